@@ -0,0 +1,76 @@
+"""
+Benchmark of class_bootstrap with the data of the Anane 2017 paper comparison: the bootstrap fits in one process
+against the same fits on all cores.
+
+Run from the repository root:
+    python benchmarks/bench_bootstrap.py [--runs 40] [--workers 4] [--parameters q_s_max,K_s] [--every 50]
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "content", "Template_generator"))
+
+import class_allthedata as catd  # noqa: E402
+import class_bootstrap as cboot  # noqa: E402
+import class_measurements as cmeas  # noqa: E402
+import class_simulator as csim  # noqa: E402
+from model_loader import load_notebook_model  # noqa: E402
+
+MODEL_DIR = os.path.join(ROOT, "content", "Library_of_models", "ecoli_2017_Anane_Acetate_cycling", "Paper_comparison")
+COLUMNS = ["Volume", "Biomass", "Substrate", "Acetate", "DOTa", "DOT", "Feed"]
+
+
+def paper_allthedata(every):
+    """ allthedata of the paper comparison notebook with every n-th point of Y_data.csv/T_data.csv as data """
+    ns = load_notebook_model(MODEL_DIR)
+    measurements = cmeas.read_measurements(os.path.join(MODEL_DIR, "Y_data.csv"), COLUMNS, start_at_zero=True,
+                                           time_file=os.path.join(MODEL_DIR, "T_data.csv"), every=every)
+    x0 = [meta["initial_value"] for meta in ns["variables"].values()]
+    rates = list(ns["algebra"](x0, ns["t"][0]))
+    simulation = csim.simulate(ns["dif_simple"], ns["feed"], x0, ns["t"], verbose=False)
+    builder = catd.AllthedataBuilder(ns["variables"], ns["inputs"], {rate: {} for rate in rates},
+                                     simulation.x_and_rs(rates), ns["t"])
+    allthedata = builder.build(**measurements.build_kwargs())
+    for name in ("Volume", "DOTa", "DOT"):  # fit biomass, substrate and acetate
+        allthedata["variables"][name]["estimable"] = False
+    return allthedata
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=40, help="number of bootstrap fits")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("--parameters", default="q_s_max,K_s", help="fitted parameters (comma separated)")
+    parser.add_argument("--every", type=int, default=50, help="use every n-th data point")
+    args = parser.parse_args()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        allthedata = paper_allthedata(args.every)
+    bootstrap = cboot.Bootstrap(MODEL_DIR, allthedata, parameters=args.parameters.split(","), seed=0)
+    bootstrap.fit_nominal()
+
+    print(f"{'parameters':<20}{'runs':>6}{'1 process':>11}{f'{args.workers} workers':>12}{'speedup':>9}"
+          f"{'max |diff|':>12}")
+    bootstrap.workers = 1
+    start = time.perf_counter()
+    serial = bootstrap.run(args.runs)
+    serial_time = time.perf_counter() - start
+    bootstrap.workers = args.workers
+    start = time.perf_counter()
+    parallel = bootstrap.run(args.runs)
+    parallel_time = time.perf_counter() - start
+
+    max_diff = float(np.max(np.abs(serial.params - parallel.params)))
+    print(f"{args.parameters:<20}{args.runs:>6}{serial_time:>10.3f}s{parallel_time:>11.3f}s"
+          f"{serial_time / parallel_time:>8.1f}x{max_diff:>12.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""
+Benchmark of the dense output of class_simulator for the library models: x_and_rs on the fixed grid t of the notebook
+against the lazily evaluated x_and_rs on the adaptive time points (same plot within 0.1 %).
+
+Run from the repository root:
+    python benchmarks/bench_dense.py
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "content", "Template_generator"))
+
+import class_simulator as csim  # noqa: E402
+from bench_rhs import LIBRARY_MODELS  # noqa: E402
+from model_loader import load_notebook_model  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.parse_args()
+
+    print(f"{'model':<30}{'grid points':>12}{'time':>9}{'adaptive':>10}{'time':>9}{'max rel. diff':>15}")
+    for model_name, model_dir in LIBRARY_MODELS.items():
+        with contextlib.redirect_stdout(io.StringIO()):
+            ns = load_notebook_model(os.path.join(ROOT, model_dir))
+        x0 = [meta["initial_value"] for meta in ns["variables"].values()]
+        t = ns["t"]
+        rates = list(ns["algebra"](x0, t[0]))
+
+        start = time.perf_counter()
+        grid = csim.simulate(ns["dif_simple"], ns["feed"], x0, t, verbose=False).x_and_rs(rates)
+        grid_time = time.perf_counter() - start
+        start = time.perf_counter()
+        simulation = csim.simulate(ns["dif_simple"], ns["feed"], x0, [t[0], t[-1]], verbose=False, dense=True)
+        lazy = simulation.lazy_x_and_rs(rates)
+        values = np.asarray(lazy)
+        lazy_time = time.perf_counter() - start
+
+        # Straight lines between the adaptive points (as plotted) compared with the grid
+        lines = np.column_stack([np.interp(t, lazy.times, column) for column in values.T])
+        rel_diff = np.abs(lines - grid).max(axis=0) / np.maximum(np.abs(grid).max(axis=0), 1e-12)
+        print(f"{model_name:<30}{len(t):>12}{grid_time:>8.3f}s{len(lazy):>10}{lazy_time:>8.3f}s"
+              f"{float(rel_diff.max()):>15.2e}")
+
+
+if __name__ == "__main__":
+    main()
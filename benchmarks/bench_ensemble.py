@@ -0,0 +1,85 @@
+"""
+Benchmark of a parameter scan: one simulation per scenario (changing the table entry and simulating again, as when
+the notebook is run once per scenario) against class_ensemble.simulate_ensemble for the library models, which
+integrates the members as one stacked system. mu_set only changes the fed-batch phase, so all members start feeding
+together; K_s also moves the feed start of Xu 1999 (substrate limit), every member then stops the stacked solver
+once. The difference is relative to the largest value of every state and rate.
+
+Run from the repository root:
+    python benchmarks/bench_ensemble.py [--members 100] [--spread 0.1] [--parameters mu_set,K_s]
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "content", "Template_generator"))
+
+import class_ensemble as cens  # noqa: E402
+import class_simulator as csim  # noqa: E402
+from bench_rhs import LIBRARY_MODELS  # noqa: E402
+from model_loader import load_notebook_model  # noqa: E402
+
+
+def scan_one_by_one(ns, name, values, x0, t, rates):
+    """ Changes the table entry and simulates again for every value, returns (N, len(t), n_states + n_rates) """
+    constant = table_entry(ns, name)
+    original = constant["value"]
+    results = []
+    try:
+        for value in values:
+            constant["value"] = value
+            with contextlib.redirect_stdout(io.StringIO()):
+                simulation = csim.simulate(ns["dif_simple"], ns["feed"], x0, t, verbose=False)
+            results.append(simulation.x_and_rs(rates))
+    finally:
+        constant["value"] = original
+    return np.array(results)
+
+
+def table_entry(ns, name):
+    """ Entry of the constants or parameters table, None if the model has no such name """
+    return ns["constants"].get(name) or ns["parameters"].get(name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--members", type=int, default=100, help="number of scenarios")
+    parser.add_argument("--spread", type=float, default=0.1, help="relative spread of the scanned values")
+    parser.add_argument("--parameters", default="mu_set,K_s", help="scanned constants/parameters (comma separated)")
+    args = parser.parse_args()
+
+    print(f"{'model':<30}{'scanned':>10}{'members':>9}{'one by one':>12}{'ensemble':>10}{'speedup':>9}"
+          f"{'feed starts':>13}{'max rel. diff':>15}")
+    for model_name, model_dir in LIBRARY_MODELS.items():
+        ns = load_notebook_model(os.path.join(ROOT, model_dir))
+        x0 = [meta["initial_value"] for meta in ns["variables"].values()]
+        t = ns["t"]
+        rates = list(ns["algebra"](x0, t[0]))  # what algebra returns (the rates dicts differ)
+        for name in args.parameters.split(","):
+            if table_entry(ns, name) is None:
+                continue
+            values = table_entry(ns, name)["value"] * np.linspace(1 - args.spread, 1 + args.spread, args.members)
+
+            start = time.perf_counter()
+            expected = scan_one_by_one(ns, name, values, x0, t, rates)
+            one_by_one_time = time.perf_counter() - start
+            start = time.perf_counter()
+            ensemble = cens.simulate_ensemble(ns["dif_simple"], ns["feed"], x0, t, parameters={name: values})
+            x_and_rs = ensemble.x_and_rs(rates)
+            ensemble_time = time.perf_counter() - start
+
+            scale = np.maximum(np.nanmax(np.abs(expected), axis=(0, 1)), 1e-12)
+            max_diff = float(np.nanmax(np.abs(expected - x_and_rs) / scale))
+            feed_starts = len({member.ts for member in ensemble.members})
+            print(f"{model_name:<30}{name:>10}{args.members:>9}{one_by_one_time:>11.3f}s{ensemble_time:>9.3f}s"
+                  f"{one_by_one_time / ensemble_time:>8.1f}x{feed_starts:>13}{max_diff:>15.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""
+Benchmark of class_estimation with the data of the Anane 2017 paper comparison: the parameters are moved away from
+their values and fitted again, with the Jacobian by finite differences of the residuals (the default) and from the
+forward sensitivities (jacobian=True). The sensitivities need fewer simulations but each is more expensive, for this
+model the fit with them is slower (about 2x with the 3 default parameters, 1.3x with
+--parameters q_s_max,K_s,Y_xsof,q_a_max,K_ia,Y_xa,Y_os,q_m), so finite differences stay the default.
+
+Run from the repository root:
+    python benchmarks/bench_estimation.py [--parameters q_s_max,K_s,Y_xsof] [--start 1.3] [--every 50]
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "content", "Template_generator"))
+
+import class_estimation as cest  # noqa: E402
+from bench_bootstrap import MODEL_DIR, paper_allthedata  # noqa: E402
+from model_loader import load_notebook_model  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--parameters", default="q_s_max,K_s,Y_xsof", help="fitted parameters (comma separated)")
+    parser.add_argument("--start", type=float, default=1.3, help="start values: factor times the notebook values")
+    parser.add_argument("--every", type=int, default=50, help="use every n-th data point")
+    args = parser.parse_args()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        allthedata = paper_allthedata(args.every)
+        ns = load_notebook_model(MODEL_DIR)
+    x0 = [meta["initial_value"] for meta in ns["variables"].values()]
+    data = cest.measured_data(allthedata, list(ns["variables"]))
+    names = args.parameters.split(",")
+
+    print(f"{'Jacobian':<16}{'time':>9}{'nfev':>6}{'njev':>6}{'simulations':>13}{'cost':>12}  fitted values")
+    for jacobian in (False, True):
+        estimator = cest.ParameterEstimator(ns["dif_simple"], ns["feed"], x0, ns["t"][0], data, names,
+                                            jacobian=jacobian)
+        if jacobian:
+            estimator.sensitivity.derivatives  # the symbolic derivation (once per model) is not part of the fit time
+        start = time.perf_counter()
+        result = estimator.fit(estimator.values * args.start)
+        fit_time = time.perf_counter() - start
+        label = "sensitivities" if jacobian else "differences"
+        values = ", ".join(f"{name}={value:.4g}" for name, value in result.as_dict().items())
+        print(f"{label:<16}{fit_time:>8.3f}s{result.nfev:>6}{result.njev:>6}{result.simulations:>13}"
+              f"{result.cost:>12.4g}  {values}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Benchmark of class_jacobian for the library models: simulations with the Jacobian estimated by the solver (finite
+differences) against the symbolic Jacobian, with odeint and the stiff methods of solve_ivp.
+
+Run from the repository root:
+    python benchmarks/bench_jacobian.py [--methods odeint,BDF,Radau] [--repeats 3]
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "content", "Template_generator"))
+
+import class_jacobian as cjac  # noqa: E402
+import class_simulator as csim  # noqa: E402
+from bench_rhs import LIBRARY_MODELS  # noqa: E402
+from model_loader import load_notebook_model  # noqa: E402
+
+
+def best_run(simulator, x0, t, repeats):
+    """ (fastest time, result) of repeated simulations """
+    best, result = np.inf, None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = simulator.run(x0, t)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--methods", default="odeint,BDF,Radau", help="solvers (comma separated)")
+    parser.add_argument("--repeats", type=int, default=3, help="simulations per case, the fastest is shown")
+    args = parser.parse_args()
+
+    print(f"{'model':<30}{'method':>8}{'Jacobian':>10}{'nfev':>8}{'njev':>6}{'time':>10}{'speedup':>9}"
+          f"{'max rel. diff':>15}")
+    for model_name, model_dir in LIBRARY_MODELS.items():
+        ns = load_notebook_model(os.path.join(ROOT, model_dir))
+        x0 = [meta["initial_value"] for meta in ns["variables"].values()]
+        t = ns["t"]
+        start = time.perf_counter()
+        jacobian = cjac.symbolic_jacobian(ns["dif_simple"])
+        print(f"{model_name:<30} derived in {time.perf_counter() - start:.2f}s, "
+              f"{int(jacobian.sparsity.sum()) if jacobian else '-'} of {len(x0) ** 2} entries not zero")
+        if jacobian is None:
+            continue
+
+        for method in args.methods.split(","):
+            solver = None if method == "odeint" else method
+            base_time, base = best_run(csim.FedBatchSimulator(ns["dif_simple"], ns["feed"], verbose=False,
+                                                              method=solver), x0, t, args.repeats)
+            jac_time, result = best_run(csim.FedBatchSimulator(ns["dif_simple"], ns["feed"], verbose=False,
+                                                               method=solver, jacobian=jacobian), x0, t, args.repeats)
+            scale = np.maximum(np.abs(base.x).max(axis=0), 1e-12)
+            rel_diff = float(np.nanmax(np.abs(result.x - base.x) / scale))
+            for label, stats, run_time in (("solver", base.stats, base_time), ("symbolic", result.stats, jac_time)):
+                speedup = f"{base_time / run_time:>8.1f}x" if label == "symbolic" else f"{'':>9}"
+                diff = f"{rel_diff:>15.2e}" if label == "symbolic" else ""
+                print(f"{'':<30}{method:>8}{label:>10}{stats['nfev']:>8}{stats['njev']:>6}{run_time:>9.3f}s"
+                      f"{speedup}{diff}")
+
+
+if __name__ == "__main__":
+    main()
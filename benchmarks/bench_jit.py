@@ -0,0 +1,89 @@
+"""
+Benchmark of class_jit for the library models: calls of the compiled Python RHS (class_compiler) against the
+numba-compiled RHS as the solver calls it (function(x, t, *args), no Python function in between), the time of the
+body of the numba RHS alone (called in a numba loop, i.e. without the call from Python) and whole simulations with
+both. Needs numba.
+
+Run from the repository root:
+    python benchmarks/bench_jit.py [--calls 20000]
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "content", "Template_generator"))
+
+import class_compiler as ccm  # noqa: E402
+import class_jit as cjit  # noqa: E402
+import class_simulator as csim  # noqa: E402
+from bench_rhs import LIBRARY_MODELS, time_calls  # noqa: E402
+from model_loader import load_notebook_model  # noqa: E402
+
+
+def best_simulation(ns, x0, jit, repeats=3):
+    best, result = np.inf, None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = csim.simulate(ns["dif_simple"], ns["feed"], x0, ns["t"], verbose=False, jit=jit)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def body_time(function, states, times, args, n_calls):
+    """ Seconds per call of the numba function called from numba (the body without the call from Python) """
+    @cjit.numba.njit
+    def loop(states, times, p, phase, ts, X_fedbatch_start, n_calls):
+        total = 0.0
+        for i in range(n_calls):
+            k = i % len(times)
+            total += function(states[k], times[k], p, phase, ts, X_fedbatch_start)[0]
+        return total
+
+    loop(states, times, *args, 1)
+    start = time.perf_counter()
+    loop(states, times, *args, n_calls)
+    return (time.perf_counter() - start) / n_calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=20000, help="RHS calls per measurement")
+    args = parser.parse_args()
+
+    if cjit.numba is None:
+        sys.exit("numba is not installed (pip install numba), there is nothing to compare.")
+    print(f"numba: {cjit.numba.__version__}")
+    print(f"{'model':<30}{'backend':>8}{'compile':>9}{'RHS call':>11}{'speedup':>9}{'body':>10}{'simulation':>12}"
+          f"{'speedup':>9}{'max rel. diff':>15}")
+    for model_name, model_dir in LIBRARY_MODELS.items():
+        ns = load_notebook_model(os.path.join(ROOT, model_dir))
+        x0 = np.array([meta["initial_value"] for meta in ns["variables"].values()], dtype=float)
+        model = ccm.compiled(ns["dif_simple"])
+        reference = csim.simulate(model, ns["feed"], x0, ns["t"], verbose=False)
+        states, times = reference.x[::10], reference.t[::10]
+        state = getattr(ns["feed"], "schedule", ns["feed"]).state("batch")
+        python_rhs = model.bind(feed=state).rhs
+        python_call = time_calls(python_rhs, list(states), times, args.calls)
+        python_time, _ = best_simulation(ns, x0, False)
+        print(f"{model_name:<30}{'python':>8}{'':>9}{python_call * 1e6:>9.2f}us{'':>9}{python_time:>11.3f}s")
+
+        start = time.perf_counter()
+        jit = cjit.JitModel(model)
+        compile_time = time.perf_counter() - start
+        rhs = jit.bind(model.values, state)
+        jit_call = time_calls(lambda x, t: rhs.function(x, t, *rhs.args), list(states), times, args.calls)
+        jit_body = body_time(rhs.function, np.ascontiguousarray(states), times, rhs.args, args.calls)
+        jit_time, result = best_simulation(ns, x0, jit)
+        scale = np.maximum(np.abs(reference.x).max(axis=0), 1e-12)
+        rel_diff = float(np.max(np.abs(result.x - reference.x) / scale))
+        print(f"{'':<30}{jit.backend:>8}{compile_time:>8.2f}s{jit_call * 1e6:>9.2f}us"
+              f"{python_call / jit_call:>8.1f}x{jit_body * 1e6:>8.2f}us{jit_time:>11.3f}s{python_time / jit_time:>8.1f}x"
+              f"{rel_diff:>15.2e}")
+
+
+if __name__ == "__main__":
+    main()
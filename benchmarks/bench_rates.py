@@ -0,0 +1,62 @@
+"""
+Benchmark of the rate post-processing: the per-point algebra loop of the old notebooks against
+SimulationResult.x_and_rs (vectorized algebra, class_compiler) for the library models.
+
+Run from the repository root:
+    python benchmarks/bench_rates.py [--dt 0.01]
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "content", "Template_generator"))
+
+import class_simulator as csim  # noqa: E402
+from bench_rhs import LIBRARY_MODELS  # noqa: E402
+from model_loader import load_notebook_model  # noqa: E402
+
+
+def legacy_rates(algebra, x, t, names, feed=None, simulation=None):
+    """ The loop of the old notebooks. With feed and simulation the feed is set to the phase of every point first
+    (the old loop used whatever phase the feed was left in). """
+    algebra_results = []
+    for k, (state_vector, time_point) in enumerate(zip(x, t)):
+        if simulation is not None:
+            feed.set_phase(simulation.phase_per_point[k], simulation.ts, simulation.X_fedbatch_start)
+        results = algebra(state_vector, time_point)
+        algebra_results.append([results[name] for name in names])
+    return np.hstack((x, np.array(algebra_results)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dt", type=float, default=0.01, help="time step of the simulation in h")
+    args = parser.parse_args()
+
+    print(f"{'model':<30}{'points':>9}{'loop':>10}{'vectorized':>12}{'speedup':>9}{'max |diff|':>12}")
+    for name, model_dir in LIBRARY_MODELS.items():
+        ns = load_notebook_model(os.path.join(ROOT, model_dir))
+        x0 = [meta["initial_value"] for meta in ns["variables"].values()]
+        t = np.linspace(0, ns["t"][-1], int(round(ns["t"][-1] / args.dt)) + 1)
+        simulation = csim.simulate(ns["dif_simple"], ns["feed"], x0, t, verbose=False)
+        names = list(ns["algebra"](simulation.x[0], t[0]))  # what algebra returns (the rates dicts differ)
+
+        start = time.perf_counter()
+        loop = legacy_rates(ns["algebra"], simulation.x, t, names)
+        loop_time = time.perf_counter() - start
+        start = time.perf_counter()
+        vectorized = simulation.x_and_rs(names)
+        vectorized_time = time.perf_counter() - start
+
+        expected = legacy_rates(ns["algebra"], simulation.x, t, names, ns["feed"], simulation)
+        max_diff = float(np.nanmax(np.abs(expected - vectorized)))
+        print(f"{name:<30}{len(t):>9}{loop_time:>9.3f}s{vectorized_time:>11.3f}s"
+              f"{loop_time / vectorized_time:>8.1f}x{max_diff:>12.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Benchmark of the compiled model RHS (class_compiler) against the generated dif_simple of the library models.
+
+Run from the repository root:
+    python benchmarks/bench_rhs.py [--calls 20000]
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+from scipy.integrate import odeint as scipy_odeint
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "content", "Template_generator"))
+
+import class_compiler as ccm  # noqa: E402
+from model_loader import load_notebook_model  # noqa: E402
+
+LIBRARY_MODELS = {
+    "Xu 1999 overflow": "content/Library_of_models/ecoli_1999_Xu_Overflow",
+    "Anane 2017 acetate cycling": "content/Library_of_models/ecoli_2017_Anane_Acetate_cycling",
+    "Anane 2017 paper comparison": "content/Library_of_models/ecoli_2017_Anane_Acetate_cycling/Paper_comparison",
+}
+
+
+def time_calls(func, states, times, n_calls):
+    n = len(states)
+    start = time.perf_counter()
+    for i in range(n_calls):
+        func(states[i % n], times[i % n])
+    return (time.perf_counter() - start) / n_calls
+
+
+def bench_model(model_dir, n_calls):
+    ns = load_notebook_model(os.path.join(ROOT, model_dir))
+    x0 = [meta["initial_value"] for meta in ns["variables"].values()]
+    t = ns["t"]
+
+    compiled = ccm.compile_model(ns["dif_simple"])
+
+    # Representative states along the trajectory
+    x = compiled.odeint(x0, t)
+    idx = np.linspace(0, len(t) - 1, 200).astype(int)
+    states, times = list(x[idx]), list(t[idx])
+
+    # Same results for every sampled state
+    max_diff = max(float(np.max(np.abs(np.subtract(ns["dif_simple"](s, ti), compiled(s, ti)))))
+                   for s, ti in zip(states, times))
+
+    per_call_plain = time_calls(ns["dif_simple"], states, times, n_calls)
+    per_call_compiled = time_calls(compiled.rhs, states, times, n_calls)
+
+    start = time.perf_counter()
+    scipy_odeint(ns["dif_simple"], x0, t)
+    solve_plain = time.perf_counter() - start
+    start = time.perf_counter()
+    compiled.odeint(x0, t)
+    solve_compiled = time.perf_counter() - start
+
+    return dict(per_call_plain=per_call_plain, per_call_compiled=per_call_compiled, solve_plain=solve_plain,
+                solve_compiled=solve_compiled, max_diff=max_diff, inlined=compiled.inlined)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=20000, help="number of RHS calls per measurement")
+    args = parser.parse_args()
+
+    print(f"{'model':<30}{'dif_simple':>12}{'compiled':>12}{'speedup':>9}{'odeint':>10}{'compiled':>10}"
+          f"{'max |diff|':>12}")
+    for name, model_dir in LIBRARY_MODELS.items():
+        r = bench_model(model_dir, args.calls)
+        print(f"{name:<30}{r['per_call_plain'] * 1e6:>10.2f}us{r['per_call_compiled'] * 1e6:>10.2f}us"
+              f"{r['per_call_plain'] / r['per_call_compiled']:>8.1f}x"
+              f"{r['solve_plain']:>9.3f}s{r['solve_compiled']:>9.3f}s{r['max_diff']:>12.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+Benchmark of class_sensitivity for the library models: the forward sensitivities (one augmented solver run per
+feeding phase, df/dx and df/dp derived with class_jacobian) against central finite differences of whole simulations
+(two simulations per parameter). The symbolic derivation is done once per model and reported on its own. A model with
+an if/else test that switches with the states inside a phase (Xu 1999) is calculated with finite differences by the
+simulator as well.
+
+Run from the repository root:
+    python benchmarks/bench_sensitivity.py [--step 1e-3]
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "content", "Template_generator"))
+
+import class_sensitivity as csens  # noqa: E402
+import class_simulator as csim  # noqa: E402
+from bench_rhs import LIBRARY_MODELS  # noqa: E402
+from model_loader import load_notebook_model  # noqa: E402
+
+
+def finite_differences(model, feed, names, x0, t, step):
+    """ d x / d p of all parameters by simulating the model twice per parameter, shape (len(t), n_states, n_params) """
+    columns = []
+    for name in names:
+        base = model.values[model.index[name]]
+        h = step * max(abs(base), 1e-8)
+        runs = []
+        for value in (base + h, base - h):
+            with contextlib.redirect_stdout(io.StringIO()):
+                runs.append(csim.simulate(model.with_values(**{name: value}), feed, x0, t, verbose=False).x)
+        columns.append((runs[0] - runs[1]) / (2 * h))
+    return np.stack(columns, axis=-1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--step", type=float, default=1e-3, help="relative step of the finite differences")
+    args = parser.parse_args()
+
+    print(f"{'model':<30}{'parameters':>11}{'derivation':>12}{'finite diff.':>14}{'forward':>10}{'speedup':>9}"
+          f"{'median rel. diff':>18}{'method':>22}")
+    for model_name, model_dir in LIBRARY_MODELS.items():
+        ns = load_notebook_model(os.path.join(ROOT, model_dir))
+        x0 = [meta["initial_value"] for meta in ns["variables"].values()]
+        t = ns["t"]
+        start = time.perf_counter()
+        simulator = csens.SensitivitySimulator(ns["dif_simple"], ns["feed"])
+        simulator.derivatives  # the derivation is done at the first use
+        derivation_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        expected = finite_differences(simulator.model, ns["feed"], simulator.names, x0, t, args.step)
+        fd_time = time.perf_counter() - start
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = simulator.run(x0, t)
+        forward_time = time.perf_counter() - start
+
+        # Relative difference of every parameter (if an if/else test switches inside a phase, e.g. the overflow of
+        # Xu 1999, the simulator falls back to finite differences, see the last column)
+        scale = np.maximum(np.abs(expected).max(axis=(0, 1)), 1e-12)
+        rel_diff = np.abs(result.sensitivities - expected).max(axis=(0, 1)) / scale
+        print(f"{model_name:<30}{len(simulator.names):>11}{derivation_time:>11.3f}s{fd_time:>13.3f}s{forward_time:>9.3f}s"
+              f"{fd_time / forward_time:>8.1f}x{float(np.median(rel_diff)):>18.2e}"
+              f"{'finite differences' if simulator.branch_switch else 'forward':>22}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Benchmark of the event-driven simulation (class_simulator) against the two odeint cells the notebooks used before:
+a test run over the whole time to find feed.ts and the phase-by-phase re-integration.
+
+Run from the repository root:
+    python benchmarks/bench_simulation.py [--repeats 5]
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+
+import numpy as np
+from scipy.integrate import odeint as scipy_odeint
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "content", "Template_generator"))
+
+import class_simulator  # noqa: E402,F401
+from bench_rhs import LIBRARY_MODELS  # noqa: E402
+from model_loader import load_notebook_model  # noqa: E402
+
+
+def legacy_simulation(ns, x0, t, substrate_limit, t_const):
+    """ The test run and the 'Const. feed + fedbatch (by substrate)' branch of the old notebooks. """
+    cfb = sys.modules["class_fedbatch"]
+    dt, t_end = t[1] - t[0], t[-1]
+    ns["feed"] = cfb.Feed(t_const=t_const, substrate_limit=substrate_limit)
+    scipy_odeint(ns["dif_simple"], x0, t)
+    ts = ns["feed"].ts
+    t_1 = np.linspace(t[0], ts, int(ts / dt) + 1)
+    t_2 = np.linspace(ts, t_const, int((t_const - ts) / dt) + 1)
+    t_3 = np.linspace(t_const, t_end, int((t_end - t_const) / dt) + 1)
+    ns["feed"] = cfb.Feed(t_const=t_const, substrate_limit=substrate_limit)
+    x_1 = scipy_odeint(ns["dif_simple"], x0, t_1)
+    x_2 = scipy_odeint(ns["dif_simple"], x_1[-1], t_2)
+    x_3 = scipy_odeint(ns["dif_simple"], x_2[-1], t_3)
+    return np.vstack((x_1[:-1], x_2[:-1], x_3))
+
+
+def new_simulation(ns, x0, t, substrate_limit, t_const):
+    cfb, csim = sys.modules["class_fedbatch"], sys.modules["class_simulator"]
+    ns["feed"] = cfb.Feed(t_const=t_const, substrate_limit=substrate_limit)
+    return csim.simulate(ns["dif_simple"], ns["feed"], x0, t, verbose=False).x
+
+
+def best_time(func, repeats, *args):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            func(*args)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeats", type=int, default=5, help="runs per measurement (the best one is shown)")
+    args = parser.parse_args()
+
+    print(f"{'model':<30}{'two odeint cells':>18}{'simulator':>12}{'speedup':>9}")
+    for name, model_dir in LIBRARY_MODELS.items():
+        ns = load_notebook_model(os.path.join(ROOT, model_dir))
+        x0 = [meta["initial_value"] for meta in ns["variables"].values()]
+        case = (ns["t"], 0.01, ns["t_constant_feed"])
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            new_simulation(ns, x0, *case)  # compiles the model once
+        legacy = best_time(legacy_simulation, args.repeats, ns, x0, *case)
+        new = best_time(new_simulation, args.repeats, ns, x0, *case)
+        print(f"{name:<30}{legacy:>17.3f}s{new:>11.3f}s{legacy / new:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+"""
+Benchmark suite of the whole notebook workflow for the library models, run headless: RHS calls, the odeint solve of
+the old notebooks, the simulation over all feeding phases (class_simulator), the rate post-processing (old algebra
+loop and x_and_rs), AllthedataBuilder.build, PlotPlotly.plot_by_expID and its _save_fig. Every case also runs in
+scaled variants (longer horizon, smaller dt, more experiments).
+
+The results are stored as JSON per commit in benchmarks/results/<commit>.json and compared with a baseline: a stage
+that is more than --threshold slower (and at least 1 ms) is flagged as regression and the exit code is 1.
+
+Run from the repository root:
+    python benchmarks/bench_suite.py [--models Xu] [--scales horizon=4,dt=4,experiments=8] [--repeats 3]
+                                     [--baseline benchmarks/results/baseline.json] [--update-baseline]
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+from scipy.integrate import odeint as scipy_odeint
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "content", "Template_generator"))
+
+import class_allthedata as catd  # noqa: E402
+import class_compiler as ccm  # noqa: E402
+import class_plot as cplt  # noqa: E402
+import class_simulator as csim  # noqa: E402
+from bench_rates import legacy_rates  # noqa: E402
+from bench_rhs import LIBRARY_MODELS  # noqa: E402
+from model_loader import load_notebook_model  # noqa: E402
+
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+BASELINE = os.path.join(RESULTS_DIR, "baseline.json")
+
+# A stage is a regression if it is slower than the baseline by more than the threshold and by at least MIN_DIFF
+DEFAULT_THRESHOLD = 0.25
+MIN_DIFF = 1e-3
+
+RHS_CALLS = 2000
+
+
+def best_time(func, repeats):
+    """ (fastest time of repeated calls, result of the last call), output of func is suppressed """
+    best, result = np.inf, None
+    for _ in range(repeats):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            result = func()
+            best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def scaled_grid(t, horizon=1, dt=1):
+    """ Time grid of the notebook with horizon times the duration and dt / dt steps """
+    step = (t[-1] - t[0]) / (len(t) - 1) / dt
+    t_end = t[0] + (t[-1] - t[0]) * horizon
+    return np.linspace(t[0], t_end, int(round((t_end - t[0]) / step)) + 1)
+
+
+class Case:
+    """ One library model with the time grid and the number of experiments of a scaled variant """
+
+    def __init__(self, ns, horizon=1, dt=1, experiments=1):
+        self.ns = ns
+        self.t = scaled_grid(ns["t"], horizon, dt)
+        self.experiments = experiments
+        self.x0 = np.array([meta["initial_value"] for meta in ns["variables"].values()], dtype=float)
+        self.model = ccm.compiled(ns["dif_simple"])
+        # Rates as algebra returns them, with the metadata of the notebook where the names match
+        self.rates = {name: ns["rates"].get(name, {}) for name in ns["algebra"](self.x0, self.t[0])}
+
+    def run(self, repeats):
+        ns, t, x0 = self.ns, self.t, self.x0
+        times = {}
+        simulation = csim.simulate(self.model, ns["feed"], x0, t, verbose=False)
+        states = list(simulation.x[np.linspace(0, len(t) - 1, 200).astype(int)])
+        points = list(t[np.linspace(0, len(t) - 1, 200).astype(int)])
+        rhs = simulation._phase_model(simulation.phases[0]["phase"]).rhs
+
+        def rhs_calls():
+            for k in range(RHS_CALLS):
+                rhs(states[k % 200], points[k % 200])
+
+        times["rhs_call"], _ = best_time(rhs_calls, repeats)
+        times["rhs_call"] /= RHS_CALLS
+        times["odeint"], _ = best_time(lambda: scipy_odeint(ns["dif_simple"], x0, t), repeats)
+        times["simulate"], simulation = best_time(
+            lambda: csim.simulate(self.model, ns["feed"], x0, t, verbose=False), repeats)
+        times["algebra_loop"], _ = best_time(
+            lambda: legacy_rates(ns["algebra"], simulation.x, t, list(self.rates)), repeats)
+        times["x_and_rs"], x_and_rs = best_time(lambda: simulation.x_and_rs(self.rates), repeats)
+
+        def build():
+            return [catd.AllthedataBuilder(ns["variables"], ns["inputs"], self.rates, x_and_rs, t,
+                                           **simulation.builder_kwargs()).build() for _ in range(self.experiments)]
+
+        times["build"], experiments = best_time(build, repeats)
+        plot_time, save_time = self._plot({str(i + 1): data for i, data in enumerate(experiments)}, repeats)
+        times["plot_by_expID"] = plot_time - save_time
+        times["save_fig"] = save_time
+        return times
+
+    @staticmethod
+    def _plot(allthedata_plot, repeats):
+        """ (time of plot_by_expID without saving, time of _save_fig), fastest of the repeats """
+        best = (np.inf, np.inf)
+        with tempfile.TemporaryDirectory() as path:
+            for _ in range(repeats):
+                plot = cplt.PlotPlotly(allthedata_plot, path, plot_info="bench", plot_mode="white_w_grid",
+                                       colorscheme="matlab_default", plot_formats=("html",))
+                save_fig, saving = plot._save_fig, [0.0]
+
+                def timed_save_fig(*args, **kwargs):
+                    start = time.perf_counter()
+                    save_fig(*args, **kwargs)
+                    saving[0] += time.perf_counter() - start
+
+                plot._save_fig = timed_save_fig
+                with contextlib.redirect_stdout(io.StringIO()):
+                    start = time.perf_counter()
+                    plot.plot_by_expID(plot_replicates=False, show_legend=False, plot_SE_data=False,
+                                       split_at_feed_start=False, range_end=None)
+                    total = time.perf_counter() - start
+                if total < best[0]:
+                    best = (total, saving[0])
+        return best
+
+
+def commit_id():
+    """ Short hash of HEAD, with -dirty if the working tree has changes ("unknown" outside of git) """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT,
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return commit + ("-dirty" if dirty else "")
+
+
+def compare(results, baseline, threshold):
+    """ [(case, stage, baseline time, time)] of all stages that are slower than the baseline """
+    regressions = []
+    for case, stages in results.items():
+        for stage, value in stages.items():
+            reference = baseline.get(case, {}).get(stage)
+            if reference is not None and value > reference * (1 + threshold) and value - reference >= MIN_DIFF:
+                regressions.append((case, stage, reference, value))
+    return regressions
+
+
+def parse_scales(text):
+    scales = [("", {})]
+    for item in filter(None, text.split(",")):
+        name, _, factor = item.partition("=")
+        if name not in ("horizon", "dt", "experiments"):
+            raise SystemExit(f"Unknown scale '{name}', use horizon, dt or experiments.")
+        scales.append((f" {name}x{factor}", {name: int(factor)}))
+    return scales
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--models", default="", help="only models whose name contains one of these (comma separated)")
+    parser.add_argument("--scales", default="horizon=4,dt=4,experiments=8",
+                        help="scaled variants: horizon, dt and experiments factors (comma separated, empty: none)")
+    parser.add_argument("--repeats", type=int, default=3, help="repetitions per stage, the fastest is stored")
+    parser.add_argument("--baseline", default=BASELINE, help="results file to compare with")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="allowed relative slowdown")
+    parser.add_argument("--update-baseline", action="store_true", help="store the results as new baseline")
+    args = parser.parse_args()
+
+    selected = [name for name in LIBRARY_MODELS
+                if not args.models or any(part in name for part in args.models.split(","))]
+    results = {}
+    print(f"{'case':<44}{'RHS call':>10}{'odeint':>9}{'simulate':>10}{'algebra':>9}{'x_and_rs':>10}{'build':>9}"
+          f"{'plot':>9}{'save':>9}")
+    for model_name in selected:
+        with contextlib.redirect_stdout(io.StringIO()):
+            ns = load_notebook_model(os.path.join(ROOT, LIBRARY_MODELS[model_name]))
+        for suffix, scale in parse_scales(args.scales):
+            times = Case(ns, **scale).run(args.repeats)
+            results[model_name + suffix] = times
+            print(f"{model_name + suffix:<44}{times['rhs_call'] * 1e6:>8.2f}us"
+                  + "".join(f"{times[stage]:>{width - 1}.3f}s" for stage, width in
+                            (("odeint", 9), ("simulate", 10), ("algebra_loop", 9), ("x_and_rs", 10), ("build", 9),
+                             ("plot_by_expID", 9), ("save_fig", 9))))
+
+    commit = commit_id()
+    record = dict(commit=commit, date=datetime.datetime.now().isoformat(timespec="seconds"),
+                  python=platform.python_version(), numpy=np.__version__, machine=platform.machine(),
+                  results=results)
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(RESULTS_DIR, f"{commit}.json")
+    with open(path, "w") as file:
+        json.dump(record, file, indent=2)
+    print(f"Results are saved here: {path}")
+
+    status = 0
+    if os.path.exists(args.baseline) and not args.update_baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        regressions = compare(results, baseline["results"], args.threshold)
+        print(f"Compared with {baseline['commit']} ({os.path.relpath(args.baseline, ROOT)}): "
+              f"{len(regressions)} regression(s)")
+        for case, stage, reference, value in regressions:
+            print(f"⚠️ {case} {stage}: {reference:.4g}s -> {value:.4g}s ({value / reference - 1:+.0%})")
+        status = 1 if regressions else 0
+    if args.update_baseline or not os.path.exists(args.baseline):
+        with open(args.baseline, "w") as file:
+            json.dump(record, file, indent=2)
+        print(f"Baseline updated: {os.path.relpath(args.baseline, ROOT)}")
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,53 @@
+"""
+Benchmark of class_sweep for the library models: a parameter sweep in one process against the same sweep on
+all cores (ProcessPoolExecutor with a shared result store).
+
+Run from the repository root:
+    python benchmarks/bench_sweep.py [--scenarios 200] [--workers 4] [--chunk-size 8]
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "content", "Template_generator"))
+
+import class_sweep as csw  # noqa: E402
+from bench_rhs import LIBRARY_MODELS  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", type=int, default=200, help="number of scenarios")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("--chunk-size", type=int, default=csw.DEFAULT_CHUNK_SIZE, help="scenarios per task")
+    args = parser.parse_args()
+
+    print(f"{'model':<30}{'scenarios':>10}{'1 process':>11}{f'{args.workers} workers':>12}{'speedup':>9}"
+          f"{'max |diff|':>12}")
+    for name, model_dir in LIBRARY_MODELS.items():
+        path = os.path.join(ROOT, model_dir)
+        sweep = csw.Sweep(path, chunk_size=args.chunk_size)
+        parameter = "mu_set" if "mu_set" in sweep.runner.model.index else sweep.runner.model.names[0]
+        base = sweep.runner.model.values[sweep.runner.model.index[parameter]]
+        scenarios = csw.grid({parameter: base * np.linspace(0.7, 1.3, args.scenarios)})
+
+        sweep.workers = 1
+        start = time.perf_counter()
+        serial = sweep.run(scenarios)
+        serial_time = time.perf_counter() - start
+        sweep.workers = args.workers
+        start = time.perf_counter()
+        parallel = sweep.run(scenarios)
+        parallel_time = time.perf_counter() - start
+
+        max_diff = float(np.nanmax(np.abs(serial.x_and_rs - parallel.x_and_rs)))
+        print(f"{name:<30}{args.scenarios:>10}{serial_time:>10.3f}s{parallel_time:>11.3f}s"
+              f"{serial_time / parallel_time:>8.1f}x{max_diff:>12.2e}")
+
+
+if __name__ == "__main__":
+    main()
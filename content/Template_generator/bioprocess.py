@@ -0,0 +1,173 @@
+"""
+Command line runner for the generated models (e.g. the Library_of_models folders), without Jupyter or IPython:
+loads the model notebook (or its specification file, see class_spec), simulates it, builds allthedata, saves the
+results and the plots and exits.
+
+Run from this folder (or with it on PYTHONPATH):
+    python -m bioprocess run ../Library_of_models/ecoli_1999_Xu_Overflow [--config overrides.json]
+                             [--output results] [--no-plots] [--quiet]
+    python -m bioprocess run ../Library_of_models/ecoli_1999_Xu_Overflow/ecoli_1999_Xu_Overflow.model.json
+
+overrides.json (every entry is optional):
+    {
+        "overrides": {"q_s_max": 1.2, "variables.Biomass.initial_value": 0.2, "inputs.Feed.concentration": 500},
+        "time": {"t_end": 20, "dt": 0.01},
+        "feed": {"t_fedbatch_start": 5, "substrate_limit": null, "t_const": 18},
+        "options": {"jacobian": true, "diagnostics": true},
+        "description": "Higher feed concentration"
+    }
+"overrides" are values of the tables of the notebook by path (<table>.<name>.<field>) or, for constants and
+parameters, by name. "time" replaces t0, t_end and dt of the notebook, "feed" the feed configuration (cfb.FeedSchedule)
+and "options" are passed to csim.FedBatchSimulator.
+"""
+import argparse
+import contextlib
+import dataclasses
+import io
+import json
+import os
+import sys
+
+import numpy as np
+
+import class_allthedata as catd
+import class_registry as creg
+import class_simulator as csim
+import class_spec as cspec
+import class_storage as cstore
+
+
+CONFIG_KEYS = ("overrides", "time", "feed", "options", "description")
+TABLES = ("constants", "parameters", "inputs", "variables")
+RESULTS_FOLDER = "cli_results"
+
+
+def load_config(path):
+    """ Config dict of a JSON file (None gives an empty config) """
+    if path is None:
+        return {}
+    with open(path, "r", encoding="utf-8") as file:
+        config = json.load(file)
+    unknown = set(config) - set(CONFIG_KEYS)
+    if unknown:
+        raise ValueError(f"Unknown entries {sorted(unknown)} in {path}, use {list(CONFIG_KEYS)}.")
+    return config
+
+
+def apply_overrides(ns, overrides):
+    """ Writes the overrides into the tables of the loaded notebook (before anything is compiled or simulated) """
+    for name, value in overrides.items():
+        parts = name.split(".")
+        if len(parts) == 3 and parts[0] in TABLES:
+            table, key, field = parts
+        else:
+            table = next((table for table in ("constants", "parameters") if name in ns.get(table, {})), None)
+            key, field = name, "value"
+        if table is None or key not in ns.get(table, {}) or field not in ns[table][key]:
+            raise KeyError(f"'{name}' is not in the model, use <table>.<name>.<field> (tables: {TABLES}) or the "
+                           f"name of a constant or parameter.")
+        ns[table][key][field] = value
+
+
+def time_grid(ns, time=None):
+    """ t of the notebook, or a new grid if time has t0, t_end or dt """
+    if not time:
+        return np.asarray(ns["t"], dtype=float)
+    t0, t_end, dt = (time.get(name, ns.get(name)) for name in ("t0", "t_end", "dt"))
+    return np.linspace(t0, t_end, int(round((t_end - t0) / dt)) + 1)
+
+
+def _json_default(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return repr(value)
+
+
+def run(model_dir, config=None, output=None, plots=True):
+    """ Simulates a model folder headless and saves everything into a new folder of output.
+
+    Saved are x_and_rs.csv (time, variables and rates), summary.json (config, feed start, phases, solver
+    statistics and allthedata["diagnostics"]), allthedata ({"1": allthedata}, see class_storage.load_allthedata)
+    and the plots of cplt.PlotPlotly.plot_by_expID as HTML. The run and its files are registered in the run
+    registry of the results folder (class_registry).
+
+    :param model_dir: model notebook or folder containing it (see model_loader.load_notebook_model), or a
+        specification file (.json/.yaml, see class_spec.load_model) which loads without executing the notebook
+    :param config: config dict (see load_config), None for the notebook as it is
+    :param output: folder of the results, defaults to RESULTS_FOLDER in the model folder
+    :param plots: False to save only the data (plotly is then not imported)
+    :return: path of the folder with the results
+    """
+    config = config or {}
+    ns = cspec.load_namespace(model_dir)
+    apply_overrides(ns, config.get("overrides", {}))
+    t = time_grid(ns, config.get("time"))
+    feed = ns["feed"]
+    if config.get("feed"):
+        feed = dataclasses.replace(getattr(feed, "schedule", feed), **config["feed"])
+
+    x0 = [meta["initial_value"] for meta in ns["variables"].values()]
+    simulation = csim.simulate(ns["dif_simple"], feed, x0, t, **config.get("options", {}))
+    # The rates in the order algebra returns them, with the description of the rates dict where the names match
+    rates = {name: ns["rates"].get(name, {}) for name in ns["algebra"](np.asarray(x0, dtype=float), t[0])}
+    x_and_rs = simulation.x_and_rs(rates)
+
+    model_name = os.path.basename(os.path.normpath(ns["__model_dir__"]))
+    builder = catd.AllthedataBuilder(ns["variables"], ns["inputs"], rates, x_and_rs, t,
+                                     description=config.get("description", model_name),
+                                     **simulation.builder_kwargs())
+    allthedata = builder.build()
+    results_folder = output or os.path.join(ns["__model_dir__"], RESULTS_FOLDER)
+    # Registered in the run registry of results_folder, identical runs have the same fingerprint
+    path, datestring, run_id = builder.init_saving(model_name, "cli", results_folder, model_name=model_name, config=dict(
+        constants=ns["constants"], parameters=ns["parameters"], feed=getattr(feed, "schedule", feed),
+        options=config.get("options", {}), model=simulation.model.source))
+
+    columns = ["time"] + list(ns["variables"]) + list(rates)
+    np.savetxt(os.path.join(path, "x_and_rs.csv"), np.column_stack((t, x_and_rs)), delimiter=",",
+               header=",".join(columns), comments="")
+    summary = dict(model=ns["__model_dir__"], config=config, mode=simulation.mode, ts=simulation.ts,
+                   X_fedbatch_start=simulation.X_fedbatch_start, phases=simulation.phases, stats=simulation.stats,
+                   diagnostics=allthedata["diagnostics"])
+    with open(os.path.join(path, "summary.json"), "w", encoding="utf-8") as file:
+        json.dump(summary, file, indent=2, default=_json_default)
+    cstore.save_allthedata({"1": allthedata}, os.path.join(path, "allthedata"))
+
+    if plots:
+        import class_plot as cplt  # plotly is only needed for the plots
+
+        plot = cplt.PlotPlotly({"1": allthedata}, path, plot_info=f"{datestring}_{run_id}", plot_mode="white_w_grid",
+                               colorscheme="matlab_default", plot_formats=("html",))
+        plot.plot_by_expID(plot_replicates=False, show_legend=False, plot_SE_data=False,
+                           split_at_feed_start=False, range_end=None)
+    with creg.RunRegistry(results_folder) as registry:
+        registry.scan_artifacts(path)
+    return path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bioprocess", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="simulate a model folder and save results and plots")
+    run_parser.add_argument("model_dir", help="model folder (or notebook or specification file), e.g. "
+                                              "../Library_of_models/<model>")
+    run_parser.add_argument("--config", help="JSON file with overrides, time, feed, options and description")
+    run_parser.add_argument("--output", help=f"folder of the results (default: <model_dir>/{RESULTS_FOLDER})")
+    run_parser.add_argument("--no-plots", action="store_true", help="save only the data")
+    run_parser.add_argument("--quiet", action="store_true", help="print only the path of the results")
+    args = parser.parse_args(argv)
+
+    config = load_config(args.config)
+    output = os.path.abspath(args.output) if args.output else None
+    with contextlib.redirect_stdout(io.StringIO()) if args.quiet else contextlib.nullcontext():
+        path = run(args.model_dir, config, output, plots=not args.no_plots)
+    if args.quiet:
+        print(path)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
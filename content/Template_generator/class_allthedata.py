@@ -1,19 +1,122 @@
 import numpy as np
 import datetime
 import os
+from collections.abc import Mapping
+from functools import lru_cache
+
+
+@lru_cache(maxsize=32)
+def placeholder_column(fill, n_points):
+    """
+    Read-only column of n_points values ("nan" for rates without data, "zeros" for input profiles), one array per
+    length that all allthedata dicts share instead of allocating their own.
+    """
+    column = np.full(n_points, np.nan if fill == "nan" else 0.0)
+    column.setflags(write=False)
+    return column
+
+
+class ColumnBlock(Mapping):
+    """
+    Columns of one float64 block (time points x columns) by name, for allthedata["simulation_data"]["vals"].
+    Every column is a view of the block, so the states and rates of an experiment are stored once (no copies).
+    Reads like the dict it replaces: vals["Biomass"], vals.keys(), len(vals).
+    """
+
+    def __init__(self, values, names):
+        self.values = values
+        self.index = {name: idx for idx, name in enumerate(names)}
+
+    def __getitem__(self, name):
+        return self.values[:, self.index[name]]
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __repr__(self):
+        return f"ColumnBlock({list(self.index)}, shape={self.values.shape})"
+
+
+class LazyColumns(Mapping):
+    """
+    Columns of a lazily evaluated trajectory (csim.LazyTrajectory) by name, for allthedata["simulation_data"]["vals"].
+    Nothing is calculated until the first column is read (e.g. by the plotting class), then all columns at once.
+    """
+
+    def __init__(self, x, names):
+        self.x = x
+        self.names = {name: idx for idx, name in enumerate(names)}
+
+    def __getitem__(self, name):
+        return self.x[:, self.names[name]]
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+
+def align_columns(data, names, columns=None):
+    """
+    Measured data of the columns `names` as ColumnBlock (only the names found in the data, in the order of names)
+    and the list of the names not found.
+
+    data can be a dict of columns, an ndarray (with `columns`, the names of its columns) or a pandas DataFrame. The
+    names are mapped through one index of the columns and gathered at once. If the found names are adjacent
+    columns of a float64 array (or DataFrame) in the same order, the block is a view of the data (no copy).
+    """
+    names = list(names)
+    if hasattr(data, "to_numpy") and hasattr(data, "columns"):  # pandas DataFrame (pandas is not imported here)
+        columns = list(data.columns) if columns is None else list(columns)
+        try:
+            data = data.to_numpy(dtype=float, copy=False)
+        except (TypeError, ValueError):  # non-numeric columns (e.g. timestamps), only the used ones are converted
+            used = [name for name in columns if name in set(names)]
+            data, columns = data[used].to_numpy(dtype=float), used
+
+    if isinstance(data, dict):
+        found = [name for name in names if name in data]
+        values = np.column_stack([np.asarray(data[name], dtype=float) for name in found]) if found \
+            else np.empty((0, 0))
+    elif isinstance(data, np.ndarray):
+        if columns is None:
+            raise ValueError("If data is ndarray, you must provide `columns`.")
+        index = {name: idx for idx, name in enumerate(columns)}
+        positions = [index[name] for name in names if name in index]
+        found = [name for name in names if name in index]
+        values = np.asarray(data, dtype=float)
+        if values.ndim == 1:
+            values = values[:, None]
+        if positions and positions == list(range(positions[0], positions[0] + len(positions))):
+            values = values[:, positions[0]:positions[0] + len(positions)]  # view
+        else:
+            values = values[:, positions]  # one gather
+    else:
+        raise TypeError("Data must be a dict, numpy.ndarray or pandas.DataFrame.")
+    found_set = set(found)
+    return ColumnBlock(values, found), [name for name in names if name not in found_set]
+
 
 class AllthedataBuilder:
-    def __init__(self, variables: dict, inputs: dict, rates: dict, x: np.ndarray, t: np.ndarray, t_fedbatch = None, t_constant_feed = None, description = "Simulation"):
+    def __init__(self, variables: dict, inputs: dict, rates: dict, x: np.ndarray, t: np.ndarray = None, t_fedbatch = None, t_constant_feed = None, description = "Simulation", diagnostics = None):
         self.variables = variables
         self.inputs = inputs
         self.rates = rates
         self.x = x
-        self.t = t
+        # x can also be a csim.LazyTrajectory (simulation.lazy_x_and_rs(rates)), t are then its time points
+        self.lazy = callable(x)
+        self.t = x.times if t is None and self.lazy else t
         self.description = description
+        # cdiag.Diagnostics of the simulation (csim.simulate(..., diagnostics=True)), stored as allthedata["diagnostics"]
+        self.diagnostics = diagnostics
 
         # Time settings (could be generalized)
-        self.t0 = float(t[0])
-        self.t_end = float(t[-1])
+        self.t0 = float(self.t[0])
+        self.t_end = float(self.t[-1])
         self.t_fedbatch = t_fedbatch
         self.t_constant_feed = t_constant_feed
 
@@ -21,14 +124,24 @@ class AllthedataBuilder:
         self.data = None
         self.t_data = None
 
-    def init_saving(self, run_description="", run_id="run", path_save="", path_to_results_load=None):
+    def init_saving(self, run_description="", run_id="run", path_save="", path_to_results_load=None, model_name=None,
+                    config=None, registry=True):
         """
         Function to initialize saving (e.g. create folder if not existing.).
 
+        The run is also registered in the run registry of path_save (class_registry.RunRegistry, runs.sqlite) with
+        its model name, a fingerprint of its configuration and summary metrics (see summary_metrics), so earlier
+        runs can be found without scanning the folders.
+
         :param run_description: Optional description string for naming the folder
         :param run_id: Run identifier (int or str)
         :param path_save: Base path to save results, defaults to current working dir
         :param path_to_results_load: If provided, load results from here instead of creating a new folder
+        :param model_name: Model name in the registry
+        :param config: Everything the run depends on beyond variables, inputs, rates and time (e.g. constants,
+                       parameters and feed settings) for the fingerprint. Without it the simulated values are part
+                       of the fingerprint instead.
+        :param registry: False to not register the run
         :return: (path_to_results, datestring)
         """
         datestring = datetime.datetime.now().strftime("%Y%m%d_%H-%M-%S")
@@ -56,8 +169,40 @@ class AllthedataBuilder:
         if not os.path.exists(path_to_results):
             os.makedirs(path_to_results, exist_ok=True)
 
+        if registry:
+            try:
+                import class_registry as creg  # sqlite3 is only imported when a run is registered
+
+                creg.register_run(path_to_results_folder, path_to_results, run_id=run_id, model=model_name,
+                                  description=self.description, fingerprint=self.fingerprint(config),
+                                  metrics=self.summary_metrics())
+            except Exception as error:  # e.g. a locked or read-only results folder, the results are saved anyway
+                print(f"⚠️ Warning: run not registered ({error}).")
+
         return path_to_results, datestring, run_id
 
+    def fingerprint(self, config=None):
+        """ Fingerprint of the configuration of the run (see init_saving), equal for identical runs """
+        run = {"variables": self.variables, "inputs": self.inputs, "rates": self.rates, "t": np.asarray(self.t),
+               "t_fedbatch": self.t_fedbatch, "t_constant_feed": self.t_constant_feed, "config": config}
+        if config is None and not self.lazy:
+            run["x"] = np.asarray(self.x)
+        import class_registry as creg
+
+        return creg.fingerprint(run)
+
+    def summary_metrics(self):
+        """ Key numbers of the run for the registry: end time, feed starts and final values of the variables """
+        metrics = {"t_end": self.t_end}
+        if self.t_fedbatch is not None and np.size(self.t_fedbatch):
+            metrics["feed start"] = float(np.ravel(self.t_fedbatch)[0])
+        if self.t_constant_feed is not None and np.size(self.t_constant_feed):
+            metrics["constant feed start"] = float(np.ravel(self.t_constant_feed)[0])
+        if not self.lazy:
+            for idx, name in enumerate(self.variables):
+                metrics[f"final {name}"] = float(self.x[-1, idx])
+        return metrics
+
 
     # -----------------------------
     # Core: Build method
@@ -99,6 +244,7 @@ class AllthedataBuilder:
             "variables": self._build_variables_section(),
             "inputs": self._build_inputs_section(),
             "measurement_times": [],
+            "diagnostics": {} if self.diagnostics is None else self.diagnostics.table(),
         }
         return allthedata
 
@@ -107,45 +253,23 @@ class AllthedataBuilder:
     # Helper: Align experimental data
     # -----------------------------
     def _align_data_with_variables(self, data, columns=None):
-        var_names = list(self.variables.keys())
-        n_vars = len(var_names)
-
-        if isinstance(data, dict):
-            aligned = np.zeros((len(self.t_data), n_vars))
-            for i, name in enumerate(var_names):
-                if name in data:
-                    aligned[:, i] = np.array(data[name])
-                else:
-                    aligned[:, i] = np.nan
-                    print(f"⚠️ Warning: '{name}' not found in data dict — filled with NaN.")
-        elif isinstance(data, np.ndarray):
-            if columns is None:
-                raise ValueError("If data is ndarray, you must provide `columns`.")
-            aligned = np.zeros((data.shape[0], n_vars))
-            for i, name in enumerate(var_names):
-                if name in columns:
-                    idx = columns.index(name)
-                    aligned[:, i] = data[:, idx]
-                else:
-                    aligned[:, i] = np.nan
-                    print(f"⚠️ Warning: '{name}' not found in data columns — filled with NaN.")
-        else:
-            raise TypeError("Data must be a dict or numpy.ndarray.")
-
+        names = list(self.variables.keys()) + list(self.rates.keys())
+        aligned, missing = align_columns(data, names, columns)
+        if len(aligned) and aligned.values.shape[0] != len(self.t_data):
+            raise ValueError(f"The data has {aligned.values.shape[0]} rows, but there are {len(self.t_data)} "
+                             f"time points (t_data).")
+        if missing:
+            print(f"⚠️ Warning: {len(missing)} of {len(names)} variables/rates not found in the data — filled with "
+                  f"NaN: {', '.join(missing)}")
         print("✅ Data successfully aligned with variable order.")
         return aligned
 
     def _extract_state_values(self):
-        vals = {}
-        for idx, var in enumerate(self.variables.keys()):
-            vals[var] = self.x[:, idx]
-
-        n_states = len(self.variables)
-
-        for id, rate in enumerate(self.rates.keys()):
-            id = n_states + id
-            vals[rate] = self.x[:, id]
-        return vals
+        names = list(self.variables.keys()) + list(self.rates.keys())
+        if self.lazy:
+            return LazyColumns(self.x, names)
+        # x_and_rs is the block itself (copied only if it is not a float64 array)
+        return ColumnBlock(np.asarray(self.x, dtype=float), names)
 
     def _format_description_with_unit(self, desc: str, unit: str) -> str:
         """
@@ -171,7 +295,7 @@ class AllthedataBuilder:
     def _build_variables_section(self):
         var_section = {}
 
-        for idx, (name, meta) in enumerate(self.variables.items()):
+        for name, meta in self.variables.items():
             boundaries = meta.get("boundaries", [None, None])
             if boundaries == [None, None]:
                 boundaries = [0, np.inf]
@@ -180,9 +304,14 @@ class AllthedataBuilder:
             unit = meta.get("unit", "")
             full_desc = self._format_description_with_unit(desc, unit)
 
+            if self.data is None:
+                vals = []
+            else:
+                vals = self.data[name] if name in self.data else placeholder_column("nan", len(self.t_data))
+
             var_section[name] = {
                 "times": self.t_data,
-                "vals": [] if self.data is None else self.data[:, idx],
+                "vals": vals,
                 "std": [],
                 "initial_value": meta.get("initial_value", None),
                 "boundaries": boundaries,
@@ -201,21 +330,16 @@ class AllthedataBuilder:
                 "ilabname": None,
             }
 
-        n_states = len(self.variables)
-
-        for id, (name, meta) in enumerate(self.rates.items()):
-            id_total = n_states + id
+        for name, meta in self.rates.items():
             desc = meta.get("description", name)
             unit = meta.get("unit", "")
             full_desc = self._format_description_with_unit(desc, unit)
 
-            # ✅ Safe check for data availability
-            if self.data is not None and id_total < self.data.shape[1]:
-                vals = self.data[:, id_total]
+            # Measured rates (e.g. OCR from the off-gas) if the data has them, NaN otherwise
+            if self.data is not None and name in self.data:
+                vals = self.data[name]
             else:
-                vals = np.full_like(self.t_data, np.nan)
-                if self.data is not None:
-                    print(f"⚠️ Warning: '{name}' (rate) not found in data — filled with NaN.")
+                vals = placeholder_column("nan", len(self.t_data))
 
             var_section[name] = {
                 "times": self.t_data,
@@ -240,10 +364,11 @@ class AllthedataBuilder:
         return var_section
     def _build_inputs_section(self):
         inputs_section = {}
+        placeholder = placeholder_column("zeros", len(self.t)) if self.lazy else self.x[:, 0]
         if self.t_constant_feed is not None and "Induction" not in self.inputs:
             inputs_section["Constant Feed"] = {
                     "times": self.t_constant_feed,
-                    "vals": self.x[:,0],  # placeholder profile
+                    "vals": placeholder,  # placeholder profile
                     "type": None,
                     "description": 'Constant Feed',
                     "initial_value": None,
@@ -259,7 +384,7 @@ class AllthedataBuilder:
             if name == "Feed" and self.t_fedbatch is not None:
                 inputs_section[name] = {
                     "times": self.t_fedbatch,
-                    "vals": self.x[:,0],  # placeholder profile
+                    "vals": placeholder,  # placeholder profile
                     "type": None,
                     "description": meta.get("description", name),
                     "initial_value": None,
@@ -274,7 +399,7 @@ class AllthedataBuilder:
             elif name == "Induction" and self.t_constant_feed is not None:
                 inputs_section[name] = {
                     "times": self.t_constant_feed,
-                    "vals": np.zeros_like(self.t_constant_feed),  # placeholder profile
+                    "vals": placeholder_column("zeros", len(self.t_constant_feed)),  # placeholder profile
                     "type": None,
                     "description": meta.get("description", name),
                     "initial_value": None,
@@ -289,7 +414,7 @@ class AllthedataBuilder:
             elif name != "Feed":
                 inputs_section[name] = {
                     "times": self.t,  # could be replaced by specific feed times
-                    "vals": np.zeros_like(self.t),  # placeholder profile
+                    "vals": placeholder_column("zeros", len(self.t)),  # placeholder profile
                     "type": None,
                     "description": meta.get("description", name),
                     "initial_value": None,
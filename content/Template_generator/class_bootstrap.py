@@ -0,0 +1,221 @@
+import concurrent.futures
+import contextlib
+import io
+import os
+
+import numpy as np
+
+import class_estimation as cest
+import class_simulator as csim
+import class_spec as cspec
+
+
+# Number of bootstrap runs if nothing else is given
+DEFAULT_RUNS = 500
+
+# Bootstrap runs fitted by one task of a worker process
+RUNS_PER_TASK = 5
+
+
+class BootstrapResult:
+    def __init__(self, names, nominal, init_params, params, bounds, success):
+        """ Parameters of all bootstrap fits.
+
+        :param names: names of the parameters
+        :param nominal: parameters of the fit to the original data
+        :param init_params: start values of every bootstrap fit, shape (n_params, runs)
+        :param params: fitted parameters, the nominal fit first, then every bootstrap fit, shape (n_params, runs + 1)
+        :param bounds: bounds of the parameters, shape (n_params, 2)
+        :param success: True for every bootstrap fit that converged
+        """
+        self.names = list(names)
+        self.nominal = nominal
+        self.init_params = init_params
+        self.params = params
+        self.bounds = bounds
+        self.success = success
+
+    @property
+    def runs(self):
+        return self.init_params.shape[1]
+
+    def fill(self, allthedata):
+        """ Fills allthedata['statistics']['bootstrap'] in the layout cplt.PlotPlotly.plot_covariance(
+        cov_method='bootstrap') uses (normalized: relative position in the range of the parameter bounds). Returns
+        allthedata.
+
+        :raises ValueError: if less than 2 bootstrap fits converged (no covariance)
+        """
+        width = self.bounds[:, 1] - self.bounds[:, 0]
+        width = np.where(width > 0, width, 1.0)[:, None]
+        lower = self.bounds[:, [0]]
+        fits = self.params[:, 1:][:, self.success]
+        if fits.shape[1] < 2:
+            raise ValueError(f"Only {fits.shape[1]} of {self.runs} bootstrap fits converged, the statistics need at "
+                             f"least 2.")
+
+        cov_params = np.atleast_2d(np.cov(fits))
+        std_dev = np.sqrt(np.diag(cov_params))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            corr_params = np.nan_to_num(cov_params / np.outer(std_dev, std_dev))
+
+        statistics = allthedata.setdefault("statistics", {})
+        statistics["bootstrap"] = {
+            "runs": self.runs,
+            "params_names": self.names,
+            # plot_covariance reads the runs of one parameter as params[i] of shape (1, runs + 1)
+            "init_params": np.asmatrix(self.init_params),
+            "init_params (normalized)": np.asmatrix((self.init_params - lower) / width),
+            "params": np.asmatrix(self.params),
+            "params (normalized)": np.asmatrix((self.params - lower) / width),
+            "params_mean": fits.mean(axis=1)[:, None],
+            "params_mean (normalized)": ((fits.mean(axis=1)[:, None] - lower) / width),
+            "cov_params": cov_params,
+            "cov_params (normalized)": cov_params / (width * width.T),
+            "corr_params": corr_params,
+            "params_bounds": self.bounds,
+            "success": self.success,
+        }
+        return allthedata
+
+
+class _BootstrapRunner:
+    """ Fits bootstrap samples of the data with the model of a loaded notebook (in the parent or in a worker). """
+
+    def __init__(self, ns, names, bounds, data, jacobian, rtol, atol, jit):
+        x0 = [meta["initial_value"] for meta in ns["variables"].values()]
+        self.estimator = cest.ParameterEstimator(ns["dif_simple"], ns["feed"], x0, ns["t"][0], data, names, bounds,
+                                                 jacobian, rtol, atol, jit)
+
+    def run(self, seeds, p0):
+        """ Fits one bootstrap sample per seed (numpy.random.SeedSequence), returns (params, success) """
+        n_rows = len(self.estimator.rows)
+        params = np.empty((len(seeds), len(p0)))
+        success = np.empty(len(seeds), dtype=bool)
+        for i, seed in enumerate(seeds):
+            rows = np.random.default_rng(seed).integers(0, n_rows, n_rows)
+            result = self.estimator.fit(p0, np.bincount(rows, minlength=n_rows))
+            params[i], success[i] = result.values, result.success
+        return params, success
+
+
+# State of a worker process (set by _init_worker)
+_worker = {}
+
+
+def _init_worker(model, *args):
+    with contextlib.redirect_stdout(io.StringIO()):
+        ns = cspec.portable_namespace(model)
+    _worker["runner"] = _BootstrapRunner(ns, *args)
+
+
+def _run_task(start, seeds, p0):
+    return start, *_worker["runner"].run(seeds, p0)
+
+
+class Bootstrap:
+    def __init__(self, model_path, allthedata, parameters=None, bounds=None, workers=None, seed=None, jacobian=False,
+                 rtol=csim.DEFAULT_TOL, atol=csim.DEFAULT_TOL, jit=False):
+        """ Bootstrap of a parameter estimation: the measured time points in allthedata are drawn with replacement
+        and the parameters are fitted again for every sample (class_estimation.ParameterEstimator), the spread of
+        the fitted parameters estimates their uncertainty.
+
+        The fits of the samples run on a concurrent.futures.ProcessPoolExecutor, every worker builds the model
+        once (as in class_sweep, see class_spec.portable_model): from the saved notebook if model_path is a path,
+        from the current tables and equations of the kernel if it is the namespace of the running notebook. Every
+        sample has its own random stream (numpy.random.SeedSequence(seed).spawn), so the result for a seed does not
+        depend on the number of workers. All fits start at the fit to the original data.
+
+        :param model_path: model notebook or folder containing it (the saved notebook is used, not the state of a
+                           running kernel), or the namespace of the running notebook (globals())
+        :param allthedata: allthedata dict with the measured data (catd.AllthedataBuilder.build with data), the
+                           data is read with class_estimation.measured_data
+        :param parameters: names of the parameters to fit, defaults to class_sensitivity.estimable_parameters
+        :param bounds: bounds of the parameters, shape (n_params, 2), defaults to 'min'/'max' of the parameters
+                       table (see class_fisher.parameter_bounds)
+        :param workers: number of processes (default: number of cores), 1 fits everything in this process
+        :param seed: seed of the random streams
+        :param jacobian: True to fit with the Jacobian from the forward sensitivities (usually slower than the
+                         default finite differences, see ParameterEstimator)
+        :param rtol: relative tolerance of the solver
+        :param atol: absolute tolerance of the solver
+        :param jit: True to simulate with dif_simple compiled by numba (class_jit), compiled once per process
+        """
+        model = cspec.portable_model(model_path)
+        with contextlib.redirect_stdout(io.StringIO()):
+            # The same namespace as in the workers, so the result does not depend on the number of workers
+            ns = cspec.portable_namespace(model)
+        data = cest.measured_data(allthedata, list(ns["variables"]))
+        self.runner = _BootstrapRunner(ns, parameters, bounds, data, jacobian, rtol, atol, jit)
+        estimator = self.runner.estimator
+        self.names = estimator.names
+        self.values = estimator.values
+        self.bounds = estimator.bounds
+
+        self.model_path = model_path
+        self.workers = workers
+        self.seed = seed
+        self.init_args = (model, self.names, self.bounds, data, jacobian, rtol, atol, jit)
+        self.nominal = None
+
+    def fit_nominal(self):
+        """ Fits the parameters to the original data (start of all bootstrap fits) """
+        if self.nominal is None:
+            result = self.runner.estimator.fit(self.values)
+            self.nominal = result.values
+            if not result.success:
+                print("⚠️ Warning: the fit to the original data did not converge.")
+        return self.nominal
+
+    def run(self, runs=DEFAULT_RUNS, progress=None):
+        """ Fits runs bootstrap samples and returns a BootstrapResult.
+
+        :param runs: number of bootstrap samples
+        :param progress: called as progress(done, total) every time a task is finished
+        """
+        p0 = self.fit_nominal()
+        seeds = np.random.SeedSequence(self.seed).spawn(runs)
+        tasks = [(start, seeds[start:start + RUNS_PER_TASK]) for start in range(0, runs, RUNS_PER_TASK)]
+        params = np.empty((runs, len(self.names)))
+        success = np.empty(runs, dtype=bool)
+
+        workers = self.workers or os.cpu_count() or 1
+        done = 0
+        if workers > 1 and len(tasks) > 1:
+            try:
+                with concurrent.futures.ProcessPoolExecutor(min(workers, len(tasks)), initializer=_init_worker,
+                                                            initargs=self.init_args) as executor:
+                    futures = [executor.submit(_run_task, start, task_seeds, p0) for start, task_seeds in tasks]
+                    for future in concurrent.futures.as_completed(futures):
+                        start, task_params, task_success = future.result()
+                        params[start:start + len(task_params)] = task_params
+                        success[start:start + len(task_params)] = task_success
+                        done += len(task_params)
+                        if progress is not None:
+                            progress(done, runs)
+                tasks = []
+            except (OSError, NotImplementedError) as error:  # no processes (e.g. in the browser)
+                print(f"⚠️ Warning: could not start worker processes ({error}), the bootstrap runs in this process.")
+                done = 0
+
+        for start, task_seeds in tasks:
+            params[start:start + len(task_seeds)], success[start:start + len(task_seeds)] = \
+                self.runner.run(task_seeds, p0)
+            done += len(task_seeds)
+            if progress is not None:
+                progress(done, runs)
+
+        if not np.all(success):
+            print(f"⚠️ Warning: {np.sum(~success)} of {runs} bootstrap fits did not converge (left out of the "
+                  f"statistics).")
+        return BootstrapResult(self.names, p0, np.tile(p0[:, None], (1, runs)),
+                               np.column_stack((p0, params.T)), self.bounds, success)
+
+
+def run_bootstrap(model_path, allthedata, runs=DEFAULT_RUNS, progress=None, **options):
+    """ Shortcut for Bootstrap(model_path, allthedata, **options).run(runs, progress), fills
+    allthedata['statistics']['bootstrap'] and returns the BootstrapResult.
+    """
+    result = Bootstrap(model_path, allthedata, **options).run(runs, progress)
+    result.fill(allthedata)
+    return result
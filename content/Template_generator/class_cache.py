@@ -0,0 +1,194 @@
+import dataclasses
+import hashlib
+import json
+import os
+
+import numpy as np
+
+import class_compiler as ccm
+import class_simulator as csim
+
+
+# Folder of the cache (relative to the notebook) and its size limit, the least recently used results are deleted
+CACHE_DIR = ".simulation_cache"
+MAX_BYTES = 512 * 1024 ** 2
+
+# Version of the stored format, part of every key so that older files are never read
+CACHE_VERSION = 1
+
+
+def _canonical(value):
+    """ JSON fallback for the values in the tables (numpy arrays/numbers, inf, functions, ...) """
+    if isinstance(value, np.ndarray):
+        return {"__array__": value.tolist()}
+    if isinstance(value, np.generic):
+        return value.item()
+    return repr(value)
+
+
+def fingerprint(model, schedule, x0, t, rates, **options):
+    """ Key of a simulation: sha256 of everything its x_and_rs depends on.
+
+    That is the compiled code of dif_simple/algebra (with algebra inlined), the bound values, the variables,
+    inputs, constants and parameters dicts, the feed configuration, x0, the time grid, the rate names and the
+    options of the simulator (tolerances, method, ...). Any change of one of them gives another key.
+
+    :param model: class_compiler.CompiledModel
+    :param schedule: cfb.FeedSchedule
+    """
+    digest = hashlib.sha256()
+    digest.update(json.dumps({
+        "version": CACHE_VERSION,
+        "source": model.source,
+        "tables": model.tables,
+        "feed": dataclasses.asdict(schedule),
+        "rates": list(rates),
+        "options": options,
+    }, sort_keys=True, default=_canonical).encode())
+    for array in (model.values, x0, t):
+        digest.update(np.ascontiguousarray(array, dtype=float).tobytes())
+    return digest.hexdigest()
+
+
+class CachedSimulationResult(csim.SimulationResult):
+    """ SimulationResult loaded from the cache, x_and_rs returns the stored (memory-mapped) array """
+
+    def __init__(self, x_and_rs, rates, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cached_x_and_rs = x_and_rs
+        self.cached_rates = list(rates)
+
+    def x_and_rs(self, rates, out=None):
+        if list(rates) != self.cached_rates:
+            return super().x_and_rs(rates, out)
+        if out is None:
+            return self.cached_x_and_rs
+        out[...] = self.cached_x_and_rs
+        return out
+
+
+class SimulationCache:
+    def __init__(self, directory=CACHE_DIR, max_bytes=MAX_BYTES):
+        """ Content-addressed cache of simulations on disk: x_and_rs as <key>.npy and the phases as <key>.json.
+
+        A hit is returned memory-mapped (read-only), nothing is integrated. Changing the model, a table, the feed,
+        x0 or t changes the key (see fingerprint), so old results are never returned. When the files exceed
+        max_bytes the least recently used results are deleted.
+
+        :param directory: folder of the cache files (created if needed)
+        :param max_bytes: size limit of all cache files
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def _paths(self, key):
+        return os.path.join(self.directory, f"{key}.npy"), os.path.join(self.directory, f"{key}.json")
+
+    def load(self, key):
+        """ (x_and_rs memory-mapped, metadata dict) of a key, None if it is not cached """
+        array_path, meta_path = self._paths(key)
+        try:
+            with open(meta_path) as file:
+                meta = json.load(file)
+            x_and_rs = np.load(array_path, mmap_mode="r")
+        except (OSError, ValueError):
+            return None
+        os.utime(array_path)  # most recently used
+        return x_and_rs, meta
+
+    def store(self, key, x_and_rs, meta):
+        """ Writes a result (each file is written to a temporary file first, so a crash leaves no broken entry) """
+        os.makedirs(self.directory, exist_ok=True)
+        array_path, meta_path = self._paths(key)
+        with open(array_path + ".tmp", "wb") as file:
+            np.save(file, np.asarray(x_and_rs))
+        with open(meta_path + ".tmp", "w") as file:
+            json.dump(meta, file)
+        os.replace(meta_path + ".tmp", meta_path)
+        os.replace(array_path + ".tmp", array_path)
+        self.evict(keep=key)
+
+    def entries(self):
+        """ [(last use, size in bytes, key)] of all cached results """
+        entries = []
+        for name in os.listdir(self.directory) if os.path.isdir(self.directory) else []:
+            if name.endswith(".npy"):
+                key = name[:-len(".npy")]
+                paths = self._paths(key)
+                try:
+                    entries.append((os.path.getmtime(paths[0]), sum(os.path.getsize(p) for p in paths), key))
+                except OSError:
+                    continue
+        return entries
+
+    def evict(self, keep=None):
+        """ Deletes the least recently used results until the cache is below max_bytes (never the key keep) """
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            for path in self._paths(key):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total -= size
+
+    def clear(self):
+        for _, _, key in self.entries():
+            for path in self._paths(key):
+                os.remove(path)
+
+    def simulate(self, model, feed, x0, t, rates, **options):
+        """ Same as csim.simulate(model, feed, x0, t, **options) followed by x_and_rs(rates), but the result is
+        taken from the cache if the same simulation was done before. Returns a CachedSimulationResult
+        (simulation.x_and_rs(rates) returns the cached array).
+
+        :param rates: rates dict of the notebook (or a list of rate names), the order of the columns
+        :param options: options of csim.FedBatchSimulator
+        """
+        compiled = ccm.compiled(model)
+        if compiled is None:
+            raise ValueError("The model can not be compiled, the cache needs the source code of dif_simple.")
+        verbose = options.pop("verbose", True)
+        simulator = csim.FedBatchSimulator(compiled, feed, verbose=verbose, **options)
+        t = np.asarray(t, dtype=float)
+        names = list(rates)
+        key = fingerprint(simulator.model, simulator.schedule, x0, t, names, feed_name=simulator.feed_name,
+                          substrate=simulator.substrate, biomass=simulator.biomass, rtol=simulator.rtol,
+                          atol=simulator.atol, method=simulator.method, jacobian=simulator.jacobian is not None)
+
+        entry = self.load(key)
+        if entry is None:
+            self.misses += 1
+            simulation = simulator.run(x0, t)
+            x_and_rs = simulation.x_and_rs(names)
+            meta = dict(phases=simulation.phases, ts=simulation.ts, X_fedbatch_start=simulation.X_fedbatch_start,
+                        mode=simulation.mode, stats=simulation.stats, n_states=simulation.x.shape[1])
+            self.store(key, x_and_rs, meta)
+            entry = self.load(key) or (x_and_rs, meta)
+        else:
+            self.hits += 1
+            meta = entry[1]
+            if verbose:
+                print("Simulation loaded from the cache.")
+                if meta["ts"] is not None:
+                    print(f"Feeding started at time: {meta['ts']:.3f}")
+                    print(f"Feeding started at Biomass: {meta['X_fedbatch_start']:.6f}")
+            if hasattr(feed, "set_phase"):
+                feed.set_phase(meta["phases"][-1]["phase"], meta["ts"], meta["X_fedbatch_start"])
+
+        x_and_rs, meta = entry
+        return CachedSimulationResult(x_and_rs, names, t, x_and_rs[:, :meta["n_states"]], meta["phases"], meta["ts"],
+                                      meta["X_fedbatch_start"], meta["mode"], simulator.model, simulator.schedule,
+                                      simulator.feed_name, meta["stats"])
+
+
+def simulate_cached(model, feed, x0, t, rates, cache_dir=CACHE_DIR, max_bytes=MAX_BYTES, **options):
+    """ Shortcut for SimulationCache(cache_dir, max_bytes).simulate(model, feed, x0, t, rates, **options) """
+    return SimulationCache(cache_dir, max_bytes).simulate(model, feed, x0, t, rates, **options)
@@ -0,0 +1,727 @@
+import ast
+import copy
+import inspect
+import itertools
+import marshal
+import math
+import textwrap
+import types
+
+import numpy as np
+from scipy.integrate import odeint as _scipy_odeint
+
+
+# Dict tables whose entries are read inside dif_simple/algebra. Every access of the form
+# table['name']['field'] (e.g. constants['K_s']['value']) is bound once at compile time.
+BINDABLE_TABLES = ("constants", "parameters", "inputs", "variables")
+
+FACTORY_NAME = "_model_factory"
+BOUND_VECTOR = "_bound"
+ENV_DICT = "_env"
+VECTORIZED_SUFFIX = "_vectorized"
+
+# Attributes of a CompiledModel that are the result of the compilation (see compiled_state)
+COMPILED_ATTRIBUTES = ("rhs_name", "algebra_name", "state_names", "calls", "bindings", "inlined", "_defs", "_returns")
+
+# Scalar functions of the math module (from math import exp) and builtins with a numpy counterpart
+NUMPY_EQUIVALENTS = {
+    "exp": "exp", "log": "log", "log10": "log10", "log2": "log2", "sqrt": "sqrt", "sin": "sin", "cos": "cos",
+    "tan": "tan", "tanh": "tanh", "sinh": "sinh", "cosh": "cosh", "atan": "arctan", "floor": "floor",
+    "ceil": "ceil", "fabs": "abs", "pow": "power", "abs": "abs",
+}
+
+
+class CompiledModel:
+    def __init__(self, dif_simple, algebra=None, constants=None, parameters=None, inputs=None, variables=None,
+                 namespace=None, env=None):
+        """ Compiles the generated model functions into a single closure with all table lookups bound as locals.
+
+        The functions are parsed from their source, every constants[...]['value'] (parameters, inputs, variables
+        alike) is replaced by a local variable of an enclosing factory function and the call to algebra inside
+        dif_simple is inlined, so that no dict is built or read during a RHS call.
+
+        :param dif_simple: function (or its source code) with the signature dif_simple(x, t)
+        :param algebra: function (or its source code) with the signature algebra(x, t), optional
+        :param constants: constants dict of the model (defaults to the one in the namespace of dif_simple)
+        :param parameters: parameters dict of the model (defaults to the one in the namespace of dif_simple)
+        :param inputs: inputs dict of the model (defaults to the one in the namespace of dif_simple)
+        :param variables: variables dict of the model (defaults to the one in the namespace of dif_simple)
+        :param namespace: globals used by the compiled functions (feed, exp, np, ...), defaults to the globals of
+                          dif_simple (i.e. the notebook)
+        :param env: globals that are fixed for the compiled model instead of being looked up in the namespace on
+                    every call, e.g. env={"feed": locked_feed} (see bind)
+        """
+        if namespace is None:
+            namespace = getattr(dif_simple, "__globals__", None)
+            if namespace is None:
+                raise ValueError("A namespace must be given if dif_simple is passed as source code.")
+        self.namespace = namespace
+        self.env = dict(env or {})
+
+        if algebra is None and callable(dif_simple) and callable(namespace.get("algebra")):
+            algebra = namespace["algebra"]
+
+        self.tables = {}
+        for name, table in zip(BINDABLE_TABLES, (constants, parameters, inputs, variables)):
+            self.tables[name] = namespace.get(name, {}) if table is None else table
+
+        dif_def = _parse_function(dif_simple)
+        alg_def = _parse_function(algebra) if algebra is not None else None
+        self.functions = (dif_simple, algebra)
+        self.rhs_name = dif_def.name
+        self.algebra_name = alg_def.name if alg_def is not None else None
+
+        # What the simulator needs to know about the original code: x[i] reads and e.g. feed.get(t, S, X)
+        self.state_names = _state_reads(dif_def)
+        self.calls = _method_calls(dif_def)
+
+        # feed.feeding_first at the feed start, also for a locked feed (which has no time), feed.get only for the
+        # notebook Feed
+        feeds = {**namespace, **self.env}
+        dif_def = _FeedGet(feeds).visit(_FeedingFirst(feeds).visit(dif_def))
+        if alg_def is not None:
+            alg_def = _FeedGet(feeds).visit(_FeedingFirst(feeds).visit(alg_def))
+
+        # Bind the table lookups (same binding list for both functions)
+        binder = _TableBinder(BINDABLE_TABLES)
+        dif_def = binder.visit(dif_def)
+        if alg_def is not None:
+            alg_def = binder.visit(alg_def)
+        self.bindings = binder.bindings
+
+        # algebra for a whole trajectory at once (None if the code can not be vectorized)
+        vec_def = _vectorize(alg_def, namespace) if alg_def is not None else None
+
+        # Inline algebra into dif_simple (only if the code follows the generated pattern)
+        self.inlined = False
+        if alg_def is not None:
+            inlined_def = _inline_algebra(dif_def, alg_def)
+            if inlined_def is not None:
+                dif_def = inlined_def
+                self.inlined = True
+
+        functions = [dif_def] if alg_def is None else [alg_def, dif_def]
+        self._defs = [_simplify(func_def) for func_def in functions]
+        self._returns = [self.rhs_name, self.algebra_name if alg_def is not None else None, None]
+        if vec_def is not None:
+            self._defs.append(vec_def)
+            self._returns[2] = vec_def.name
+        self._factories = {}  # compiled factories by bound env names, shared by all copies of the model
+        self._finish()
+
+    def _finish(self):
+        self._use_env(self.env)
+        self.names = [f"{table}.{key}.{field}" for table, key, field in self.bindings]
+        self.index = {}
+        for i, (table, key, field) in enumerate(self.bindings):
+            self.index[self.names[i]] = i
+            if table in ("constants", "parameters") and field == "value":
+                self.index.setdefault(key, i)
+
+        self.values = self.read_values()
+        self.rhs, self.algebra, self.algebra_vectorized = self._factory(self.values, self.env)
+
+    # -----------------------------
+    # Cache of the compilation
+    # -----------------------------
+    def compiled_state(self):
+        """ Everything the compilation produced as picklable dict (transformed functions, bindings and the bytecode
+        of the factories), no values and no namespace. from_compiled_state rebuilds the model from it without
+        parsing or transforming any code again.
+        """
+        state = {name: getattr(self, name) for name in COMPILED_ATTRIBUTES}
+        state["factories"] = {names: (source, marshal.dumps(factory.__code__))
+                              for names, (source, factory) in self._factories.items()}
+        return state
+
+    @classmethod
+    def from_compiled_state(cls, state, functions, namespace, env=None):
+        """ CompiledModel from compiled_state() of the same code (only valid for the same Python version).
+
+        :param functions: (dif_simple, algebra) of the namespace, algebra can be None
+        :param namespace: globals of the functions, the tables (constants, ...) are read from it
+        :param env: bound globals as for the constructor
+        """
+        model = cls.__new__(cls)
+        model.namespace = namespace
+        model.env = dict(env or {})
+        model.tables = {name: namespace.get(name, {}) for name in BINDABLE_TABLES}
+        model.functions = tuple(functions)
+        for name in COMPILED_ATTRIBUTES:
+            setattr(model, name, state[name])
+        model._factories = {names: (source, types.FunctionType(marshal.loads(code), namespace, FACTORY_NAME))
+                            for names, (source, code) in state["factories"].items()}
+        model._finish()
+        # Like compiled(), so that compiled(dif_simple) finds the model
+        _compiled_cache.clear()
+        _compiled_cache[model.functions[0]] = model
+        return model
+
+    # -----------------------------
+    # Bound values
+    # -----------------------------
+    def read_values(self):
+        """ Reads the current values of all bound table entries (e.g. after constants were changed). """
+        return tuple(self.tables[table][key][field] for table, key, field in self.bindings)
+
+    def vector(self):
+        """ Returns the bound values as a flat float64 vector (same order as self.names). """
+        return np.asarray(self.values, dtype=float)
+
+    def with_values(self, values=None, **overrides):
+        """ Returns a copy of the model with new bound values. The source is not compiled again.
+
+        :param values: flat vector/sequence with all values (order of self.names), defaults to the current values
+        :param overrides: single values by name, e.g. K_s=0.1 or **{"inputs.Feed.concentration": 300}
+        """
+        new_values = list(self.values if values is None else values)
+        for name, value in overrides.items():
+            if name not in self.index:
+                raise KeyError(f"'{name}' is not used by the model. Available: {self.names}")
+            new_values[self.index[name]] = value
+
+        model = copy.copy(self)
+        model.values = tuple(new_values)
+        model.rhs, model.algebra, model.algebra_vectorized = self._factory(model.values, model.env)
+        return model
+
+    def bind(self, **env):
+        """ Returns a copy of the model in which the given globals are fixed values, e.g. bind(feed=locked_feed).
+
+        The factory is compiled once per set of bound names, binding other values to the same names is cheap.
+        """
+        model = copy.copy(self)
+        model._use_env({**self.env, **env})
+        model.rhs, model.algebra, model.algebra_vectorized = model._factory(model.values, model.env)
+        return model
+
+    def _use_env(self, env):
+        names = tuple(sorted(env))
+        if names not in self._factories:
+            source = _build_factory_source(self._defs, self._returns, len(self.bindings), names)
+            self._factories[names] = (source, _make_factory(source, self.namespace, self.rhs_name))
+        self.env = env
+        self.source, self._factory = self._factories[names]
+
+    def state_index(self, name):
+        """ Position of a state in x (e.g. 'S' for S = x[1]), None if dif_simple does not read it like that. """
+        return self.state_names.get(name)
+
+    def refresh(self):
+        """ Re-reads all values from the tables and rebinds them (call after changing e.g. constants). """
+        return self.with_values(self.read_values())
+
+    # -----------------------------
+    # Integration
+    # -----------------------------
+    def __call__(self, x, t):
+        return self.rhs(x, t)
+
+    def odeint(self, y0, t, *args, **kwargs):
+        """ Same as scipy.integrate.odeint(dif_simple, y0, t, ...) but with the compiled RHS. """
+        return _scipy_odeint(self.rhs, y0, t, *args, **kwargs)
+
+
+# -----------------------------
+# Public helpers
+# -----------------------------
+def compile_model(dif_simple, algebra=None, constants=None, parameters=None, inputs=None, variables=None,
+                  namespace=None):
+    """ Shortcut for CompiledModel(...), see there. """
+    return CompiledModel(dif_simple, algebra, constants=constants, parameters=parameters, inputs=inputs,
+                         variables=variables, namespace=namespace)
+
+
+_compiled_cache = {}
+
+
+def compiled(func):
+    """ Returns the CompiledModel of a generated model function (e.g. dif_simple), None if it can not be compiled.
+
+    The model is compiled once and kept: it is compiled again if the function (or algebra) is redefined and gets
+    new bound values if a table entry (constants, ...) changed since the last call.
+    """
+    if isinstance(func, CompiledModel):
+        return func
+
+    model = _compiled_cache.get(func)
+    if model is not None and model.algebra_name and model.namespace.get(model.algebra_name) is not model.functions[1]:
+        model = None  # algebra was redefined
+    if model is None:
+        try:
+            model = CompiledModel(func)
+        except (OSError, TypeError, ValueError, KeyError, SyntaxError):
+            return None
+        _compiled_cache.clear()  # keep only the latest model (functions are redefined on every cell run)
+        _compiled_cache[func] = model
+    else:
+        values = model.read_values()
+        if values != model.values:
+            model = model.with_values(values)
+            _compiled_cache[func] = model
+    return model
+
+
+def odeint(func, y0, t, *args, **kwargs):
+    """ Drop-in replacement for scipy.integrate.odeint.
+
+    If func is a generated model function (e.g. dif_simple) the compiled RHS is used (see compiled).
+    Anything that can not be compiled is passed to scipy unchanged.
+    """
+    model = compiled(func)
+    return _scipy_odeint(func if model is None else model.rhs, y0, t, *args, **kwargs)
+
+
+# -----------------------------
+# Source transformation
+# -----------------------------
+def _state_reads(func_def):
+    """ {name: i} for all top level assignments name = x[i] of the state vector (first argument). """
+    if not func_def.args.args:
+        return {}
+    state = func_def.args.args[0].arg
+    reads = {}
+    for stmt in func_def.body:
+        if (isinstance(stmt, ast.Assign) and len(stmt.targets) == 1 and isinstance(stmt.targets[0], ast.Name)
+                and isinstance(stmt.value, ast.Subscript) and isinstance(stmt.value.value, ast.Name)
+                and stmt.value.value.id == state and isinstance(stmt.value.slice, ast.Constant)
+                and isinstance(stmt.value.slice.value, int)):
+            reads.setdefault(stmt.targets[0].id, stmt.value.slice.value)
+    return reads
+
+
+def _method_calls(func_def):
+    """ {'obj.method': [argument source, ...]} for the first call of every obj.method(...) in the function. """
+    calls = {}
+    for node in ast.walk(func_def):
+        if (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute)
+                and isinstance(node.func.value, ast.Name)):
+            calls.setdefault(f"{node.func.value.id}.{node.func.attr}", [ast.unparse(arg) for arg in node.args])
+    return calls
+
+
+def _parse_function(func):
+    source = func if isinstance(func, str) else inspect.getsource(func)
+    module = ast.parse(textwrap.dedent(source))
+    defs = [node for node in module.body if isinstance(node, ast.FunctionDef)]
+    if len(defs) != 1:
+        raise ValueError("The model source must contain exactly one function definition.")
+    func_def = defs[0]
+    func_def.decorator_list = []
+    return func_def
+
+
+class _TableBinder(ast.NodeTransformer):
+    """ Replaces table['key']['field'] reads by the local name _bound_<i>. """
+
+    def __init__(self, tables):
+        self.tables = tables
+        self.bindings = []
+
+    def visit_Subscript(self, node):
+        self.generic_visit(node)
+        inner = node.value
+        if (isinstance(node.ctx, ast.Load)
+                and isinstance(inner, ast.Subscript)
+                and isinstance(inner.value, ast.Name) and inner.value.id in self.tables
+                and _is_str(inner.slice) and _is_str(node.slice)):
+            binding = (inner.value.id, inner.slice.value, node.slice.value)
+            if binding not in self.bindings:
+                self.bindings.append(binding)
+            return ast.copy_location(ast.Name(id=f"{BOUND_VECTOR}_{self.bindings.index(binding)}", ctx=ast.Load()),
+                                     node)
+        return node
+
+
+class _FeedingFirst(ast.NodeTransformer):
+    """ Replaces feed.feeding_first by (feed.feeding_first | feed.feeding_exp & (t == feed.ts)). A locked feed
+    (cfb.FeedState) is the same for every call of a phase and does not know t, so the call at the feed start
+    (t == feed.ts in the fedbatch phase) is recognized by its time. The notebook Feed sets feeding_first itself.
+    """
+
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self.t_name = None
+
+    def visit_FunctionDef(self, node):
+        if len(node.args.args) < 2:
+            return node
+        self.t_name = node.args.args[1].arg
+        self.generic_visit(node)
+        return node
+
+    def visit_Attribute(self, node):
+        if (node.attr == "feeding_first" and isinstance(node.ctx, ast.Load) and isinstance(node.value, ast.Name)
+                and hasattr(self.namespace.get(node.value.id), "feeding_exp")):
+            feed = node.value.id
+            expression = ast.parse(f"({feed}.feeding_first | {feed}.feeding_exp & ({self.t_name} == {feed}.ts))",
+                                   mode="eval").body
+            return ast.copy_location(expression, node)
+        return self.generic_visit(node)
+
+
+class _FeedGet(ast.NodeTransformer):
+    """ Calls feed.get(t, S, X) only for a feed that changes with it (cfb.Feed): if feed.stateful: feed.get(...).
+    A locked feed (cfb.FeedState) already is in its phase.
+    """
+
+    def __init__(self, namespace):
+        self.namespace = namespace
+
+    def visit_Expr(self, node):
+        func = node.value.func if isinstance(node.value, ast.Call) else None
+        if (isinstance(func, ast.Attribute) and func.attr == "get" and isinstance(func.value, ast.Name)
+                and hasattr(self.namespace.get(func.value.id), "feeding_exp")):
+            test = ast.Attribute(ast.Name(func.value.id, ast.Load()), "stateful", ast.Load())
+            return ast.copy_location(ast.If(test=test, body=[node], orelse=[]), node)
+        return node
+
+
+class _Renamer(ast.NodeTransformer):
+    def __init__(self, mapping):
+        self.mapping = mapping
+
+    def visit_Name(self, node):
+        if node.id in self.mapping:
+            return ast.copy_location(ast.Name(id=self.mapping[node.id], ctx=node.ctx), node)
+        return node
+
+
+class _ResultInliner(ast.NodeTransformer):
+    """ Replaces rs['key'] by the expression algebra returned for 'key'. """
+
+    def __init__(self, result_name, results):
+        self.result_name = result_name
+        self.results = results
+
+    def visit_Subscript(self, node):
+        self.generic_visit(node)
+        if (isinstance(node.ctx, ast.Load) and isinstance(node.value, ast.Name)
+                and node.value.id == self.result_name and _is_str(node.slice) and node.slice.value in self.results):
+            return ast.copy_location(copy.deepcopy(self.results[node.slice.value]), node)
+        return node
+
+
+def _is_str(node):
+    return isinstance(node, ast.Constant) and isinstance(node.value, str)
+
+
+def _assigned_names(func_def):
+    names = {arg.arg for arg in func_def.args.args}
+    for node in ast.walk(func_def):
+        if isinstance(node, ast.Name) and isinstance(node.ctx, (ast.Store, ast.Del)):
+            names.add(node.id)
+    return names
+
+
+def _inline_algebra(dif_def, alg_def):
+    """ Inlines `rs = algebra(x, t)` into dif_simple. Returns None if the code does not follow that pattern. """
+    body = alg_def.body
+    returns = [node for node in ast.walk(alg_def) if isinstance(node, ast.Return)]
+    if (not body or not isinstance(body[-1], ast.Return) or len(returns) != 1
+            or not isinstance(body[-1].value, ast.Dict)
+            or not all(_is_str(key) for key in body[-1].value.keys)):
+        return None
+
+    # Find the (single) top level call rs = algebra(x, t)
+    call_index = None
+    for i, stmt in enumerate(dif_def.body):
+        if (isinstance(stmt, ast.Assign) and len(stmt.targets) == 1 and isinstance(stmt.targets[0], ast.Name)
+                and isinstance(stmt.value, ast.Call) and isinstance(stmt.value.func, ast.Name)
+                and stmt.value.func.id == alg_def.name and not stmt.value.keywords
+                and len(stmt.value.args) == len(alg_def.args.args)
+                and all(isinstance(arg, ast.Name) for arg in stmt.value.args)):
+            if call_index is not None:
+                return None
+            call_index = i
+    if call_index is None:
+        return None
+
+    call = dif_def.body[call_index]
+    result_name = call.targets[0].id
+
+    # Rename all locals of algebra, its arguments become the names passed by dif_simple
+    mapping = {name: f"_{alg_def.name}_{name}" for name in _assigned_names(alg_def)}
+    for arg, passed in zip(alg_def.args.args, call.value.args):
+        mapping[arg.arg] = passed.id
+    renamed = _Renamer(mapping).visit(copy.deepcopy(alg_def))
+    statements = [stmt for stmt in renamed.body[:-1]
+                  if not (isinstance(stmt, ast.Expr) and isinstance(stmt.value, ast.Constant))]
+    result_dict = renamed.body[-1].value
+    results = {key.value: value for key, value in zip(result_dict.keys, result_dict.values)}
+
+    new_def = copy.deepcopy(dif_def)
+    rest = [_ResultInliner(result_name, results).visit(stmt) for stmt in new_def.body[call_index + 1:]]
+
+    # Keep the dict only if dif_simple still uses it in another way than rs['key']
+    still_used = any(isinstance(node, ast.Name) and node.id == result_name
+                     for stmt in rest for node in ast.walk(stmt))
+    if still_used:
+        statements.append(ast.Assign(targets=[ast.Name(id=result_name, ctx=ast.Store())], value=result_dict,
+                                     lineno=call.lineno))
+
+    new_def.body = new_def.body[:call_index] + statements + rest
+    return new_def
+
+
+def _simplify(func_def):
+    """ Removes what costs time on every call but does nothing: docstring-like strings, `if ...: pass` blocks,
+    plain copies (K_s = _bound_3, q_s = rs['q_s']) and repeated state reads (X = x[0] in both functions).
+    If the state vector is only read by index it is converted to a list first (float math on a list is several
+    times faster than on numpy scalars).
+    """
+    func_def = copy.deepcopy(func_def)
+    func_def.body = _drop_noops(func_def.body)
+    args = [arg.arg for arg in func_def.args.args]
+
+    store_counts = {}
+    for node in ast.walk(func_def):
+        if isinstance(node, ast.Name) and isinstance(node.ctx, (ast.Store, ast.Del)):
+            store_counts[node.id] = store_counts.get(node.id, 0) + 1
+        elif isinstance(node, ast.AugAssign) and isinstance(node.target, ast.Name):
+            store_counts[node.target.id] = store_counts.get(node.target.id, 0) + 1
+
+    # Names that keep one value during the whole call (never reassigned)
+    stable = {arg for arg in args if arg not in store_counts}
+    aliases = {}
+    known_exprs = {}
+    body = []
+    for stmt in func_def.body:
+        stmt = _Renamer(aliases).visit(stmt)
+        if (isinstance(stmt, ast.Assign) and len(stmt.targets) == 1 and isinstance(stmt.targets[0], ast.Name)
+                and store_counts.get(stmt.targets[0].id) == 1):
+            target = stmt.targets[0].id
+            value = stmt.value
+            if isinstance(value, ast.Name) and (value.id in stable or value.id.startswith(BOUND_VECTOR)):
+                aliases[target] = value.id
+                continue
+            if (isinstance(value, ast.Subscript) and isinstance(value.value, ast.Name)
+                    and value.value.id in stable and isinstance(value.slice, ast.Constant)):
+                key = ast.dump(value)
+                if key in known_exprs:
+                    aliases[target] = known_exprs[key]
+                    continue
+                known_exprs[key] = target
+            stable.add(target)
+        body.append(stmt)
+    func_def.body = body
+
+    # Index only access of the state vector -> work on a list
+    if args:
+        state = args[0]
+        uses = [node for node in ast.walk(func_def) if isinstance(node, ast.Name) and node.id == state]
+        indexed = [node for node in ast.walk(func_def)
+                   if isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name)
+                   and node.value.id == state and isinstance(node.ctx, ast.Load)
+                   and isinstance(node.slice, ast.Constant) and isinstance(node.slice.value, int)]
+        if uses and len(uses) == len(indexed) and state not in store_counts:
+            func_def.body.insert(0, ast.parse(f"if {state}.__class__ is _ndarray: {state} = {state}.tolist()").body[0])
+    return func_def
+
+
+class _Unsupported(Exception):
+    pass
+
+
+class _ArrayExpressions(ast.NodeTransformer):
+    """ Rewrites scalar expressions for arrays: min/max/exp/... -> numpy, `a if c else b` -> where,
+    and/or/not and chained comparisons -> logical_and/logical_or/logical_not. """
+
+    def __init__(self, namespace):
+        self.namespace = namespace
+
+    def _numpy_name(self, func):
+        if isinstance(func, ast.Name):
+            if func.id in ("min", "max", "abs"):
+                # builtins, unless the notebook defines its own
+                return None if func.id in self.namespace else {"min": "minimum", "max": "maximum"}.get(func.id, "abs")
+            if func.id in NUMPY_EQUIVALENTS and self.namespace.get(func.id) is getattr(math, func.id, None):
+                return NUMPY_EQUIVALENTS[func.id]
+            return None
+        if (isinstance(func, ast.Attribute) and isinstance(func.value, ast.Name)
+                and self.namespace.get(func.value.id) is math and func.attr in NUMPY_EQUIVALENTS):
+            return NUMPY_EQUIVALENTS[func.attr]
+        return None
+
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        name = self._numpy_name(node.func)
+        if name is None:
+            return node
+        if node.keywords:
+            raise _Unsupported("keyword arguments")
+        if name in ("minimum", "maximum"):
+            if len(node.args) < 2:
+                raise _Unsupported("min/max of an iterable")
+            result = node.args[0]
+            for arg in node.args[1:]:
+                result = _np_call(name, result, arg)
+            return ast.copy_location(result, node)
+        return ast.copy_location(_np_call(name, *node.args), node)
+
+    def visit_IfExp(self, node):
+        self.generic_visit(node)
+        return ast.copy_location(_np_call("where", node.test, node.body, node.orelse), node)
+
+    def visit_BoolOp(self, node):
+        self.generic_visit(node)
+        name = "logical_and" if isinstance(node.op, ast.And) else "logical_or"
+        result = node.values[0]
+        for value in node.values[1:]:
+            result = _np_call(name, result, value)
+        return ast.copy_location(result, node)
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.op, ast.Not):
+            return ast.copy_location(_np_call("logical_not", node.operand), node)
+        return node
+
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        if len(node.ops) == 1:
+            return node
+        pairs = []
+        left = node.left
+        for op, right in zip(node.ops, node.comparators):
+            pairs.append(ast.Compare(left=left, ops=[op], comparators=[right]))
+            left = right
+        result = pairs[0]
+        for pair in pairs[1:]:
+            result = _np_call("logical_and", result, pair)
+        return ast.copy_location(result, node)
+
+    def visit_Lambda(self, node):
+        raise _Unsupported("lambda")
+
+
+def _is_noop(stmt):
+    return isinstance(stmt, ast.Pass) or (isinstance(stmt, ast.Expr) and isinstance(stmt.value, ast.Constant))
+
+
+def _np_call(name, *args):
+    return ast.Call(func=ast.Attribute(value=ast.Name(id="_np", ctx=ast.Load()), attr=name, ctx=ast.Load()),
+                    args=list(args), keywords=[])
+
+
+def _vectorize(alg_def, namespace):
+    """ Returns a version of algebra(x, t) that works on a whole trajectory: x with shape (n_states, n_points) and
+    t with shape (n_points,). Every `if` is replaced by masks (np.where), so both branches are calculated for all
+    points and each name keeps the value of the branch that applies to the point. Names that are only set in one
+    branch are NaN where the other branch applies. Returns None if the code uses something that can not be
+    rewritten like this (loops, return inside of an if, ...).
+    """
+    body = alg_def.body
+    if not body or not isinstance(body[-1], ast.Return) or not isinstance(body[-1].value, ast.Dict):
+        return None
+    expressions = _ArrayExpressions(namespace)
+    defined = {arg.arg for arg in alg_def.args.args}
+    mask_numbers = itertools.count(1)
+
+    def convert(expr):
+        return expressions.visit(copy.deepcopy(expr))
+
+    def assign(name, value, mask):
+        if mask is not None:
+            previous = ast.Name(id=name, ctx=ast.Load()) if name in defined else ast.Attribute(
+                value=ast.Name(id="_np", ctx=ast.Load()), attr="nan", ctx=ast.Load())
+            value = _np_call("where", ast.Name(id=mask, ctx=ast.Load()), value, previous)
+        defined.add(name)
+        return ast.Assign(targets=[ast.Name(id=name, ctx=ast.Store())], value=value, lineno=0)
+
+    def block(statements, mask):
+        out = []
+        for stmt in statements:
+            if _is_noop(stmt):
+                continue
+            if isinstance(stmt, ast.Assign) and len(stmt.targets) == 1 and isinstance(stmt.targets[0], ast.Name):
+                out.append(assign(stmt.targets[0].id, convert(stmt.value), mask))
+            elif isinstance(stmt, ast.AnnAssign) and isinstance(stmt.target, ast.Name) and stmt.value is not None:
+                out.append(assign(stmt.target.id, convert(stmt.value), mask))
+            elif isinstance(stmt, ast.AugAssign) and isinstance(stmt.target, ast.Name):
+                value = ast.BinOp(left=ast.Name(id=stmt.target.id, ctx=ast.Load()), op=stmt.op,
+                                  right=convert(stmt.value))
+                out.append(assign(stmt.target.id, value, mask))
+            elif isinstance(stmt, ast.If):
+                if all(_is_noop(branch_stmt) for branch_stmt in stmt.body + stmt.orelse):
+                    continue
+                test_name = f"_mask_{next(mask_numbers)}"
+                out.append(ast.Assign(targets=[ast.Name(id=test_name, ctx=ast.Store())], value=convert(stmt.test),
+                                      lineno=0))
+                branches = [(stmt.body, ast.Name(id=test_name, ctx=ast.Load())),
+                            (stmt.orelse, _np_call("logical_not", ast.Name(id=test_name, ctx=ast.Load())))]
+                for i, (statements_branch, condition) in enumerate(branches):
+                    if all(_is_noop(branch_stmt) for branch_stmt in statements_branch):
+                        continue
+                    if mask is not None:
+                        condition = _np_call("logical_and", ast.Name(id=mask, ctx=ast.Load()), condition)
+                    branch_mask = f"{test_name}_{'if' if i == 0 else 'else'}"
+                    out.append(ast.Assign(targets=[ast.Name(id=branch_mask, ctx=ast.Store())], value=condition,
+                                          lineno=0))
+                    out.extend(block(statements_branch, branch_mask))
+            else:
+                raise _Unsupported(type(stmt).__name__)
+        return out
+
+    try:
+        statements = block(body[:-1], None)
+        result = convert(body[-1].value)
+    except _Unsupported:
+        return None
+
+    # Both branches are calculated everywhere, so e.g. divisions by zero in the branch that does not apply are fine
+    errstate = ast.parse("with _np.errstate(all='ignore'): pass").body[0]
+    errstate.body = statements + [ast.Return(value=result)]
+    vec_def = copy.copy(alg_def)
+    vec_def.name = alg_def.name + VECTORIZED_SUFFIX
+    vec_def.body = [errstate]
+    return ast.fix_missing_locations(vec_def)
+
+
+def _drop_noops(statements):
+    kept = []
+    for stmt in statements:
+        if isinstance(stmt, ast.Expr) and isinstance(stmt.value, ast.Constant):
+            continue
+        if isinstance(stmt, ast.Pass):
+            continue
+        if isinstance(stmt, ast.If):
+            stmt.body = _drop_noops(stmt.body)
+            stmt.orelse = _drop_noops(stmt.orelse)
+            if not stmt.body and not stmt.orelse and _is_plain_read(stmt.test):
+                continue
+            if not stmt.body:
+                stmt.body = [ast.Pass()]
+        kept.append(stmt)
+    return kept
+
+
+def _is_plain_read(node):
+    """ True for tests without side effects like `feed.batch` or `q_o_s >= q_o_lim`. """
+    return all(isinstance(child, (ast.Name, ast.Attribute, ast.Constant, ast.Compare, ast.BoolOp, ast.UnaryOp,
+                                  ast.Load, ast.cmpop, ast.boolop, ast.unaryop))
+               for child in ast.walk(node))
+
+
+def _build_factory_source(functions, returns, n_bindings, env_names=()):
+    lines = [f"def {FACTORY_NAME}({BOUND_VECTOR}, {ENV_DICT}):", "    import numpy as _np",
+             "    from numpy import ndarray as _ndarray"]
+    for name in env_names:
+        lines.append(f"    {name} = {ENV_DICT}[{name!r}]")
+    if n_bindings:
+        bound_names = ", ".join(f"{BOUND_VECTOR}_{i}" for i in range(n_bindings))
+        lines.append(f"    {bound_names}, = {BOUND_VECTOR}")
+    for func_def in functions:
+        func_def = ast.fix_missing_locations(func_def)
+        lines.append(textwrap.indent(ast.unparse(func_def), "    "))
+    lines.append(f"    return {', '.join(str(name) for name in returns)}")
+    return "\n".join(lines) + "\n"
+
+
+def _make_factory(source, namespace, name):
+    code = compile(source, f"<compiled {name}>", "exec")
+    scratch = {}
+    exec(code, scratch)
+    # Rebuild the factory with the real namespace as globals so that e.g. feed is looked up live
+    factory = scratch[FACTORY_NAME]
+    return types.FunctionType(factory.__code__, namespace, FACTORY_NAME)
@@ -0,0 +1,118 @@
+import time
+from contextlib import contextmanager
+
+
+# Columns of allthedata["diagnostics"] (times in seconds)
+COLUMNS = ("RHS calls", "Jacobian evaluations", "accepted steps", "rejected steps", "algebra calls",
+           "wall time [s]", "RHS time [s]", "Feed.get time [s]", "kinetics time [s]", "Jacobian time [s]",
+           "solver overhead [s]")
+
+
+class Diagnostics:
+    def __init__(self):
+        """ Work of one simulation by section: one row per feeding phase, the search of the feed start by substrate
+        limit ("event search") and the calculation of the rates ("post-processing").
+
+        The solver calls the wrapped dif_simple and Jacobian (see wrap), which count the calls and measure their
+        time. "Feed.get time" is 0: the simulator gives dif_simple a feed locked in the phase (cfb.FeedState), for
+        which the compiled model does not call feed.get, so the whole RHS time is kinetics. Everything else of the wall time of a section is spent by the solver itself. Accepted steps and Jacobian evaluations
+        (also the ones by finite differences) are reported by the solver, rejected steps (failed error tests or
+        Newton iterations) are counted as the times the solver evaluates dif_simple at an earlier time than
+        before. The measurement itself adds some time to every call.
+
+        Typical pictures: many Jacobian evaluations and rejected steps -> stiff model (try jacobian=True or a
+        stiff method); a long event search -> many trial runs to find the feed start (try dense=True); most of
+        the time in the RHS -> a long dif_simple (try jit=True for large models, see class_jit).
+        """
+        self.rows = {}
+        self._sections = []
+        self._started = None
+        self._last_t = None
+
+    # -----------------------------
+    # Sections
+    # -----------------------------
+    @contextmanager
+    def section(self, name):
+        """ Wall time and counts inside the block belong to the row name (not to the enclosing section) """
+        self._pause()
+        self._sections.append(self.rows.setdefault(name, dict.fromkeys(COLUMNS, 0)))
+        self._started = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self._pause()
+            self._sections.pop()
+            self._started = time.perf_counter() if self._sections else None
+
+    def _pause(self):
+        if self._sections:
+            self._sections[-1]["wall time [s]"] += time.perf_counter() - self._started
+
+    def add(self, column, value=1):
+        if self._sections:
+            self._sections[-1][column] += value
+
+    # -----------------------------
+    # Instrumentation
+    # -----------------------------
+    def wrap(self, rhs, jac=None):
+        """ (rhs, jac) that count their calls and measure their time, for the solver """
+        rows = self._sections
+
+        def timed_rhs(x, t):
+            if self._last_t is not None and t < self._last_t:
+                rows[-1]["rejected steps"] += 1
+            self._last_t = t
+            start = time.perf_counter()
+            result = rhs(x, t)
+            row = rows[-1]
+            row["RHS time [s]"] += time.perf_counter() - start
+            row["RHS calls"] += 1
+            return result
+
+        def timed_jac(x, t):
+            start = time.perf_counter()
+            result = jac(x, t)
+            rows[-1]["Jacobian time [s]"] += time.perf_counter() - start
+            return result
+
+        return timed_rhs, None if jac is None else timed_jac
+
+    def solver_started(self):
+        """ Called before every solver run (the solver starts at the beginning again) """
+        self._last_t = None
+
+    # -----------------------------
+    # Results
+    # -----------------------------
+    def table(self):
+        """ Rows by section with the derived columns and a "total" row, for allthedata["diagnostics"] and
+        generate_markdown_table(allthedata["diagnostics"], "Diagnostics")
+        """
+        table = {}
+        for name, row in self.rows.items():
+            row = dict(row)
+            row["kinetics time [s]"] = row["RHS time [s]"] - row["Feed.get time [s]"]
+            if row["RHS calls"]:
+                row["solver overhead [s]"] = max(row["wall time [s]"] - row["RHS time [s]"]
+                                                 - row["Jacobian time [s]"], 0.0)
+            table[name] = row
+        if table:
+            table["total"] = {column: sum(row[column] for row in table.values()) for column in COLUMNS}
+        return {name: {column: round(value, 6) if isinstance(value, float) else value
+                       for column, value in row.items()} for name, row in table.items()}
+
+    def report(self):
+        """ Summary of the table as text """
+        table = self.table()
+        if not table:
+            return "No diagnostics recorded."
+        lines = [f"{'section':<16}{'RHS calls':>11}{'Jacobians':>11}{'accepted':>10}{'rejected':>10}{'wall':>10}"
+                 f"{'RHS':>10}{'Feed.get':>10}{'solver':>10}"]
+        for name, row in table.items():
+            lines.append(f"{name:<16}{row['RHS calls']:>11}{row['Jacobian evaluations']:>11}"
+                         f"{row['accepted steps']:>10}{row['rejected steps']:>10}{row['wall time [s]']:>9.3f}s"
+                         f"{row['RHS time [s]']:>9.3f}s{row['Feed.get time [s]']:>9.3f}s"
+                         f"{row['solver overhead [s]']:>9.3f}s")
+        return "\n".join(lines)
@@ -0,0 +1,352 @@
+import ast
+import copy
+import math
+
+import numpy as np
+from scipy.integrate import solve_ivp
+
+import class_allthedata as catd
+import class_compiler as ccm
+import class_simulator as csim
+
+
+# Number of members whose vectorized rates are compared with the rates of algebra
+CHECK_MEMBERS = 8
+
+# Smallest ensemble that is integrated as one stacked system: one vectorized call of dif_simple costs about 0.1 ms
+# for any number of members, 20-50 times a scalar call (benchmarks/bench_ensemble.py)
+MIN_STACKED_MEMBERS = 32
+
+# Members whose substrate is this close (relative) to the lowest one at a feed start event start feeding together
+EVENT_RTOL = 1e-9
+
+
+class EnsembleResult:
+    def __init__(self, t, x, members, model, varied, parameters):
+        """ Trajectories of N simulations (members) of one model with different parameters and/or x0.
+
+        :param t: time points (the same for all members)
+        :param x: states, shape (N, len(t), n_states)
+        :param members: one csim.SimulationResult per member (phases, feed start, ...), its x is x[i]
+        :param model: the class_compiler.CompiledModel of the ensemble (bound to the feed)
+        :param varied: {position in model.values: array with one value per member}
+        :param parameters: the varied values by the name they were given with, e.g. {"mu_set": array([...])}
+        """
+        self.t = t
+        self.x = x
+        self.members = members
+        self.model = model
+        self.varied = varied
+        self.parameters = parameters
+        self.schedule = members[0].schedule
+        self.feed_name = members[0].feed_name
+
+    def __len__(self):
+        return len(self.members)
+
+    def label(self, i):
+        """ Short description of member i, e.g. 'mu_set=0.1, K_s=0.05' """
+        if not self.parameters:
+            return f"member {i + 1}"
+        return ", ".join(f"{name}={values[i]:g}" for name, values in self.parameters.items())
+
+    # -----------------------------
+    # Rates
+    # -----------------------------
+    def x_and_rs(self, rates, out=None):
+        """ States and rates of all members: array of shape (N, len(t), n_states + len(rates)).
+
+        The vectorized algebra of class_compiler is called once for all members and time points, the parameters
+        of the members are bound as arrays. If that is not possible (or its results differ from algebra for the
+        checked members) the rates are calculated member by member with csim.SimulationResult.x_and_rs.
+
+        :param rates: rates dict of the notebook (or a list of rate names), gives the order of the columns
+        :param out: preallocated array of shape (N, len(t), n_states + len(rates)), created if None
+        """
+        names = list(rates)
+        n_members, n_points, n_states = self.x.shape
+        if out is None:
+            out = np.empty((n_members, n_points, n_states + len(names)))
+        out[..., :n_states] = self.x
+        if not self._rates_vectorized(names, out[..., n_states:]):
+            for member, member_out in zip(self.members, out):
+                member.x_and_rs(names, out=member_out)
+        return out
+
+    def _rates_vectorized(self, names, columns):
+        phase = np.stack([member.phase_per_point for member in self.members])
+        ts = np.array([np.nan if member.ts is None else member.ts for member in self.members])
+        X_fedbatch_start = np.array([np.nan if member.X_fedbatch_start is None else member.X_fedbatch_start
+                                     for member in self.members])
+        feed = self.schedule.state(phase, ts[:, None], X_fedbatch_start[:, None])
+
+        # Values with one row per member broadcast against the (member, time point) arrays
+        values = list(self.model.values)
+        for position, column in self.varied.items():
+            values[position] = column[:, None]
+        algebra_vectorized = self.model.with_values(values).bind(**{self.feed_name: feed}).algebra_vectorized
+        if algebra_vectorized is None:
+            return False
+        try:
+            results = algebra_vectorized(np.moveaxis(self.x, 2, 0), self.t)
+            for j, name in enumerate(names):
+                columns[..., j] = results[name]
+        except Exception as error:
+            print(f"⚠️ Warning: vectorized algebra failed ({error}), the rates are calculated member by member.")
+            return False
+
+        for i in np.unique(np.linspace(0, len(self) - 1, CHECK_MEMBERS).astype(int)):
+            if not self.members[i]._rates_match(names, columns[i]):
+                print("⚠️ Warning: vectorized algebra differs from algebra, the rates are calculated member by member.")
+                return False
+        return True
+
+    # -----------------------------
+    # Plotting
+    # -----------------------------
+    def allthedata(self, variables, inputs, rates, x_and_rs=None, description="Simulation"):
+        """ One allthedata dict per member (see catd.AllthedataBuilder), e.g. for cplt.PlotPlotly:
+        allthedata_plot = {str(i + 1): data for i, data in enumerate(ensemble.allthedata(variables, inputs, rates))}
+
+        :param x_and_rs: result of x_and_rs(rates), calculated if None
+        :param description: description of the simulations, the label of the member is added
+        """
+        if x_and_rs is None:
+            x_and_rs = self.x_and_rs(rates)
+        data = []
+        for i, member in enumerate(self.members):
+            builder = catd.AllthedataBuilder(variables, inputs, rates, x_and_rs[i], self.t, member.t_fedbatch,
+                                             member.t_constant_feed, description=f"{description} ({self.label(i)})")
+            data.append(builder.build())
+        return data
+
+
+class StackedModel:
+    def __init__(self, model, feed_name="feed"):
+        """ dif_simple of all members of an ensemble at once: the compiled dif_simple is vectorized like algebra
+        (class_compiler, every if becomes a mask), so x with shape (n_states, N), bound values with one entry per
+        member and a feed with one phase per member (cfb.FeedState of arrays) give the derivatives of all members
+        in one call.
+
+        :param model: class_compiler.CompiledModel (any copy, the values are passed by bind)
+        :param feed_name: global name of the feed inside dif_simple
+        :raises ValueError: if dif_simple can not be vectorized (e.g. loops or calls other than feed.get)
+        """
+        rhs_def = copy.deepcopy(next(func_def for func_def in model._defs if func_def.name == model.rhs_name))
+        # x = x.tolist() and (if feed.stateful:) feed.get(t, S, X) are left out, the feed of a member is fixed
+        body = [stmt for stmt in rhs_def.body if not (isinstance(stmt, ast.If) and (
+            "tolist" in ast.unparse(stmt.test) or "_ndarray" in ast.unparse(stmt.test)
+            or ast.unparse(stmt.test) == f"{feed_name}.stateful"))]
+        returned = body[-1].value if body and isinstance(body[-1], ast.Return) else None
+        lists = {stmt.targets[0].id: len(stmt.value.elts) for stmt in body if isinstance(stmt, ast.Assign)
+                 and isinstance(stmt.targets[0], ast.Name) and isinstance(stmt.value, (ast.List, ast.Tuple))}
+        if isinstance(returned, (ast.List, ast.Tuple)):
+            elements = returned.elts
+        elif isinstance(returned, ast.Name) and returned.id in lists:
+            elements = [ast.Subscript(ast.Name(returned.id, ast.Load()), ast.Constant(i), ast.Load())
+                        for i in range(lists[returned.id])]
+        else:
+            raise ValueError("dif_simple can not be vectorized (it does not return a list).")
+        # _vectorize needs a dict as result: {i: derivative of state i}
+        body[-1] = ast.Return(ast.Dict([ast.Constant(i) for i in range(len(elements))], elements))
+        rhs_def.body = body
+        self.function_def = ccm._vectorize(rhs_def, {**model.namespace, "math": math})
+        if self.function_def is None:
+            raise ValueError("dif_simple can not be vectorized.")
+        self.n_states = len(elements)
+        self.feed_name = feed_name
+        self.n_bindings = len(model.bindings)
+        self.namespace = model.namespace
+        self._factories = {}
+
+    @property
+    def source(self):
+        return ast.unparse(self.function_def)
+
+    def bind(self, model, values, feed_state):
+        """ rhs(y, t) of the stacked states y = x of all members one after the other (shape (N * n_states,)).
+
+        :param model: copy of the model the function was derived from (its other bound globals are used)
+        :param values: bound values (CompiledModel.values), the varied ones as arrays with one entry per member
+        :param feed_state: cfb.FeedState with the phase, ts and X_fedbatch_start of every member (arrays)
+        """
+        env = {**model.env, self.feed_name: feed_state}
+        names = tuple(sorted(env))
+        if names not in self._factories:
+            source = ccm._build_factory_source([self.function_def], [self.function_def.name], self.n_bindings, names)
+            self._factories[names] = ccm._make_factory(source, self.namespace, self.function_def.name)
+        function = self._factories[names](values, env)
+        n_states = self.n_states
+        n_members = len(feed_state.batch)
+        out = np.empty((n_members, n_states))
+
+        def rhs(y, t):
+            derivatives = function(y.reshape(n_members, n_states).T, t)
+            for i in range(n_states):
+                out[:, i] = derivatives[i]
+            return out.ravel()
+
+        return rhs
+
+
+class EnsembleSimulator:
+    def __init__(self, model, feed, substrate=None, biomass=None, feed_name=None, rtol=csim.DEFAULT_TOL,
+                 atol=csim.DEFAULT_TOL, jit=False, stacked=True):
+        """ Simulates N variants of a generated model (parameters and/or x0), e.g. for scenario scans without
+        running the notebook again for every scenario.
+
+        Ensembles of at least MIN_STACKED_MEMBERS members are integrated together as one stacked system
+        (StackedModel, one vectorized call of dif_simple for all members). Every member has its own feeding phase
+        (a mask inside the RHS), its own feed start and its own overflow/min/max branches. The solver (LSODA) gets
+        the block structure of the Jacobian (banded, the members do not depend on each other) and shares its step
+        size among the members. At a feed start caused by the substrate limit the solver stops (an event per
+        member) and starts again with the new phase of that member: members that start feeding at the same time
+        (e.g. a scan of the feed rate) cost one stop, members that start at different times one stop each
+        (benchmarks/bench_ensemble.py shows both). The states agree with single simulations within the tolerances.
+
+        Smaller ensembles, or if dif_simple can not be vectorized (or with stacked=False), are simulated member
+        by member, each by its own csim.FedBatchSimulator. The rates of all members are calculated together (see
+        EnsembleResult.x_and_rs). Use class_sweep to spread many members over processes.
+
+        :param jit: True to simulate the members one after the other with dif_simple compiled by numba (class_jit)
+        :param stacked: False to simulate the members one after the other
+        The other arguments are the same as for csim.FedBatchSimulator.
+        """
+        simulator = csim.FedBatchSimulator(model, feed, substrate, biomass, feed_name, rtol, atol, verbose=False,
+                                           jit=jit)
+        self.model = simulator.model
+        self.schedule = simulator.schedule
+        self.feed_name = simulator.feed_name
+        self.substrate = simulator.substrate
+        self.biomass = simulator.biomass
+        self.rtol = rtol
+        self.atol = atol
+        self.jit = simulator.jit
+        self.stacked = None
+        if stacked and self.jit is None:
+            try:
+                self.stacked = StackedModel(self.model, self.feed_name)
+            except ValueError as error:
+                print(f"⚠️ Warning: {error} The members are simulated one after the other.")
+
+    def run(self, x0, t, parameters=None):
+        """ Simulates all members and returns an EnsembleResult.
+
+        :param x0: initial states, shape (n_states,) (the same for all members) or (N, n_states)
+        :param t: time points
+        :param parameters: values per member by name, e.g. {"mu_set": [0.1, 0.2], "inputs.Feed.concentration": 300}
+                           (names as for class_compiler.CompiledModel.with_values, numbers are used for all members)
+        """
+        t = np.asarray(t, dtype=float)
+        parameters = {name: np.asarray(values, dtype=float).ravel() for name, values in (parameters or {}).items()}
+        x0 = np.asarray(x0, dtype=float)
+        n_members = max([len(x0) if x0.ndim == 2 else 1] + [values.size for values in parameters.values()])
+        x0 = np.array(np.broadcast_to(x0, (n_members, x0.shape[-1])))
+
+        varied = {}
+        for name, values in parameters.items():
+            if name not in self.model.index:
+                raise KeyError(f"'{name}' is not used by the model. Available: {self.model.names}")
+            if values.size not in (1, n_members):
+                raise ValueError(f"'{name}' has {values.size} values, but there are {n_members} members.")
+            parameters[name] = np.array(np.broadcast_to(values, n_members))
+            varied[self.model.index[name]] = parameters[name]
+
+        if self.stacked is not None and n_members >= MIN_STACKED_MEMBERS:
+            return self._run_stacked(x0, t, varied, parameters)
+
+        x = np.empty((n_members, len(t), x0.shape[1]))
+        members = []
+        for i in range(n_members):
+            values = list(self.model.values)
+            for position, column in varied.items():
+                values[position] = float(column[i])
+            simulator = csim.FedBatchSimulator(self.model.with_values(values), self.schedule, self.substrate,
+                                               self.biomass, self.feed_name, self.rtol, self.atol, verbose=False,
+                                               jit=self.jit)
+            member = simulator.run(x0[i], t)
+            x[i] = member.x
+            member.x = x[i]
+            members.append(member)
+        return EnsembleResult(t, x, members, self.model, varied, parameters)
+
+    def _run_stacked(self, x0, t, varied, parameters):
+        """ run with all members in one stacked system (see StackedModel) """
+        n_members, n_states = x0.shape
+        S, X = self.substrate, self.biomass
+        schedule = self.schedule
+        values = list(self.model.values)
+        for position, column in varied.items():
+            values[position] = column
+
+        x = np.full((n_members, len(t), n_states), np.nan)
+        phase = np.full(n_members, "", dtype="<U8")
+        started = np.zeros(n_members, dtype=bool)
+        ts = np.full(n_members, np.nan)
+        X_fedbatch_start = np.full(n_members, np.nan)
+        phases = [[] for _ in range(n_members)]
+        stats = {"nfev": 0, "njev": 0}
+        t_now, t_end = t[0], t[-1]
+        x_now = x0
+        while True:
+            # Phase of every member as in csim.FedBatchSimulator.run
+            for i in range(n_members):
+                new_phase = schedule.phase_at(t_now, x_now[i, S], started[i])
+                if new_phase != phase[i]:
+                    if new_phase == "fedbatch" and np.isnan(ts[i]):
+                        started[i] = True
+                        ts[i], X_fedbatch_start[i] = t_now, x_now[i, X]
+                    if phases[i]:
+                        phases[i][-1]["end"] = float(t_now)
+                    phases[i].append(dict(phase=new_phase, start=float(t_now), end=float(t_end)))
+                    phase[i] = new_phase
+
+            t_stop = min(schedule.next_stop(member_phase, t_now, t_end) for member_phase in set(phase))
+            in_phase = (t >= t_now) & ((t < t_stop) | (t_stop == t_end))
+            times = np.unique(np.concatenate(([t_now], t[in_phase], [t_stop])))
+            rhs = self.stacked.bind(self.model, values, schedule.state(phase.copy(), ts.copy(),
+                                                                       X_fedbatch_start.copy()))
+
+            # The solver stops when the first member in the batch phase reaches the substrate limit
+            limited = (phase == "batch") & (schedule.substrate_limit is not None)
+            event = None
+            if limited.any():
+                def event(time, y):
+                    return y.reshape(n_members, n_states)[limited, S].min() - schedule.threshold
+                event.terminal, event.direction = True, -1
+
+            solution = solve_ivp(lambda time, y: rhs(y, time), (t_now, t_stop), x_now.ravel(), "LSODA", t_eval=times,
+                                 events=event, rtol=self.rtol, atol=self.atol, lband=n_states - 1,
+                                 uband=n_states - 1)
+            stats["nfev"] += solution.nfev
+            stats["njev"] += solution.njev
+            states = solution.y.T.reshape(-1, n_members, n_states)
+            on_grid = np.isin(solution.t, t[in_phase])
+            x[:, np.searchsorted(t, solution.t[on_grid])] = np.swapaxes(states[on_grid], 0, 1)
+
+            if solution.status == 1:
+                t_now = solution.t_events[0][0]
+                x_now = solution.y_events[0][0].reshape(n_members, n_states)
+                lowest = x_now[limited, S].min()
+                started |= limited & (x_now[:, S] <= lowest + EVENT_RTOL * max(abs(lowest), 1.0))
+                continue
+            if not solution.success:
+                print(f"⚠️ Warning: LSODA failed at t={solution.t[-1]:.6g} ({solution.message}).")
+                break
+            if t_stop >= t_end:
+                break
+            t_now, x_now = t_stop, states[-1]
+
+        members = []
+        for i in range(n_members):
+            member_values = [value[i] if isinstance(value, np.ndarray) else value for value in values]
+            feed_start = (None, None) if np.isnan(ts[i]) else (float(ts[i]), float(X_fedbatch_start[i]))
+            members.append(csim.SimulationResult(t, x[i], phases[i], *feed_start,
+                                                 schedule.mode, self.model.with_values(member_values), schedule,
+                                                 self.feed_name, dict(stats)))
+        return EnsembleResult(t, x, members, self.model, varied, parameters)
+
+
+def simulate_ensemble(model, feed, x0, t, parameters=None, **options):
+    """ Shortcut for EnsembleSimulator(model, feed, **options).run(x0, t, parameters), see there. """
+    return EnsembleSimulator(model, feed, **options).run(x0, t, parameters)
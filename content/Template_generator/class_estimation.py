@@ -0,0 +1,247 @@
+import collections
+import contextlib
+import io
+
+import numpy as np
+from scipy.optimize import least_squares
+
+import class_fisher as cfish
+import class_sensitivity as csens
+import class_simulator as csim
+
+
+# Number of simulations (parameter vectors) kept by ParameterEstimator
+CACHE_SIZE = 32
+
+
+class MeasuredData:
+    def __init__(self, times, values, scale):
+        """ Measured values of the states of a model.
+
+        :param times: sorted measurement times (repeated for replicates)
+        :param values: shape (len(times), n_states), nan where a state was not measured
+        :param scale: factor of every residual (weight / std), same shape as values
+        """
+        self.times = np.asarray(times, dtype=float)
+        self.values = np.asarray(values, dtype=float)
+        self.scale = np.asarray(scale, dtype=float)
+
+
+def _replicate_index(times):
+    """ 0 for the first measurement at a time, 1 for the second (replicate) at the same time, ... """
+    order = np.argsort(times, kind="stable")
+    sorted_times = times[order]
+    first = np.r_[True, sorted_times[1:] != sorted_times[:-1]]
+    positions = np.arange(len(times))
+    index = np.empty(len(times), dtype=int)
+    index[order] = positions - np.maximum.accumulate(np.where(first, positions, 0))
+    return index
+
+
+def measured_data(allthedata, states):
+    """ MeasuredData of the states from an allthedata dict (catd.AllthedataBuilder.build with data).
+
+    Only variables with 'estimable' not False are used, values outside the 'boundaries' of a variable (e.g. below
+    the detection limit) are left out. Every measurement gets its own residual: the rows are the sorted
+    measurement times, a time is repeated for replicates (the k-th value of a state at a time is in the k-th row of
+    that time). The scale of a value is 'weight' / 'std' ('std' one value or one value per time, an empty 'std' is
+    1).
+    """
+    used = [(i, allthedata["variables"][state]) for i, state in enumerate(states)]
+    used = [(i, meta) for i, meta in used if meta["estimable"] is not False and len(meta["vals"]) > 0]
+    times = [np.asarray(meta["times"], dtype=float) for _, meta in used]
+    keys = np.column_stack((np.concatenate(times), np.concatenate([_replicate_index(t) for t in times]))) \
+        if used else np.empty((0, 2))
+    rows, row_of = np.unique(keys, axis=0, return_inverse=True)
+    row_of = row_of.ravel()
+
+    values = np.full((len(rows), len(states)), np.nan)
+    scale = np.ones((len(rows), len(states)))
+    start = 0
+    for (i, meta), t in zip(used, times):
+        measurement_rows = row_of[start:start + len(t)]
+        start += len(t)
+        vals = np.asarray(meta["vals"], dtype=float)
+        lower, upper = [-np.inf if bound is None else bound for bound in meta.get("boundaries", [None, None])]
+        values[measurement_rows, i] = np.where((vals >= lower) & (vals <= upper), vals, np.nan)
+        std = np.atleast_1d(np.asarray(meta.get("std", []), dtype=float))
+        scale[measurement_rows, i] = meta["weight"] / (std if std.size else 1.0)
+    return MeasuredData(rows[:, 0], values, scale)
+
+
+class EstimationResult:
+    def __init__(self, names, values, initial, bounds, cost, success, message, nfev, njev, simulations):
+        """ Result of ParameterEstimator.fit.
+
+        :param names: names of the parameters
+        :param values: fitted values
+        :param initial: start values of the fit
+        :param bounds: bounds of the parameters, shape (n_params, 2)
+        :param cost: half of the sum of the squared weighted residuals
+        :param success: True if the optimizer converged
+        :param message: message of the optimizer
+        :param nfev: number of residual evaluations of the optimizer
+        :param njev: number of Jacobian evaluations of the optimizer
+        :param simulations: number of simulations that were needed (the others came from the cache)
+        """
+        self.names = list(names)
+        self.values = values
+        self.initial = initial
+        self.bounds = bounds
+        self.cost = cost
+        self.success = success
+        self.message = message
+        self.nfev = nfev
+        self.njev = njev
+        self.simulations = simulations
+
+    def as_dict(self):
+        """ Fitted values by name, e.g. for class_compiler.CompiledModel.with_values(**result.as_dict()) """
+        return dict(zip(self.names, self.values))
+
+
+class ParameterEstimator:
+    def __init__(self, model, feed, x0, t0, data, parameters=None, bounds=None, jacobian=False,
+                 rtol=csim.DEFAULT_TOL, atol=csim.DEFAULT_TOL, jit=False):
+        """ Weighted least-squares fit of parameters of a generated model to measured data (scipy least_squares).
+
+        The residuals (simulated - measured) * weight / std are evaluated only at the measurement times: the solver
+        returns its (interpolated) solution exactly at these times, so no fine time grid is simulated. Simulations
+        are cached by parameter vector, a point the optimizer evaluates again (e.g. the Jacobian at an accepted
+        step) is not integrated again.
+
+        :param model: dif_simple (compiled, see class_compiler) or a class_compiler.CompiledModel
+        :param feed: the cfb.Feed of the notebook or a cfb.FeedSchedule
+        :param x0: initial states
+        :param t0: start time of the simulation
+        :param data: MeasuredData (see measured_data)
+        :param parameters: names of the parameters (as for class_compiler.CompiledModel.with_values) or initial
+                           values ("variables.<name>.initial_value"), defaults to
+                           class_sensitivity.estimable_parameters
+        :param bounds: bounds of the parameters, shape (n_params, 2), defaults to 'min'/'max' of the parameters
+                       table (see class_fisher.parameter_bounds)
+        :param jacobian: True to give the optimizer the Jacobian from the forward sensitivities (class_sensitivity)
+                         instead of finite differences of the residuals. It needs fewer simulations, but each one
+                         integrates the sensitivities of all parameters: for the library models the fit is slower
+                         (benchmarks/bench_estimation.py), it can pay off for an expensive simulation with many
+                         parameters or if finite differences of the residuals are too noisy to converge. If an
+                         if/else test of dif_simple switches with the states inside a phase, the sensitivities are
+                         finite differences as well (see class_sensitivity.SensitivitySimulator)
+        :param rtol: relative tolerance of the solver
+        :param atol: absolute tolerance of the solver
+        :param jit: True to simulate with dif_simple compiled by numba (class_jit, compiled once for all fits)
+        """
+        self.simulator = csim.FedBatchSimulator(model, feed, rtol=rtol, atol=atol, verbose=False, jit=jit)
+        self.model = self.simulator.model
+        self.rtol = rtol
+        self.atol = atol
+        self.jacobian = jacobian
+        self.x0 = np.asarray(x0, dtype=float)
+        self.names = list(csens.estimable_parameters(self.model) if parameters is None else parameters)
+        self.sensitivity = csens.SensitivitySimulator(self.model, self.simulator.schedule, self.names,
+                                                      self.simulator.substrate, self.simulator.biomass,
+                                                      self.simulator.feed_name, rtol, atol)
+        initial_values = self.sensitivity.initial_values
+        self.values = np.array([self.x0[initial_values[name]] if name in initial_values
+                                else self.model.values[self.model.index[name]] for name in self.names], dtype=float)
+        self.bounds = cfish.parameter_bounds(self.names, self.values, self.model.tables["parameters"]) \
+            if bounds is None else np.asarray(bounds, dtype=float)
+        empty = [name for name, (lower, upper) in zip(self.names, self.bounds) if not lower < upper]
+        if empty:
+            raise ValueError(f"The bounds of {empty} are empty (lower >= upper). A parameter with the value 0 needs "
+                             f"'min' and 'max' in the parameters table (or pass bounds=).")
+
+        self.data = data
+        self.t = np.unique(np.concatenate(([t0], data.times)))
+        self.rows = np.searchsorted(self.t, data.times)
+        self.measured = ~np.isnan(data.values)
+        if not np.any(self.measured):
+            raise ValueError("There are no measured values of estimable variables.")
+        self.cache = collections.OrderedDict()
+        self.simulations = 0
+
+    def _model_and_x0(self, p):
+        values = list(self.model.values)
+        x0 = self.x0.copy()
+        for name, value in zip(self.names, p):
+            if name in self.sensitivity.initial_values:
+                x0[self.sensitivity.initial_values[name]] = value
+            else:
+                values[self.model.index[name]] = value
+        return self.model.with_values(values), x0
+
+    def _simulate(self, p, sensitivities=False):
+        """ States (and d states / d p) at the measurement times, cached by parameter vector """
+        key = np.asarray(p, dtype=float).tobytes()
+        entry = self.cache.get(key)
+        if entry is None or (sensitivities and "S" not in entry):
+            model, x0 = self._model_and_x0(p)
+            with contextlib.redirect_stdout(io.StringIO()):
+                if sensitivities:
+                    simulator = csens.SensitivitySimulator(model, self.simulator.schedule, self.names,
+                                                           self.simulator.substrate, self.simulator.biomass,
+                                                           self.simulator.feed_name, self.rtol, self.atol)
+                    result = simulator.run(x0, self.t)
+                    entry = {"x": result.x[self.rows], "S": result.sensitivities[self.rows]}
+                else:
+                    simulator = csim.FedBatchSimulator(model, self.simulator.schedule, self.simulator.substrate,
+                                                       self.simulator.biomass, self.simulator.feed_name, self.rtol,
+                                                       self.atol, verbose=False, jit=self.simulator.jit)
+                    entry = {"x": simulator.run(x0, self.t).x[self.rows]}
+            self.simulations += 1
+            self.cache[key] = entry
+            if len(self.cache) > CACHE_SIZE:
+                self.cache.popitem(last=False)
+        self.cache.move_to_end(key)
+        return entry
+
+    def _row_factor(self, counts):
+        scale = self.data.scale if counts is None else self.data.scale * np.sqrt(counts)[:, None]
+        return scale[self.measured]
+
+    def simulate(self, p=None):
+        """ Simulated states at the measurement times, shape (len(data.times), n_states) """
+        return self._simulate(self.values if p is None else p)["x"]
+
+    def residuals(self, p=None, counts=None):
+        """ Weighted residuals of all measured values.
+
+        :param p: values of the parameters, defaults to the current values
+        :param counts: how often every row of the data is counted (e.g. for a bootstrap sample), 1 if None
+        """
+        x = self.simulate(p)
+        residuals = self._row_factor(counts) * (x[self.measured] - self.data.values[self.measured])
+        # A failed simulation (nan) must not stop the fit
+        return np.nan_to_num(residuals, nan=1e10, posinf=1e10, neginf=-1e10)
+
+    def jacobian_matrix(self, p=None, counts=None):
+        """ d residuals / d p from the forward sensitivities, shape (number of residuals, n_params) """
+        S = self._simulate(self.values if p is None else p, sensitivities=True)["S"]
+        return np.nan_to_num(self._row_factor(counts)[:, None] * S[self.measured])
+
+    def fit(self, p0=None, counts=None, **options):
+        """ Fits the parameters and returns an EstimationResult.
+
+        :param p0: start values, defaults to the current values (clipped to the bounds)
+        :param counts: how often every row of the data is counted, 1 if None
+        :param options: passed to scipy.optimize.least_squares (e.g. max_nfev, ftol)
+        """
+        p0 = np.clip(self.values if p0 is None else np.asarray(p0, dtype=float), self.bounds[:, 0], self.bounds[:, 1])
+        simulations = self.simulations
+        options.setdefault("x_scale", np.where(p0 != 0, np.abs(p0), 1.0))
+        if self.jacobian:
+            options["jac"] = self.jacobian_matrix
+        solution = least_squares(self.residuals, p0, bounds=(self.bounds[:, 0], self.bounds[:, 1]),
+                                 args=(counts,), **options)
+        return EstimationResult(self.names, solution.x, p0, self.bounds, float(solution.cost),
+                                bool(solution.success), solution.message, solution.nfev, solution.njev,
+                                self.simulations - simulations)
+
+
+def estimate_parameters(model, feed, x0, t0, allthedata, parameters=None, **options):
+    """ Fits parameters of a model to the measured data of an allthedata dict, returns an EstimationResult.
+
+    :param options: bounds, jacobian, rtol, atol and jit of ParameterEstimator
+    """
+    data = measured_data(allthedata, list(allthedata["variables"])[:len(x0)])
+    return ParameterEstimator(model, feed, x0, t0, data, parameters, **options).fit()
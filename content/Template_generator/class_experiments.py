@@ -0,0 +1,270 @@
+import concurrent.futures
+import contextlib
+import dataclasses
+import io
+import os
+
+import numpy as np
+
+import class_allthedata as catd
+import class_simulator as csim
+from class_spec import load_namespace
+
+
+# Entries of an experiment (all optional)
+EXPERIMENT_KEYS = ("description", "Group_name", "overrides", "x0", "feed", "time", "data", "columns", "t_data")
+
+# Entries the simulation needs (only these are sent to the workers, not the measured data)
+SIMULATION_KEYS = ("overrides", "x0", "feed", "time")
+
+EXECUTORS = ("process", "thread")
+
+
+class ExperimentRun:
+    def __init__(self, x_and_rs, ts, X_fedbatch_start, mode, phases, stats, t_fedbatch, t_constant_feed,
+                 diagnostics):
+        """ Result of the simulation of one experiment, without the model (small enough to be sent between
+        processes). The time points are the grid of the experiment (MultiExperimentResult.t[expID]).
+        """
+        self.x_and_rs = x_and_rs
+        self.ts = ts
+        self.X_fedbatch_start = X_fedbatch_start
+        self.mode = mode
+        self.phases = phases
+        self.stats = stats
+        self.t_fedbatch = t_fedbatch
+        self.t_constant_feed = t_constant_feed
+        self.diagnostics = diagnostics
+
+    def builder_kwargs(self):
+        """ Feed times for catd.AllthedataBuilder, as csim.SimulationResult.builder_kwargs """
+        return dict(t_fedbatch=self.t_fedbatch, t_constant_feed=self.t_constant_feed, diagnostics=self.diagnostics)
+
+
+class MultiExperimentResult:
+    def __init__(self, t, runs, allthedata, columns):
+        """ All experiments by expID (in the order of the experiment table).
+
+        :param t: time points by expID, experiments with the same time settings share one array
+        :param runs: ExperimentRun by expID
+        :param allthedata: allthedata dict by expID, e.g. for cplt.PlotPlotly(result.allthedata, ...)
+        :param columns: names of the columns of x_and_rs (variables, then rates)
+        """
+        self.t = t
+        self.runs = runs
+        self.allthedata = allthedata
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.runs)
+
+    def column(self, expID, name):
+        """ One variable or rate of one experiment """
+        return self.runs[expID].x_and_rs[:, self.columns.index(name)]
+
+
+class _ExperimentRunner:
+    """ Loads a model once and simulates single experiments with it (in the parent, a thread or a worker). """
+
+    def __init__(self, model_path, rates, options):
+        with contextlib.redirect_stdout(io.StringIO()):
+            ns = load_namespace(model_path)
+            simulator = csim.FedBatchSimulator(ns["dif_simple"], ns["feed"], verbose=False, **options)
+        self.ns = ns
+        self.variables = list(ns["variables"])
+        self.x0 = np.array([meta["initial_value"] for meta in ns["variables"].values()], dtype=float)
+        self.t = np.asarray(ns["t"], dtype=float)
+        self.rates = list(ns["algebra"](self.x0, self.t[0]) if rates is None else rates)
+        self.model = simulator.model
+        self.schedule = simulator.schedule
+        # The Jacobian and the numba model are derived once and used for all experiments
+        self.options = dict(options, substrate=simulator.substrate, biomass=simulator.biomass,
+                            feed_name=simulator.feed_name, jacobian=simulator.jacobian, jit=simulator.jit)
+        self._grids = {}
+
+    @property
+    def columns(self):
+        return self.variables + self.rates
+
+    def time_grid(self, time=None):
+        """ t of the model, or the grid of t0, t_end and dt (one array per grid, shared by all experiments) """
+        if not time:
+            return self.t
+        t0, t_end, dt = (float(time.get(name, self.ns.get(name))) for name in ("t0", "t_end", "dt"))
+        key = (t0, t_end, dt)
+        if key not in self._grids:
+            self._grids[key] = np.linspace(t0, t_end, int(round((t_end - t0) / dt)) + 1)
+        return self._grids[key]
+
+    def check(self, expID, experiment):
+        """ Raises a KeyError for an unknown entry or override, a ValueError for a wrong x0 """
+        unknown = set(experiment) - set(EXPERIMENT_KEYS)
+        if unknown:
+            raise KeyError(f"Unknown entries {sorted(unknown)} in experiment '{expID}', use {list(EXPERIMENT_KEYS)}.")
+        for name in experiment.get("overrides", {}):
+            if self._initial_value_position(name) is None and name not in self.model.index:
+                raise KeyError(f"'{name}' (experiment '{expID}') is not used by the model. Available: "
+                               f"{self.model.names} and "
+                               f"{[f'variables.{variable}.initial_value' for variable in self.variables]}")
+        x0 = experiment.get("x0")
+        if isinstance(x0, dict):
+            for name in x0:
+                if name not in self.variables:
+                    raise KeyError(f"'{name}' in x0 of experiment '{expID}' is not a variable of the model.")
+        elif x0 is not None and len(x0) != len(self.variables):
+            raise ValueError(f"x0 of experiment '{expID}' has {len(x0)} values, the model has "
+                             f"{len(self.variables)} variables.")
+        unknown = set(experiment.get("feed", {})) - {field.name for field in dataclasses.fields(self.schedule)}
+        if unknown:
+            raise KeyError(f"Unknown feed settings {sorted(unknown)} in experiment '{expID}'.")
+
+    def _initial_value_position(self, name):
+        table, _, rest = name.partition(".")
+        variable, _, field = rest.rpartition(".")
+        if table == "variables" and field == "initial_value" and variable in self.variables:
+            return self.variables.index(variable)
+        return None
+
+    def run(self, experiment):
+        """ Simulates one experiment (only SIMULATION_KEYS are read) and returns an ExperimentRun """
+        x0 = experiment.get("x0")
+        if isinstance(x0, dict):
+            x0 = [x0.get(name, value) for name, value in zip(self.variables, self.x0)]
+        x0 = np.array(self.x0 if x0 is None else x0, dtype=float)
+        values = list(self.model.values)
+        for name, value in experiment.get("overrides", {}).items():
+            position = self._initial_value_position(name)
+            if position is not None:
+                x0[position] = value
+            if name in self.model.index:
+                values[self.model.index[name]] = value
+        schedule = dataclasses.replace(self.schedule, **experiment.get("feed", {}))
+        t = self.time_grid(experiment.get("time"))
+
+        simulation = csim.FedBatchSimulator(self.model.with_values(values), schedule, verbose=False,
+                                            **self.options).run(x0, t)
+        return ExperimentRun(simulation.x_and_rs(self.rates), simulation.ts, simulation.X_fedbatch_start,
+                             simulation.mode, simulation.phases, simulation.stats, simulation.t_fedbatch,
+                             simulation.t_constant_feed, simulation.diagnostics)
+
+
+# State of a worker process (set by _init_worker)
+_worker = {}
+
+
+def _init_worker(model_path, rates, options):
+    _worker["runner"] = _ExperimentRunner(model_path, rates, options)
+
+
+def _run_experiment(expID, experiment):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return expID, _worker["runner"].run(experiment)
+
+
+class MultiExperiment:
+    def __init__(self, model_path, rates=None, workers=None, executor="process", **options):
+        """ Simulates a table of experiments of one model (different initial values, parameters, feed settings,
+        time grids and measured data) and assembles one allthedata dict keyed by expID, as cplt.PlotPlotly expects
+        for plot_by_expID(plot_replicates=True, use_group_names=True) or plot_by_variable.
+
+        Every experiment is a dict with the (optional) entries of EXPERIMENT_KEYS:
+            {"description": "High X0", "Group_name": "X0",
+             "overrides": {"q_s_max": 1.2, "variables.Biomass.initial_value": 0.2, "inputs.Feed.concentration": 500},
+             "x0": {"Biomass": 0.2},                        # or all initial values as list
+             "feed": {"t_fedbatch_start": 5, "t_const": 18},  # replaces the settings of the cfb.Feed
+             "time": {"t_end": 25, "dt": 0.01},             # replaces t0, t_end and dt of the model
+             "data": measured, "columns": [...], "t_data": t_measured}  # as for catd.AllthedataBuilder.build
+
+        The model is loaded (and dif_simple compiled, see class_compiler) once per process, every experiment only
+        binds its values into a copy of the compiled model. The experiments run on a concurrent.futures pool,
+        only the simulation entries are sent to the workers and only the states, rates and feed times come back.
+        The allthedata dicts are built afterwards in this process, experiments with the same time settings share
+        one time grid, all share the variables, inputs and rates tables of the model.
+
+        :param model_path: model notebook or folder containing it, or a specification file (see
+                           class_spec.load_namespace)
+        :param rates: names of the rates in x_and_rs, defaults to everything algebra returns
+        :param workers: number of processes/threads (default: number of cores), 1 runs everything in this process
+        :param executor: "process" (a ProcessPoolExecutor, every worker loads the model once) or "thread" (a
+                         ThreadPoolExecutor sharing the loaded model, worth it only if the solver spends its time
+                         outside of Python, which is rarely the case: it calls dif_simple from Python at every step)
+        :param options: options of csim.FedBatchSimulator for all experiments (rtol, atol, jacobian, method, jit,
+                        diagnostics, ...), the Jacobian and the numba model are derived once
+        """
+        if executor not in EXECUTORS:
+            raise ValueError(f"Unknown executor {executor!r}, use one of {', '.join(EXECUTORS)}.")
+        self.model_path = model_path
+        self.workers = workers
+        self.executor = executor
+        self.options = options
+        self.runner = _ExperimentRunner(model_path, rates, options)
+        self.rates = self.runner.rates
+
+    def run(self, experiments, progress=None):
+        """ Simulates all experiments and returns a MultiExperimentResult.
+
+        :param experiments: experiments by expID (dict), or a list (expIDs "1", "2", ...)
+        :param progress: called as progress(done, total) every time an experiment is finished
+        """
+        if not isinstance(experiments, dict):
+            experiments = {str(i + 1): experiment for i, experiment in enumerate(experiments)}
+        experiments = {str(expID): dict(experiment) for expID, experiment in experiments.items()}
+        for expID, experiment in experiments.items():
+            self.runner.check(expID, experiment)
+        tasks = [(expID, {key: experiment[key] for key in SIMULATION_KEYS if key in experiment})
+                 for expID, experiment in experiments.items()]
+
+        runs = {}
+        workers = min(self.workers or os.cpu_count() or 1, len(tasks))
+        if workers > 1:
+            try:
+                self._run_parallel(tasks, workers, runs, progress)
+            except (OSError, NotImplementedError) as error:  # no processes (e.g. in the browser)
+                print(f"⚠️ Warning: could not start worker processes ({error}), the experiments run in this "
+                      f"process.")
+                runs.clear()
+        for expID, task in tasks:
+            if expID not in runs:
+                runs[expID] = self.runner.run(task)
+                if progress is not None:
+                    progress(len(runs), len(tasks))
+
+        runs = {expID: runs[expID] for expID in experiments}
+        t = {expID: self.runner.time_grid(experiment.get("time")) for expID, experiment in experiments.items()}
+        return MultiExperimentResult(t, runs, self._allthedata(experiments, t, runs), self.runner.columns)
+
+    def _run_parallel(self, tasks, workers, runs, progress):
+        if self.executor == "thread":
+            executor = concurrent.futures.ThreadPoolExecutor(workers)
+            futures = [executor.submit(lambda expID, task: (expID, self.runner.run(task)), expID, task)
+                       for expID, task in tasks]
+        else:
+            executor = concurrent.futures.ProcessPoolExecutor(
+                workers, initializer=_init_worker, initargs=(self.model_path, self.rates, self.options))
+            futures = [executor.submit(_run_experiment, expID, task) for expID, task in tasks]
+        with executor:
+            for future in concurrent.futures.as_completed(futures):
+                expID, run = future.result()
+                runs[expID] = run
+                if progress is not None:
+                    progress(len(runs), len(tasks))
+
+    def _allthedata(self, experiments, t, runs):
+        ns = self.runner.ns
+        rates = {name: ns["rates"].get(name, {}) for name in self.rates}
+        allthedata = {}
+        for expID, experiment in experiments.items():
+            run = runs[expID]
+            builder = catd.AllthedataBuilder(ns["variables"], ns["inputs"], rates, run.x_and_rs, t[expID],
+                                             description=experiment.get("description", f"Experiment {expID}"),
+                                             **run.builder_kwargs())
+            data = builder.build(experiment.get("data"), experiment.get("columns"), experiment.get("t_data"))
+            if "Group_name" in experiment:
+                data["Group_name"] = experiment["Group_name"]
+            allthedata[expID] = data
+        return allthedata
+
+
+def run_experiments(model_path, experiments, progress=None, **options):
+    """ Shortcut for MultiExperiment(model_path, **options).run(experiments, progress), see there. """
+    return MultiExperiment(model_path, **options).run(experiments, progress)
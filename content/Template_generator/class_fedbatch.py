@@ -1,4 +1,131 @@
+from dataclasses import dataclass, field
+
+import numpy as np
+
+
+PHASES = ("batch", "fedbatch", "constant")
+
+# The feeding starts at S <= substrate_limit + SUBSTRATE_LIMIT_OFFSET
+SUBSTRATE_LIMIT_OFFSET = 1e-6
+
+# Printed mode, keyed by which of t_const, t_fedbatch_start and substrate_limit are set
+MODES = {
+    (False, False, False): "Mode: Batch only",
+    (True, False, False): "Mode: Constant feed only",
+    (False, True, False): "Mode: Fedbatch only (start by time)",
+    (False, False, True): "Mode: Fedbatch only (start by substrate limit)",
+    (True, True, False): "Mode: Const. feed + fedbatch (by time)",
+    (True, False, True): "Mode: Const. feed + fedbatch (by substrate)",
+    (False, True, True): "Mode: Fedbatch (start by time or substrate)",
+    (True, True, True): "Mode: Const. feed + fedbatch (start by time or substrate)",
+}
+
+
+@dataclass(frozen=True)
+class FeedSchedule:
+    """
+    Feeding configuration without any state. Which phase applies is a pure function of the time, the substrate
+    and whether the feeding already started, so a schedule can be cached, shared between threads and sent to
+    worker processes. The phase changes are found by class_simulator (stop times and the substrate event).
+
+    Parameters:
+        t_const (float): start of the constant feed
+        substrate_limit (float): the fedbatch starts when the substrate falls below this value
+        t_fedbatch_start (float): start of the fedbatch
+    """
+    t_const: float = None
+    substrate_limit: float = None
+    t_fedbatch_start: float = None
+
+    @property
+    def threshold(self):
+        """ Substrate value at which the fedbatch starts (None without substrate_limit) """
+        return None if self.substrate_limit is None else self.substrate_limit + SUBSTRATE_LIMIT_OFFSET
+
+    @property
+    def mode(self):
+        return MODES[(self.t_const is not None, self.t_fedbatch_start is not None, self.substrate_limit is not None)]
+
+    def phase_at(self, t, S, feeding_started=False):
+        """ Phase at time t and substrate S: constant feed first, then fedbatch, else batch. A feed started by the
+        substrate limit stays on (no oscillation), a feed by time only is on from t_fedbatch_start.
+        """
+        if self.t_const is not None and t >= self.t_const:
+            return "constant"
+        if self.t_fedbatch_start is not None and t >= self.t_fedbatch_start:
+            return "fedbatch"
+        if self.substrate_limit is not None and (feeding_started or S <= self.threshold):
+            return "fedbatch"
+        return "batch"
+
+    def next_stop(self, phase, t, t_end):
+        """ Next time after t at which the phase ends at the latest (t_fedbatch_start, t_const or t_end) """
+        if phase == "batch":
+            candidates = [self.t_fedbatch_start, self.t_const]
+        elif phase == "fedbatch":
+            candidates = [self.t_const]
+        else:
+            candidates = []
+        return min([time for time in candidates if time is not None and t < time < t_end] + [t_end])
+
+    def state(self, phase, ts=None, X_fedbatch_start=None):
+        """ Immutable feed for the RHS in one phase (or an array with the phase of every time point) """
+        return FeedState(self, phase, ts, X_fedbatch_start)
+
+
+@dataclass(frozen=True, eq=False)
+class FeedState:
+    """
+    Feed as seen by dif_simple/algebra inside one phase: same attributes as Feed (batch, feeding_exp, ts, ...),
+    but immutable, get() changes nothing. With an array of phases the flags are boolean arrays (one entry per
+    time point), which is what the vectorized algebra of class_compiler needs. feeding_first is always False here,
+    the compiled model replaces it by feeding_exp & (t == ts), i.e. true at the start of the fed-batch phase.
+    The compiled model does not call feed.get(t, S, X) for a state (stateful is False).
+    """
+    stateful = False
+
+    schedule: FeedSchedule
+    phase: object = "batch"
+    ts: float = None
+    X_fedbatch_start: float = None
+    batch: object = field(init=False, repr=False)
+    feeding_first: object = field(init=False, repr=False)
+    feeding_exp: object = field(init=False, repr=False)
+    feeding_const: object = field(init=False, repr=False)
+
+    def __post_init__(self):
+        phase = self.phase if isinstance(self.phase, str) else np.asarray(self.phase)
+        if not np.isin(phase, PHASES).all():
+            raise ValueError(f"Unknown feeding phase '{phase}', use one of {PHASES}")
+        object.__setattr__(self, "batch", phase == "batch")
+        object.__setattr__(self, "feeding_first", np.zeros_like(self.batch) if not isinstance(phase, str) else False)
+        object.__setattr__(self, "feeding_exp", phase == "fedbatch")
+        object.__setattr__(self, "feeding_const", phase == "constant")
+
+    @property
+    def t_const(self):
+        return self.schedule.t_const
+
+    @property
+    def substrate_limit(self):
+        return self.schedule.substrate_limit
+
+    @property
+    def t_fedbatch_start(self):
+        return self.schedule.t_fedbatch_start
+
+    @property
+    def feeding_started(self):
+        return self.ts is not None
+
+    def get(self, t, S, X):
+        raise TypeError("A FeedState is fixed to one phase and can not be updated with get(t, S, X), use "
+                        "schedule.phase_at(t, S) or a Feed.")
+
+
 class Feed:
+    stateful = True  # get(t, S, X) changes the feed (see FeedState)
+
     def __init__(self, t_const=None, substrate_limit=None, t_fedbatch_start=None):
         self.t_const = t_const
         self.substrate_limit = substrate_limit
@@ -13,52 +140,72 @@ class Feed:
         self.feeding_exp = False
         self.feeding_first = False
 
+    @property
+    def schedule(self):
+        """ The (stateless) FeedSchedule of this feed """
+        return FeedSchedule(self.t_const, self.substrate_limit, self.t_fedbatch_start)
+
     def get(self, t, S, X):
+        """
+        Sets the flags for time t, substrate S and biomass X. This changes the feed (the first fedbatch call stores
+        ts and X_fedbatch_start), so the result depends on the order of the calls. class_simulator uses the
+        stateless schedule instead.
+        """
         # Reset all flags
         self.batch = False
         self.feeding_first = False
         self.feeding_exp = False
         self.feeding_const = False
 
-        # Priority 1: Constant feeding
-        if self.t_const is not None and t >= self.t_const:
+        phase = self.schedule.phase_at(t, S, self.feeding_started)
+        if phase == "constant":
             self.feeding_const = True
             return
+        if phase == "batch":
+            self.batch = True
+            return
 
-        # Priority 2: Check feeding conditions with hysteresis
-        feeding_should_start = False
-
-        if self.t_fedbatch_start is not None and t >= self.t_fedbatch_start:
-            feeding_should_start = True
-            if not self.feeding_started:
-                self.feeding_started = True  # Lock feeding ON
+        if not self.feeding_started:
+            self.feeding_started = True  # Lock feeding ON
+            if self.t_fedbatch_start is not None and t >= self.t_fedbatch_start:
                 print("Feeding started via time")
-
-        if self.substrate_limit is not None:
-            if not self.feeding_started:
-                # First time: check condition
-                if S <= (self.substrate_limit + 1e-6):
-                    feeding_should_start = True
-                    self.feeding_started = True  # Lock feeding ON
-                    print("Feeding started via substrate limit")
-                else:
-                    pass
             else:
-                # Once started, keep feeding (prevents oscillation)
-                feeding_should_start = True
-
-        # Priority 3: Set appropriate flag
-        if feeding_should_start:
-            if self.ts is None:
-                self.ts = t
-                self.X_fedbatch_start = X
-                self.feeding_first = True
-                print(f"Feeding started at time: {self.ts:.3f}")
-                print(f"Feeding started at Biomass: {self.X_fedbatch_start:.6f}")
-            else:
-                self.feeding_exp = True
+                print("Feeding started via substrate limit")
+
+        if self.ts is None:
+            self.ts = t
+            self.X_fedbatch_start = X
+            self.feeding_first = True
+            print(f"Feeding started at time: {self.ts:.3f}")
+            print(f"Feeding started at Biomass: {self.X_fedbatch_start:.6f}")
         else:
-            self.batch = True
+            self.feeding_exp = True
+
+    def set_phase(self, phase, ts=None, X_fedbatch_start=None):
+        """
+        Sets the feeding flags for one phase, as get() would do inside of it.
+
+        Parameters:
+            phase (str): "batch", "fedbatch" or "constant"
+            ts (float): time when the feeding started (fedbatch and constant phase)
+            X_fedbatch_start (float): Biomass at the feed start
+        """
+        state = self.locked(phase, ts, X_fedbatch_start)
+        self.batch = state.batch
+        self.feeding_first = state.feeding_first
+        self.feeding_exp = state.feeding_exp
+        self.feeding_const = state.feeding_const
+        if ts is not None:
+            self.ts = ts
+            self.X_fedbatch_start = X_fedbatch_start
+            self.feeding_started = True
+
+    def locked(self, phase, ts=None, X_fedbatch_start=None):
+        """
+        Returns an immutable FeedState of this feed in one phase (or with an array of phases, in the phase of every
+        time point). Used by class_simulator, which integrates every phase on its own.
+        """
+        return self.schedule.state(phase, ts, X_fedbatch_start)
 
     def get_pulse(self, x, pulse_amount, pulse_index):
         """
@@ -78,3 +225,4 @@ class Feed:
         # Apply  pulse to specific index 
         x[-1, pulse_index] += pulse_amount
         return x
+
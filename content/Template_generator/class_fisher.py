@@ -0,0 +1,172 @@
+import numpy as np
+
+
+# Eigenvalues of the (scaled) Fisher information matrix below DEFAULT_RCOND * largest eigenvalue are treated as zero
+# (the parameter combinations of these directions cannot be identified from the measurements)
+DEFAULT_RCOND = 1e-10
+
+# A parameter whose unit vector lies by more than this fraction (squared) in the directions left out is not
+# identifiable, its standard deviation is nan
+NULL_SPACE_LIMIT = 1e-2
+
+
+def parameter_bounds(names, values, parameters=None):
+    """ Bounds of the parameters as array of shape (n_params, 2): 'min' and 'max' of the parameters table, a missing
+    bound (None or no entry, e.g. for constants) is 0 or two times the value (empty bounds for the value 0, the fit
+    of class_estimation asks for 'min' and 'max' then).
+    """
+    parameters = {} if parameters is None else parameters
+    bounds = np.empty((len(names), 2))
+    for i, (name, value) in enumerate(zip(names, values)):
+        meta = parameters.get(name, {})
+        lower, upper = meta.get("min"), meta.get("max")
+        bounds[i, 0] = min(0.0, 2 * value) if lower is None else lower
+        bounds[i, 1] = max(0.0, 2 * value) if upper is None else upper
+    return bounds
+
+
+class FisherResult:
+    def __init__(self, names, values, bounds, matrix, scaled_inverse, rank, eigenvalues, identifiable):
+        """ Fisher information matrix (FIM) of some parameters and the covariance estimated with it.
+
+        :param names: names of the parameters
+        :param values: values of the parameters
+        :param bounds: bounds of the parameters, shape (n_params, 2)
+        :param matrix: FIM scaled with the parameter values (diag(p) FIM diag(p))
+        :param scaled_inverse: pseudo-inverse of matrix (covariance relative to the parameter values)
+        :param rank: number of eigenvalues of matrix that were used for the inversion
+        :param eigenvalues: eigenvalues of matrix (ascending)
+        :param identifiable: False for the parameters that lie in the left out directions
+        """
+        self.names = list(names)
+        self.values = np.asarray(values, dtype=float)
+        self.bounds = np.asarray(bounds, dtype=float)
+        self.matrix = matrix
+        self.scaled_inverse = scaled_inverse
+        self.rank = rank
+        self.eigenvalues = eigenvalues
+        self.identifiable = identifiable
+
+    @property
+    def inverse(self):
+        """ Covariance of the parameters (pseudo-inverse of the unscaled FIM) """
+        return self.scaled_inverse * np.outer(self.values, self.values)
+
+    @property
+    def std_dev(self):
+        """ Standard deviation of the parameters, nan if a parameter is not identifiable """
+        std_dev = np.sqrt(np.clip(np.diag(self.scaled_inverse), 0, None)) * np.abs(self.values)
+        return np.where(self.identifiable, std_dev, np.nan)
+
+    @property
+    def log_det(self):
+        """ log(det) of the scaled FIM (D-criterion of experimental design), -inf if it is singular """
+        if self.rank < len(self.names):
+            return -np.inf
+        return float(np.sum(np.log(self.eigenvalues)))
+
+    def fill(self, allthedata):
+        """ Fills allthedata['statistics']['fisher'] in the layout cplt.PlotPlotly.plot_covariance(cov_method='fisher')
+        uses (normalized: relative position in / relative to the range of the parameter bounds). Returns allthedata.
+        """
+        width = self.bounds[:, 1] - self.bounds[:, 0]
+        width = np.where(width > 0, width, 1.0)
+        statistics = allthedata.setdefault("statistics", {})
+        statistics["fisher"] = {
+            "params_names": self.names,
+            "params_value": self.values[:, None],
+            "params_value (normalized)": ((self.values - self.bounds[:, 0]) / width)[:, None],
+            "params_bounds": self.bounds,
+            "fisher_matrix (scaled)": self.matrix,
+            "inverse_matrix": self.inverse,
+            "inverse_matrix (scaled)": self.scaled_inverse,
+            "std_dev": self.std_dev[:, None],
+            "std_dev (normalized)": (self.std_dev / width)[:, None],
+            "rank": self.rank,
+            "identifiable": self.identifiable,
+        }
+        return allthedata
+
+
+class FisherInformation:
+    def __init__(self, allthedata, names, values, bounds=None, measurement_times=None, rcond=DEFAULT_RCOND):
+        """ Fisher information matrix from the sensitivity_matrix of allthedata (see class_sensitivity), evaluated at
+        the measurement times only.
+
+        Every measured value of a state contributes (weight * d state / d p * p / std)^2: 'weight' and 'std' of
+        allthedata['variables'] are used ('std' can be one value or one value per time in 'times' of the variable,
+        an empty 'std' is 1). Everything that does not depend on the sensitivities (interpolation to the measurement
+        times, standard deviations) is prepared here, so compute can be called in a loop, e.g. for experimental
+        design with new sensitivity matrices.
+
+        :param allthedata: allthedata dict of one experiment, filled by class_sensitivity.SensitivityResult.fill
+        :param names: names of the parameters (the columns of the sensitivity_matrix)
+        :param values: values of the parameters
+        :param bounds: bounds of the parameters, shape (n_params, 2), see parameter_bounds for the default
+        :param measurement_times: defaults to allthedata['measurement_times'], all simulated times if it is empty
+        :param rcond: relative limit for the eigenvalues used in the pseudo-inversion
+        """
+        self.names = list(names)
+        self.values = np.asarray(values, dtype=float)
+        self.bounds = parameter_bounds(self.names, self.values) if bounds is None else np.asarray(bounds, float)
+        self.rcond = rcond
+
+        simulation_data = allthedata["simulation_data"]
+        self.t = np.asarray(simulation_data["times"], dtype=float)
+        self.states = list(simulation_data["sensitivities"])
+        if measurement_times is None:
+            measurement_times = allthedata.get("measurement_times")
+        if measurement_times is None or len(measurement_times) == 0:
+            measurement_times = self.t
+        self.measurement_times = np.asarray(measurement_times, dtype=float)
+        if np.any(self.measurement_times < self.t[0]) or np.any(self.measurement_times > self.t[-1]):
+            raise ValueError(f"The measurement times must be between {self.t[0]} and {self.t[-1]} (simulated times).")
+
+        # Linear interpolation of the sensitivities: row k is (1 - fraction) * row lower + fraction * row lower + 1
+        self.lower = np.clip(np.searchsorted(self.t, self.measurement_times, side="right") - 1, 0, len(self.t) - 2)
+        self.fraction = ((self.measurement_times - self.t[self.lower]) / np.diff(self.t)[self.lower])[:, None, None]
+
+        std = np.ones((len(self.measurement_times), len(self.states)))
+        for i, state in enumerate(self.states):
+            meta = allthedata["variables"][state]
+            state_std = np.atleast_1d(np.asarray(meta.get("std", []), dtype=float))
+            if state_std.size == 1:
+                std[:, i] = state_std[0]
+            elif state_std.size > 1:
+                std[:, i] = np.interp(self.measurement_times, np.asarray(meta["times"], dtype=float), state_std)
+        self.inv_std = (1 / std)[:, :, None]
+
+    def compute(self, sensitivity_matrix):
+        """ FIM and covariance for a sensitivity_matrix (layout of allthedata['simulation_data']['sensitivity_matrix'],
+        shape (len(t) * n_states, n_params)), returns a FisherResult.
+        """
+        S = np.asarray(sensitivity_matrix, dtype=float).reshape(len(self.t), len(self.states), len(self.names))
+        S_measured = (1 - self.fraction) * S[self.lower] + self.fraction * S[self.lower + 1]
+        A = (S_measured * self.inv_std).reshape(-1, len(self.names))
+        matrix = A.T @ A
+
+        # Pseudo-inverse of the symmetric matrix with its eigenvalues: directions with eigenvalues close to zero (not
+        # identifiable) are left out instead of being inverted to huge numbers
+        eigenvalues, eigenvectors = np.linalg.eigh(matrix)
+        keep = (eigenvalues > self.rcond * eigenvalues[-1]) & (eigenvalues > 0)
+        scaled_inverse = (eigenvectors[:, keep] / eigenvalues[keep]) @ eigenvectors[:, keep].T
+        identifiable = np.sum(eigenvectors[:, ~keep] ** 2, axis=1) <= NULL_SPACE_LIMIT
+        return FisherResult(self.names, self.values, self.bounds, matrix, scaled_inverse, int(keep.sum()),
+                            eigenvalues, identifiable)
+
+
+def fisher_information(sensitivity, allthedata, parameters=None, **options):
+    """ FIM of the parameters of a class_sensitivity.SensitivityResult that was filled into allthedata, fills
+    allthedata['statistics']['fisher'] and returns the FisherResult.
+
+    :param parameters: parameters table with 'min' and 'max' for the bounds (see parameter_bounds)
+    :param options: measurement_times and rcond of FisherInformation
+    """
+    bounds = parameter_bounds(sensitivity.names, sensitivity.values, parameters)
+    fisher = FisherInformation(allthedata, sensitivity.names, sensitivity.values, bounds, **options)
+    result = fisher.compute(allthedata["simulation_data"]["sensitivity_matrix"])
+    result.fill(allthedata)
+    if not np.all(result.identifiable):
+        print(f"⚠️ Warning: the measurements do not contain enough information for "
+              f"{[name for name, ok in zip(result.names, result.identifiable) if not ok]} (standard deviation nan).")
+    return result
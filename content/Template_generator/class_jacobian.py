@@ -0,0 +1,391 @@
+import ast
+import copy
+import itertools
+import re
+
+import numpy as np
+import sympy as sp
+from sympy.printing.pycode import PythonCodePrinter
+
+import class_compiler as ccm
+
+
+JACOBIAN_SUFFIX = "_jacobian"
+JACOBIAN_MATRIX = "_J"
+PARAMETER_MATRIX = "_P"
+SENSITIVITY_SUFFIX = "_sensitivity"
+DERIVATIVE_PREFIX = "_d_"
+BRANCH_LIST = "_branches"
+
+# Functions of dif_simple (from math import exp, np.exp, builtins) and their sympy counterparts
+SYMPY_FUNCTIONS = {
+    "exp": sp.exp, "log": sp.log, "sqrt": sp.sqrt, "sin": sp.sin, "cos": sp.cos, "tan": sp.tan, "tanh": sp.tanh,
+    "sinh": sp.sinh, "cosh": sp.cosh, "atan": sp.atan, "arctan": sp.atan, "abs": sp.Abs, "fabs": sp.Abs,
+    "pow": sp.Pow, "power": sp.Pow, "min": sp.Min, "max": sp.Max, "minimum": sp.Min, "maximum": sp.Max,
+    "log10": lambda x: sp.log(x, 10), "log2": lambda x: sp.log(x, 2),
+}
+
+COMPARISONS = {ast.Lt: sp.Lt, ast.LtE: sp.Le, ast.Gt: sp.Gt, ast.GtE: sp.Ge, ast.Eq: sp.Eq, ast.NotEq: sp.Ne}
+OPERATORS = {ast.Add: lambda a, b: a + b, ast.Sub: lambda a, b: a - b, ast.Mult: lambda a, b: a * b,
+             ast.Div: lambda a, b: a / b, ast.Pow: lambda a, b: a ** b}
+
+
+class _Unsupported(Exception):
+    pass
+
+
+class _Printer(PythonCodePrinter):
+    """ Python code of the derivatives (math functions as math.exp, ...) """
+
+    def __init__(self):
+        super().__init__({"fully_qualified_modules": True, "strict": True})
+
+
+class _Derivatives:
+    """ Forward differentiation of dif_simple statement by statement: before every assignment v = expr the
+    derivatives _d_v_j = d v / d x[j] are assigned (only those that are not zero), if/else blocks keep their
+    structure.
+    """
+
+    def __init__(self, state_arg, parameters=()):
+        self.state_arg = state_arg
+        # Globals (_bound_3, feed.ts) to differentiate by as well, their derivatives have the keys p0, p1, ...
+        self.parameters = {source: f"p{k}" for k, source in enumerate(parameters)}
+        self.gradients = {}      # name -> {state: derivative (symbol of the _d_ variable or number)}
+        self.assignments = {}    # name -> number of assignments in the function
+        self.lists = {}          # name -> elements of a list (dxdt = [dXdt, dSdt, ...])
+        self.placeholders = {}   # symbol name -> source code of attribute reads (feed.ts)
+        self.n_states = 0
+        self.printer = _Printer()
+        self.sources = {}        # sympy expression -> code (the statements are derived again until structure is stable)
+
+    # -----------------------------
+    # Expressions
+    # -----------------------------
+    def symbol(self, name):
+        return sp.Symbol(name, real=True)
+
+    def expression(self, node):
+        """ sympy expression of an ast expression """
+        if isinstance(node, ast.Constant):
+            if isinstance(node.value, bool) or not isinstance(node.value, (int, float)):
+                raise _Unsupported(f"constant {node.value!r}")
+            return sp.Integer(node.value) if isinstance(node.value, int) else sp.Float(node.value, 17)
+        if isinstance(node, ast.Name):
+            return self.symbol(node.id)
+        if isinstance(node, ast.Attribute):
+            source = ast.unparse(node)
+            name = f"_attribute_{len(self.placeholders)}"
+            name = next((key for key, value in self.placeholders.items() if value == source), name)
+            self.placeholders[name] = source
+            return self.symbol(name)
+        if (isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name) and node.value.id == self.state_arg
+                and isinstance(node.slice, ast.Constant) and isinstance(node.slice.value, int)):
+            return self.state(node.slice.value)
+        if isinstance(node, ast.BinOp) and type(node.op) in OPERATORS:
+            return OPERATORS[type(node.op)](self.expression(node.left), self.expression(node.right))
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+            operand = self.expression(node.operand)
+            return -operand if isinstance(node.op, ast.USub) else operand
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+            return sp.Not(self.expression(node.operand))
+        if isinstance(node, ast.Call) and not node.keywords:
+            func = node.func
+            name = func.attr if isinstance(func, ast.Attribute) else getattr(func, "id", None)
+            if name in SYMPY_FUNCTIONS:
+                return SYMPY_FUNCTIONS[name](*[self.expression(arg) for arg in node.args])
+        if isinstance(node, ast.IfExp):
+            return sp.Piecewise((self.expression(node.body), self.expression(node.test)),
+                                (self.expression(node.orelse), True))
+        if isinstance(node, ast.Compare):
+            terms = [self.expression(operand) for operand in [node.left] + node.comparators]
+            relations = []
+            for op, left, right in zip(node.ops, terms, terms[1:]):
+                if type(op) not in COMPARISONS:
+                    raise _Unsupported(ast.unparse(node))
+                relations.append(COMPARISONS[type(op)](left, right))
+            return sp.And(*relations)
+        if isinstance(node, ast.BoolOp):
+            values = [self.expression(value) for value in node.values]
+            return sp.And(*values) if isinstance(node.op, ast.And) else sp.Or(*values)
+        raise _Unsupported(ast.unparse(node))
+
+    def state(self, i):
+        self.n_states = max(self.n_states, i + 1)
+        return self.symbol(f"_state_{i}")
+
+    def depends_on_states(self, test):
+        """ True if the value of an if test can change with the states """
+        try:
+            symbols = self.expression(test).free_symbols
+        except _Unsupported:
+            return False
+        return any(symbol.name.startswith("_state_") or any(isinstance(j, int) for j in self.gradients.get(
+            symbol.name, {})) for symbol in symbols)
+
+    def gradient(self, expr):
+        """ d expr / d x as {state: sympy expression} without the zeros """
+        gradient = {}
+        for symbol in expr.free_symbols:
+            if symbol.name.startswith("_state_"):
+                chain = {int(symbol.name[len("_state_"):]): sp.Integer(1)}
+            elif self.placeholders.get(symbol.name, symbol.name) in self.parameters:
+                chain = {self.parameters[self.placeholders.get(symbol.name, symbol.name)]: sp.Integer(1)}
+            else:
+                chain = self.gradients.get(symbol.name, {})
+            if not chain:
+                continue
+            partial = sp.diff(expr, symbol)
+            if partial == 0:
+                continue
+            for j, derivative in chain.items():
+                gradient[j] = gradient.get(j, 0) + partial * derivative
+        return {j: value for j, value in gradient.items() if value != 0}
+
+    def code(self, expr):
+        if expr not in self.sources:
+            source = self.printer.doprint(expr)
+            source = re.sub(r"\b_attribute_\d+\b", lambda match: self.placeholders[match.group()], source)
+            self.sources[expr] = re.sub(r"\b_state_(\d+)\b", lambda match: f"_{self.state_arg}_{match.group(1)}",
+                                        source)
+        return self.sources[expr]
+
+    # -----------------------------
+    # Statements
+    # -----------------------------
+    def count_assignments(self, statements):
+        for node in itertools.chain.from_iterable(ast.walk(stmt) for stmt in statements):
+            if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Store):
+                self.assignments[node.id] = self.assignments.get(node.id, 0) + 1
+
+    def assign(self, name, expr, structure):
+        """ Statements for the derivatives of name = expr. structure: states in which name can depend on x """
+        gradient = self.gradient(expr)
+        lines = []
+        if self.assignments.get(name, 0) > 1:
+            # Assigned more than once (if/else): every branch assigns all derivatives the name can have
+            for j in sorted(structure.get(name, set()) | set(gradient), key=_order):
+                lines.append(f"{DERIVATIVE_PREFIX}{name}_{j} = {self.code(gradient.get(j, sp.Integer(0)))}")
+            self.gradients[name] = {j: self.symbol(f"{DERIVATIVE_PREFIX}{name}_{j}")
+                                    for j in structure.get(name, set()) | set(gradient)}
+        else:
+            self.gradients[name] = {}
+            for j, derivative in gradient.items():
+                if derivative.is_number:
+                    self.gradients[name][j] = derivative
+                else:
+                    lines.append(f"{DERIVATIVE_PREFIX}{name}_{j} = {self.code(derivative)}")
+                    self.gradients[name][j] = self.symbol(f"{DERIVATIVE_PREFIX}{name}_{j}")
+        structure.setdefault(name, set()).update(gradient)
+        return [ast.parse(line).body[0] for line in lines]
+
+    def statements(self, statements, structure):
+        body = []
+        for stmt in statements:
+            if isinstance(stmt, ast.Assign) and len(stmt.targets) == 1 and isinstance(stmt.targets[0], ast.Name):
+                name = stmt.targets[0].id
+                if name != self.state_arg and isinstance(stmt.value, (ast.List, ast.Tuple)):
+                    self.lists[name] = stmt.value.elts
+                elif name != self.state_arg:  # not x = x.tolist()
+                    # The derivatives come first, they need the values before the assignment (e.g. for v = v * s)
+                    body.extend(self.assign(name, self.expression(stmt.value), structure))
+                body.append(stmt)
+            elif isinstance(stmt, ast.AugAssign) and isinstance(stmt.target, ast.Name) \
+                    and type(stmt.op) in OPERATORS:
+                name = stmt.target.id
+                value = OPERATORS[type(stmt.op)](self.symbol(name), self.expression(stmt.value))
+                body.extend(self.assign(name, value, structure))
+                body.append(stmt)
+            elif isinstance(stmt, ast.If):
+                if self.parameters and self.depends_on_states(stmt.test):
+                    # The sensitivities record the tests that can switch with the states (see SensitivityJacobian)
+                    body.append(ast.parse(f"{BRANCH_LIST}.append(bool({ast.unparse(stmt.test)}))").body[0])
+                gradients = dict(self.gradients)
+                if_body = self.statements(stmt.body, structure) or [ast.Pass()]
+                after_body = self.gradients
+                self.gradients = gradients
+                orelse = self.statements(stmt.orelse, structure)
+                for name, gradient in after_body.items():
+                    self.gradients[name] = {**self.gradients.get(name, {}), **gradient}
+                body.append(ast.If(test=stmt.test, body=if_body, orelse=orelse))
+            elif isinstance(stmt, ast.Expr) and isinstance(stmt.value, ast.Call):
+                body.append(stmt)  # e.g. feed.get(t, S, X), does not change the states
+            elif isinstance(stmt, ast.Pass):
+                continue
+            elif isinstance(stmt, ast.Return) and stmt.value is not None:
+                body.extend(self.matrix(stmt.value))
+            else:
+                raise _Unsupported(ast.unparse(stmt).splitlines()[0])
+        return body
+
+    def matrix(self, value):
+        """ Statements that fill and return the Jacobian from the returned list of derivatives """
+        if isinstance(value, ast.Name) and value.id in self.lists:
+            elements = self.lists[value.id]
+        elif isinstance(value, (ast.List, ast.Tuple)):
+            elements = value.elts
+        else:
+            raise _Unsupported(f"return {ast.unparse(value)}")
+        self.n_states = max(self.n_states, len(elements))
+        self.rows = len(elements)
+        if self.parameters:
+            return self.sensitivity(elements)
+        lines = [f"{JACOBIAN_MATRIX} = _np.zeros(({len(elements)}, {len(elements)}))"]
+        self.entries = set()
+        for i, element in enumerate(elements):
+            for j, derivative in sorted(self.gradient(self.expression(element)).items()):
+                lines.append(f"{JACOBIAN_MATRIX}[{i}, {j}] = {self.code(derivative)}")
+                self.entries.add((i, j))
+        lines.append(f"return {JACOBIAN_MATRIX}")
+        return [ast.parse(line).body[0] for line in lines]
+
+    def sensitivity(self, elements):
+        """ Statements that return the derivatives, the Jacobian and the derivatives by the parameters """
+        n_states = len(elements)
+        columns = {f"p{k}": k for k in range(len(self.parameters))}
+        lines = [f"{JACOBIAN_MATRIX} = _np.zeros(({n_states}, {n_states}))",
+                 f"{PARAMETER_MATRIX} = _np.zeros(({n_states}, {len(columns)}))"]
+        self.entries = set()
+        for i, element in enumerate(elements):
+            gradient = self.gradient(self.expression(element))
+            for j in sorted(gradient, key=_order):
+                if j in columns:
+                    lines.append(f"{PARAMETER_MATRIX}[{i}, {columns[j]}] = {self.code(gradient[j])}")
+                else:
+                    lines.append(f"{JACOBIAN_MATRIX}[{i}, {j}] = {self.code(gradient[j])}")
+                    self.entries.add((i, j))
+        values = ", ".join(ast.unparse(element) for element in elements)
+        lines.append(f"return _np.array([{values}], dtype=float), {JACOBIAN_MATRIX}, {PARAMETER_MATRIX}, "
+                     f"tuple({BRANCH_LIST})")
+        return [ast.parse(line).body[0] for line in lines]
+
+
+def _order(key):
+    """ Sort key of the derivatives: states (numbers) first, then parameters (p0, p1, ...) """
+    return (0, key) if isinstance(key, int) else (1, int(key[1:]))
+
+
+def _derive(model, name, parameters=()):
+    """ (_Derivatives, function def) of the derivatives of dif_simple of a compiled model, see SymbolicJacobian """
+    rhs_def = next(func_def for func_def in model._defs if func_def.name == model.rhs_name)
+    state_arg = rhs_def.args.args[0].arg
+    derivatives = _Derivatives(state_arg, parameters)
+    derivatives.count_assignments(rhs_def.body)
+    try:
+        # Repeated until every name has all states it can depend on (in any branch), so that every branch
+        # assigns the same derivatives
+        structure = {}
+        for _ in range(len(rhs_def.body) + 1):
+            before = {key: set(value) for key, value in structure.items()}
+            derivatives.gradients = {}
+            body = derivatives.statements(rhs_def.body, structure)
+            if structure == before:
+                break
+    except _Unsupported as error:
+        raise ValueError(f"dif_simple can not be differentiated symbolically ({error}).") from None
+    if not hasattr(derivatives, "entries"):
+        raise ValueError("dif_simple does not return its derivatives.")
+
+    reads = [ast.parse(f"_{state_arg}_{i} = {state_arg}[{i}]").body[0] for i in range(derivatives.n_states)]
+    if parameters:
+        reads.append(ast.parse(f"{BRANCH_LIST} = []").body[0])
+    first = 1 if body and isinstance(body[0], ast.If) and "tolist" in ast.unparse(body[0]) else 0
+    func_def = copy.deepcopy(rhs_def)
+    func_def.name = name
+    func_def.decorator_list = []
+    func_def.body = body[:first] + reads + body[first:]
+    return derivatives, func_def
+
+
+class SymbolicJacobian:
+    def __init__(self, model):
+        """ Jacobian d dif_simple / d x of a compiled model, derived symbolically (sympy) from the code of dif_simple
+        (with algebra inlined and the table lookups bound, see class_compiler).
+
+        The derivatives follow the statements of dif_simple: every if/else block (feed phases, overflow switches)
+        stays a block and the branch taken at x is differentiated, min/max and conditional expressions are
+        differentiated piecewise. Only the entries that are not always zero are calculated (sparsity).
+
+        :param model: class_compiler.CompiledModel (any copy, the function is bound to a model by bind)
+        :raises ValueError: if dif_simple uses something that can not be differentiated (e.g. loops or calls of
+                            unknown functions)
+        """
+        derivatives, jac_def = _derive(model, model.rhs_name + JACOBIAN_SUFFIX)
+        n_states = derivatives.rows
+        self.name = jac_def.name
+        self.function_def = ast.fix_missing_locations(jac_def)
+        self.n_states = n_states
+        self.sparsity = np.zeros((n_states, n_states), dtype=bool)
+        for i, j in derivatives.entries:
+            self.sparsity[i, j] = True
+        self.n_bindings = len(model.bindings)
+        self.namespace = model.namespace
+        self._factories = {}
+
+    @property
+    def source(self):
+        return ast.unparse(self.function_def)
+
+    def bind(self, model):
+        """ Jacobian function jac(x, t) (shape (n_states, n_states), row = derivative) for the values and globals
+        bound in model (a copy of the model the Jacobian was derived from, e.g. after with_values or bind).
+        """
+        names = tuple(sorted(model.env))
+        if names not in self._factories:
+            source = ccm._build_factory_source([self.function_def], [self.name], self.n_bindings, names)
+            source = source.replace("    import numpy as _np\n", "    import numpy as _np\n    import math\n", 1)
+            self._factories[names] = ccm._make_factory(source, self.namespace, self.name)
+        return self._factories[names](model.values, model.env)
+
+
+class SensitivityJacobian:
+    def __init__(self, model, parameters):
+        """ dif_simple with its derivatives by the states and by parameters, derived like SymbolicJacobian: one
+        function returns (f, d f / d x, d f / d p, branches) with the shapes (n_states,), (n_states, n_states) and
+        (n_states, len(parameters)), all that the forward sensitivities d(dx/dp)/dt = df/dx dx/dp + df/dp need
+        (class_sensitivity). branches are the values of the if tests that depend on the states (e.g. the overflow
+        switch), in the order they were reached: where they change, dif_simple can jump, which the sensitivities
+        do not follow.
+
+        :param model: class_compiler.CompiledModel (any copy, the function is bound to a model by bind)
+        :param parameters: globals of the compiled dif_simple to differentiate by, as they appear in its code: bound
+                           values (f"_bound_{model.index[name]}") or feed attributes ("feed.ts"), without repetitions
+        :raises ValueError: if dif_simple can not be differentiated (see SymbolicJacobian)
+        """
+        self.parameters = list(dict.fromkeys(parameters))
+        derivatives, func_def = _derive(model, model.rhs_name + SENSITIVITY_SUFFIX, parameters=self.parameters)
+        self.function_def = ast.fix_missing_locations(func_def)
+        self.n_states = derivatives.rows
+        self.n_bindings = len(model.bindings)
+        self.namespace = model.namespace
+        self._factories = {}
+
+    @property
+    def source(self):
+        return ast.unparse(self.function_def)
+
+    def bind(self, model):
+        """ Function (x, t) -> (f, df/dx, df/dp, branches) for the values and globals bound in model (see
+        SymbolicJacobian.bind)
+        """
+        names = tuple(sorted(model.env))
+        if names not in self._factories:
+            source = ccm._build_factory_source([self.function_def], [self.function_def.name], self.n_bindings, names)
+            source = source.replace("    import numpy as _np\n", "    import numpy as _np\n    import math\n", 1)
+            self._factories[names] = ccm._make_factory(source, self.namespace, self.function_def.name)
+        return self._factories[names](model.values, model.env)
+
+
+def symbolic_jacobian(model, verbose=True):
+    """ SymbolicJacobian of a model (dif_simple or class_compiler.CompiledModel), None (with a warning if verbose)
+    if dif_simple can not be differentiated.
+    """
+    compiled = ccm.compiled(model)
+    if compiled is None:
+        return None
+    try:
+        return SymbolicJacobian(compiled)
+    except ValueError as error:
+        if verbose:
+            print(f"⚠️ Warning: {error} The Jacobian is estimated by the solver.")
+        return None
@@ -0,0 +1,183 @@
+import ast
+import builtins
+import copy
+import math
+
+import numpy as np
+
+import class_compiler as ccm
+import class_fedbatch as cfb
+
+try:
+    import numba
+except ImportError:  # e.g. the Pyodide kernel of JupyterLite
+    numba = None
+
+
+JIT_SUFFIX = "_jit"
+
+# Integer code of the feeding phases inside the jitted RHS
+PHASE_CODES = {phase: code for code, phase in enumerate(cfb.PHASES)}
+
+# Arguments after (x, t): bound values, phase code, feed start time and biomass at the feed start
+VALUES_ARG, PHASE_ARG, TS_ARG, X_START_ARG = "_p", "_phase", "_ts", "_X_fedbatch_start"
+SIGNATURE = "float64[:](float64[:], float64, float64[:], int64, float64, float64)"
+
+
+class _Unsupported(Exception):
+    pass
+
+
+class _JitTransformer(ast.NodeTransformer):
+    """ Rewrites the compiled dif_simple into a function of arrays and numbers only (what numba.njit accepts):
+    _bound_<i> -> _p[i], feed.batch -> _phase == 0, feed.ts -> _ts, (if feed.stateful:) feed.get(...) is left out.
+    """
+
+    def __init__(self, feed_name):
+        self.feed_name = feed_name
+        self.flags = {"batch": PHASE_CODES["batch"], "feeding_exp": PHASE_CODES["fedbatch"],
+                      "feeding_const": PHASE_CODES["constant"]}
+
+    def visit_If(self, node):
+        if "tolist" in ast.unparse(node.test) or "_ndarray" in ast.unparse(node.test):
+            return None  # if x.__class__ is _ndarray: x = x.tolist()
+        if ast.unparse(node.test) == f"{self.feed_name}.stateful":
+            return None  # if feed.stateful: feed.get(t, S, X)
+        return self.generic_visit(node)
+
+    def visit_Expr(self, node):
+        if isinstance(node.value, ast.Call) and ast.unparse(node.value.func) == f"{self.feed_name}.get":
+            return None
+        return self.generic_visit(node)
+
+    def visit_Attribute(self, node):
+        if isinstance(node.value, ast.Name) and node.value.id == self.feed_name:
+            if node.attr in self.flags:
+                return ast.Compare(ast.Name(PHASE_ARG, ast.Load()), [ast.Eq()], [ast.Constant(self.flags[node.attr])])
+            if node.attr == "feeding_first":
+                return ast.Constant(False)
+            if node.attr in ("ts", "X_fedbatch_start"):
+                return ast.Name(TS_ARG if node.attr == "ts" else X_START_ARG, ast.Load())
+            raise _Unsupported(f"{self.feed_name}.{node.attr}")
+        return self.generic_visit(node)
+
+    def visit_Name(self, node):
+        prefix = f"{ccm.BOUND_VECTOR}_"
+        if node.id.startswith(prefix) and node.id[len(prefix):].isdigit():
+            return ast.Subscript(ast.Name(VALUES_ARG, ast.Load()), ast.Constant(int(node.id[len(prefix):])),
+                                 ast.Load())
+        if node.id == self.feed_name:
+            raise _Unsupported(f"{self.feed_name} is used as a whole")
+        return node
+
+    def visit_Return(self, node):
+        node.value = ast.Call(ast.Attribute(ast.Name("_np", ast.Load()), "array", ast.Load()),
+                              [self.visit(node.value)], [ast.keyword("dtype", ast.Attribute(
+                                  ast.Name("_np", ast.Load()), "float64", ast.Load()))])
+        return node
+
+
+def _names_assigned_in_ifs(statements, inside=False):
+    names = []
+    for stmt in statements:
+        if isinstance(stmt, ast.If):
+            names += _names_assigned_in_ifs(stmt.body + stmt.orelse, True)
+        elif inside and isinstance(stmt, (ast.Assign, ast.AugAssign)):
+            targets = stmt.targets if isinstance(stmt, ast.Assign) else [stmt.target]
+            names += [target.id for target in targets if isinstance(target, ast.Name)]
+    return list(dict.fromkeys(names))
+
+
+class JitModel:
+    def __init__(self, model, feed_name="feed", use_numba=True):
+        """ dif_simple of a compiled model as a function of arrays and numbers only, compiled with numba.njit:
+
+            rhs(x, t, p, phase, ts, X_fedbatch_start) with the bound values p (CompiledModel.values) as float64
+            vector and the feeding phase as integer code (PHASE_CODES)
+
+        The function is derived from the compiled dif_simple (algebra inlined, table lookups bound, see
+        class_compiler), so the notebook code does not change. bind gives the usual rhs(x, t) for one model and
+        feed phase, without numba it is the Python version of the same code.
+
+        The solver still calls the function from Python at every step: numba removes the time of the body of
+        dif_simple, not the call itself (about 1-2 us, as much as the whole compiled Python RHS of the library
+        models). It is worth it for models with a long dif_simple, benchmarks/bench_jit.py shows both parts.
+
+        :param model: class_compiler.CompiledModel (any copy, the values are passed by bind)
+        :param feed_name: global name of the feed inside dif_simple
+        :param use_numba: compile with numba if it is installed (False: the Python version, e.g. for debugging)
+        :raises ValueError: if dif_simple uses something the rewrite does not support (e.g. other feed attributes)
+        """
+        rhs_def = next(func_def for func_def in model._defs if func_def.name == model.rhs_name)
+        jit_def = copy.deepcopy(rhs_def)
+        try:
+            jit_def = _JitTransformer(feed_name).visit(jit_def)
+        except _Unsupported as error:
+            raise ValueError(f"dif_simple can not be compiled with numba ({error}).") from None
+        # Names that are only assigned in some branches start as 0.0 (numba needs a value on every path)
+        defaults = [ast.parse(f"{name} = 0.0").body[0] for name in _names_assigned_in_ifs(jit_def.body)]
+        jit_def.body = defaults + jit_def.body
+        jit_def.name = model.rhs_name + JIT_SUFFIX
+        jit_def.decorator_list = []
+        jit_def.args.args = jit_def.args.args[:2] + [ast.arg(name) for name in (VALUES_ARG, PHASE_ARG, TS_ARG,
+                                                                                  X_START_ARG)]
+        self.function_def = ast.fix_missing_locations(jit_def)
+        self.source = ast.unparse(self.function_def)
+
+        # Globals: numpy and the functions/numbers of the notebook that dif_simple uses (exp, ...)
+        assigned = {node.id for node in ast.walk(jit_def) if isinstance(node, ast.Name)
+                    and isinstance(node.ctx, ast.Store)} | {arg.arg for arg in jit_def.args.args}
+        namespace = {"_np": np, "math": math}
+        for node in ast.walk(jit_def):
+            if isinstance(node, ast.Name) and node.id not in assigned and node.id in model.namespace \
+                    and not hasattr(builtins, node.id):
+                namespace[node.id] = model.namespace[node.id]
+        exec(compile(self.source, f"<jit {jit_def.name}>", "exec"), namespace)
+        self.python_function = namespace[jit_def.name]
+
+        self.function = self.python_function
+        self.backend = "python"
+        if use_numba and numba is not None:
+            try:
+                self.function = numba.njit(SIGNATURE, error_model="numpy", cache=False)(self.python_function)
+                self.backend = "numba"
+            except Exception as error:  # numba reports unsupported code when compiling
+                raise ValueError(f"dif_simple can not be compiled with numba ({type(error).__name__}).") from None
+
+    def bind(self, values, feed_state):
+        """ JitRhs (rhs(x, t)) for the bound values (CompiledModel.values) and a cfb.FeedState of one phase """
+        ts = np.nan if feed_state.ts is None else float(feed_state.ts)
+        X_fedbatch_start = np.nan if feed_state.X_fedbatch_start is None else float(feed_state.X_fedbatch_start)
+        return JitRhs(self.function, (np.asarray(values, dtype=float), PHASE_CODES[feed_state.phase], ts,
+                                      X_fedbatch_start))
+
+
+class JitRhs:
+    def __init__(self, function, args):
+        """ rhs(x, t) of a JitModel for one phase. The simulator passes function and args to the solver
+        (odeint(function, x0, t, args=args)), so the solver calls the compiled function without a Python function
+        and conversions in between. Calling the object itself converts x and t first (e.g. for a list of states).
+
+        :param function: compiled function(x, t, p, phase, ts, X_fedbatch_start)
+        :param args: (p, phase, ts, X_fedbatch_start) of the phase
+        """
+        self.function = function
+        self.args = args
+
+    def __call__(self, x, t):
+        return self.function(np.asarray(x, dtype=float), float(t), *self.args)
+
+
+def jit_model(model, feed_name="feed", verbose=True):
+    """ JitModel of a model (dif_simple or class_compiler.CompiledModel) if numba is installed, else None (the
+    simulator then uses the compiled Python RHS as before). None with a warning if dif_simple can not be compiled.
+    """
+    compiled = ccm.compiled(model)
+    if numba is None or compiled is None:
+        return None
+    try:
+        return JitModel(compiled, feed_name)
+    except ValueError as error:
+        if verbose:
+            print(f"⚠️ Warning: {error} The Python RHS is used.")
+        return None
@@ -0,0 +1,232 @@
+import contextlib
+import hashlib
+import itertools
+import json
+import os
+
+import numpy as np
+
+
+# Lines parsed at once (100000 rows of 1 s sensor data are ~28 h, only the kept rows stay in memory)
+CHUNK_ROWS = 100_000
+
+# Parsed files are cached next to them, like class_spec caches compiled models
+CACHE_FOLDER = "__pycache__"
+CACHE_VERSION = 1
+
+
+class Measurements:
+    def __init__(self, t, values, columns, path=None):
+        """ Measured data read by read_measurements.
+
+        :param t: time points
+        :param values: one column per name of columns (rows as t)
+        :param columns: names of the columns of values
+        :param path: file the data was read from
+        """
+        self.t = t
+        self.values = values
+        self.columns = columns
+        self.path = path
+
+    def __len__(self):
+        return len(self.t)
+
+    def column(self, name):
+        """ Values of one column """
+        return self.values[:, self.columns.index(name)]
+
+    def build_kwargs(self):
+        """ data, columns and t_data for catd.AllthedataBuilder.build (or an experiment of class_experiments) """
+        return dict(data=self.values, columns=self.columns, t_data=self.t)
+
+
+def _conversion_factors(conversion, columns):
+    """ Factor of every column: conversion has factors by name or is a variables table (its 'conversion_factor') """
+    factors = np.ones(len(columns))
+    for name, factor in (conversion or {}).items():
+        if isinstance(factor, dict):
+            factor = factor.get("conversion_factor")
+        if factor is not None and name in columns:
+            factors[columns.index(name)] = factor
+    return factors
+
+
+def _parse(lines, delimiter):
+    try:
+        return np.loadtxt(lines, delimiter=delimiter, ndmin=2)
+    except ValueError:  # empty fields (missing values) are read as NaN, slower
+        return np.genfromtxt(lines, delimiter=delimiter, dtype=float, ndmin=2)
+
+
+def _header(path, delimiter):
+    with open(path, "r", encoding="utf-8") as file:
+        return [name.strip().strip('"') for name in file.readline().rstrip("\r\n").split(delimiter)]
+
+
+class _Filter:
+    """ Keeps the rows of the chunks inside the time window and downsamples them. The state between the chunks
+    (first time point, number of rows, last time bin) gives the same result for every chunk size.
+    """
+
+    def __init__(self, t_start, t_end, every, dt, start_at_zero, factors):
+        self.t_start = -np.inf if t_start is None else t_start
+        self.t_end = np.inf if t_end is None else t_end
+        self.every = every
+        self.dt = dt
+        self.start_at_zero = start_at_zero
+        self.factors = factors
+        self.t0 = None          # subtracted from all time points (the first one for start_at_zero)
+        self.rows = 0           # rows inside the time window so far (for every)
+        self.origin = None      # start of the first time bin (for dt)
+        self.last_bin = np.nan  # time bin of the last kept row (for dt)
+        self.done = False       # past t_end, the rest of the file is not read
+        self.t = []
+        self.values = []
+
+    def add(self, t, values):
+        if self.t0 is None:
+            self.t0 = t[0] if self.start_at_zero else 0.0
+        t = t - self.t0
+        keep = (t >= self.t_start) & (t <= self.t_end)
+        window = np.flatnonzero(keep)
+        if self.every > 1:
+            keep[window[(self.rows + np.arange(len(window))) % self.every != 0]] = False
+        self.rows += len(window)
+        if self.dt and keep.any():
+            kept = np.flatnonzero(keep)
+            if self.origin is None:
+                self.origin = t[kept[0]] if np.isinf(self.t_start) else self.t_start
+            bins = np.floor((t[kept] - self.origin) / self.dt)
+            keep[kept[np.diff(bins, prepend=self.last_bin) == 0]] = False  # first row of every bin
+            self.last_bin = bins[-1]
+        self.t.append(t[keep])
+        self.values.append(values[keep] * self.factors)
+        self.done = t[-1] > self.t_end  # the time points are increasing
+
+    def block(self):
+        """ Time points and values of the kept rows as one array (time first), column by column """
+        n_rows = sum(len(t) for t in self.t)
+        block = np.empty((n_rows, 1 + len(self.factors)), order="F")
+        block[:, 0] = np.concatenate(self.t) if self.t else []
+        block[:, 1:] = np.concatenate(self.values) if self.values else np.empty((0, len(self.factors)))
+        return block
+
+
+def _cache_path(path, files, options):
+    """ Cache file of the options, a change of an option or of one of the files gives a new file """
+    stats = [(os.path.abspath(file), os.stat(file).st_size, os.stat(file).st_mtime_ns) for file in files]
+    key = hashlib.sha256(json.dumps(dict(version=CACHE_VERSION, files=stats, options=options),
+                                    sort_keys=True).encode()).hexdigest()
+    folder = os.path.join(os.path.dirname(os.path.abspath(path)), CACHE_FOLDER)
+    return os.path.join(folder, f"{os.path.basename(path)}.{key[:16]}.npy")
+
+
+def _read_cache(cache_path, n_columns, mmap):
+    if cache_path is None or not os.path.exists(cache_path):
+        return None
+    try:
+        block = np.load(cache_path, mmap_mode="r" if mmap else None)
+    except (OSError, ValueError):
+        return None
+    return block if block.ndim == 2 and block.shape[1] == n_columns + 1 else None
+
+
+def _write_cache(cache_path, block):
+    if cache_path is None:
+        return
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(cache_path + ".tmp", "wb") as file:
+            np.save(file, block)
+        os.replace(cache_path + ".tmp", cache_path)
+    except OSError:  # e.g. a read-only folder, the file is just parsed again next time
+        pass
+
+
+def read_measurements(path, columns=None, time=None, time_file=None, header=None, delimiter=",", t_start=None,
+                      t_end=None, start_at_zero=False, every=1, dt=None, conversion=None, chunk_rows=CHUNK_ROWS,
+                      cache=True, mmap=True):
+    """ Reads measured data from a CSV file (numbers only, e.g. an export of 1 s sensor data over days) for
+    catd.AllthedataBuilder.build:
+
+        measurements = cmeas.read_measurements("Y_data.csv", columns=[...], time_file="T_data.csv", every=50)
+        allthedata = builder.build(**measurements.build_kwargs())
+
+    The file is parsed in chunks of chunk_rows lines, every chunk is cut to the time window, downsampled and
+    converted before the next one is read, so only the kept rows are in memory and the file stops being read after
+    t_end. The result is cached as binary file in __pycache__ next to the CSV file: reading the same file with the
+    same options again only maps the cache into memory (a changed file is parsed again).
+
+    :param path: CSV file
+    :param columns: names of the columns of the file (including the time column), default: the first line
+    :param time: name of the time column, or None if the time points are in time_file
+    :param time_file: file with the time points (first column) for the rows of path, e.g. T_data.csv
+    :param header: True if the first line of the file(s) holds names (skipped), default: columns is None
+    :param delimiter: delimiter of the columns
+    :param t_start: first time point to keep (after start_at_zero)
+    :param t_end: last time point to keep (the time points have to be increasing)
+    :param start_at_zero: True to subtract the first time point of the file from all time points
+    :param every: keep every n-th row of the time window
+    :param dt: keep the first row of every interval of length dt (after every)
+    :param conversion: factor by column name, or the variables table (its 'conversion_factor'), every value is
+                       multiplied by the factor of its column (None or missing: 1)
+    :param chunk_rows: number of lines parsed at once
+    :param cache: False to parse the file without reading or writing the cache
+    :param mmap: False to read the cache into memory (writable, the cache can be deleted afterwards)
+    :return: Measurements (t, values, columns)
+    """
+    if header is None:
+        header = columns is None
+    names = _header(path, delimiter) if columns is None else list(columns)
+    if time_file is None:
+        if time not in names:
+            raise ValueError(f"Give the name of the time column (time=, one of {names}) or a file with the time "
+                             f"points (time_file=).")
+        time_index = names.index(time)
+    else:
+        time_index = None
+    value_columns = [name for i, name in enumerate(names) if i != time_index]
+    if every < 1 or (dt is not None and dt <= 0):
+        raise ValueError(f"every has to be at least 1 and dt positive (every={every}, dt={dt}).")
+    factors = _conversion_factors(conversion, value_columns)
+
+    options = dict(columns=names, time=time, header=header, delimiter=delimiter, t_start=t_start, t_end=t_end,
+                   start_at_zero=start_at_zero, every=every, dt=dt, factors=factors.tolist())
+    cache_path = _cache_path(path, [path] + ([time_file] if time_file else []), options) if cache else None
+    block = _read_cache(cache_path, len(value_columns), mmap)
+    if block is None:
+        block = _stream(path, time_file, names, time_index, header, delimiter, chunk_rows,
+                        _Filter(t_start, t_end, every, dt, start_at_zero, factors))
+        _write_cache(cache_path, block)
+    return Measurements(block[:, 0], block[:, 1:], value_columns, path)
+
+
+def _stream(path, time_file, names, time_index, header, delimiter, chunk_rows, rows):
+    value_index = [i for i in range(len(names)) if i != time_index]
+    with open(path, "r", encoding="utf-8") as file, \
+            (open(time_file, "r", encoding="utf-8") if time_file else contextlib.nullcontext()) as t_file:
+        if header:
+            file.readline()
+            if time_file:
+                t_file.readline()
+        line = 1 + header
+        while not rows.done:
+            lines = list(itertools.islice(file, chunk_rows))
+            if not lines:
+                break
+            values = _parse(lines, delimiter)
+            if values.size and values.shape[1] != len(names):
+                raise ValueError(f"{path} has {values.shape[1]} columns from line {line} on, expected "
+                                 f"{len(names)} ({names}).")
+            if time_file:
+                t = _parse(list(itertools.islice(t_file, len(lines))), delimiter)[:, 0]
+                if len(t) != len(values):
+                    raise ValueError(f"{time_file} and {path} have a different number of rows (line {line} on).")
+            else:
+                t = values[:, time_index]
+                values = values[:, value_index]
+            if len(t):
+                rows.add(t, values)
+            line += len(lines)
+    return rows.block()
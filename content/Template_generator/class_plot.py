@@ -2,12 +2,11 @@
 from matplotlib import cm
 from matplotlib import colors as mcolors
 import numpy as np
-from scipy.stats import norm
 from plotly.subplots import make_subplots
 import plotly.graph_objects as go
 import plotly.io as pio
 import plotly.offline
-import plotly.express as px
+import plotly.colors
 #from plotly.validators.scatter.marker import SymbolValidator
 #import ecoli_sim_and_pe
 import os
@@ -15,7 +14,6 @@ import sys
 import math
 import copy
 from pathlib import Path
-from IPython.display import display, HTML
 #import ecoli_sim_and_pe
 
 
@@ -169,7 +167,7 @@ class PlotPlotly:
             colors = colorrrs * math.ceil(n / len(colorrrs))
 
         else:
-            colors = px.colors.qualitative.G10 * math.ceil(n / 10)  # self.colorscheme == "qualitative_plotly"
+            colors = plotly.colors.qualitative.G10 * math.ceil(n / 10)  # self.colorscheme == "qualitative_plotly"
 
         if n_colors:
             self.colors = colors
@@ -182,7 +180,9 @@ class PlotPlotly:
                     colors_dict[key] = colors[i]
                 self.colors = colors_dict
 
-        # Add info
+        # Add info (only to a colors dict, a list of colors is used by index e.g. in plot_sensitivities)
+        if not isinstance(self.colors, dict):
+            return
         if not "color_data" in self.colors.keys():
             self.colors["color_data"] = self.color_data
             self.colors["color_data_default"] = "black"
@@ -1926,6 +1926,8 @@ class PlotPlotly:
                         params_names=None, result_as_table=False):
         """ Function to plot results from bootstrap analysis or fisher matrix.
         """
+        from scipy.stats import norm  # imported here, scipy.stats is slow to import and only needed for this plot
+
         cov_method = cov_method.lower()
         expID = list(self.allthedata.keys())[0]
 
@@ -2453,9 +2455,16 @@ class PlotPlotly:
     def _save_fig(self, fig, plot_name):
 
         filename = os.path.join(self.path, plot_name + ".html")
-        print("If it does not work on the first run try re_running the last cell. If it still does not work go to the path where the HTML is saved and open it manually")
         # Save the figure to an HTML file
         pio.write_html(fig, filename, auto_open=False)
+
+        # Outside of Jupyter (e.g. the command line runner) the file is all there is, IPython is not needed
+        ipython = sys.modules.get("IPython")
+        if ipython is None or ipython.get_ipython() is None:
+            return
+        from IPython.display import display, HTML
+
+        print("If it does not work on the first run try re_running the last cell. If it still does not work go to the path where the HTML is saved and open it manually")
         # Generate HTML as string
         html_str = pio.to_html(fig, full_html=True, include_plotlyjs='cdn')
 
@@ -0,0 +1,312 @@
+import datetime
+import hashlib
+import json
+import os
+import re
+import shutil
+import time
+from dataclasses import dataclass, field
+
+import numpy as np
+
+
+# Registry database inside the results folder (next to the run folders created by AllthedataBuilder.init_saving)
+REGISTRY_FILE = "runs.sqlite"
+
+# Name of a run folder: <datestring>_<identifier> (see AllthedataBuilder.init_saving)
+RUN_FOLDER = re.compile(r"^(\d{8}_\d{2}-\d{2}-\d{2})_(.+)$")
+DATE_FORMAT = "%Y%m%d_%H-%M-%S"
+
+# Seconds to wait for a lock of the database (several processes writing to one results folder)
+TIMEOUT = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    run_id TEXT,
+    model TEXT,
+    description TEXT,
+    fingerprint TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_model ON runs (model, created);
+CREATE INDEX IF NOT EXISTS runs_fingerprint ON runs (fingerprint, created);
+CREATE INDEX IF NOT EXISTS runs_created ON runs (created);
+CREATE TABLE IF NOT EXISTS metrics (
+    run INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    value REAL,
+    PRIMARY KEY (run, name)
+);
+CREATE INDEX IF NOT EXISTS metrics_value ON metrics (name, value);
+CREATE TABLE IF NOT EXISTS artifacts (
+    run INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+    path TEXT NOT NULL,
+    PRIMARY KEY (run, path)
+);
+"""
+
+
+def _canonical(value):
+    """ JSON fallback for configurations (numpy arrays/numbers, inf, functions, ...) """
+    if isinstance(value, np.ndarray):
+        return {"__array__": hashlib.sha256(np.ascontiguousarray(value).tobytes()).hexdigest(),
+                "shape": value.shape}
+    if isinstance(value, np.generic):
+        return value.item()
+    return repr(value)
+
+
+def fingerprint(config):
+    """ sha256 of a configuration (any JSON-like dict, arrays by content), equal configurations give equal keys """
+    return hashlib.sha256(json.dumps(config, sort_keys=True, default=_canonical).encode()).hexdigest()
+
+
+@dataclass(frozen=True)
+class Run:
+    """ One row of the registry, path is absolute, created/updated are UNIX times """
+    id: int
+    path: str
+    run_id: str
+    model: str
+    description: str
+    fingerprint: str
+    created: float
+    updated: float
+    metrics: dict = field(default_factory=dict)
+    artifacts: list = field(default_factory=list)
+
+    @property
+    def datestring(self):
+        return datetime.datetime.fromtimestamp(self.created).strftime(DATE_FORMAT)
+
+
+class RunRegistry:
+    def __init__(self, folder):
+        """ Index of the run folders of one results folder in an SQLite database (REGISTRY_FILE in folder).
+
+        Every run has the id given to init_saving (run_id), the model name, a fingerprint of its configuration,
+        the creation and update time, summary metrics (e.g. the final values of the variables) and its artifacts
+        (files of the run folder). Lookups by model, fingerprint, time or metric use indexes instead of scanning
+        the folders. Paths are stored relative to folder, so the registry stays valid when the results folder is
+        moved or mounted somewhere else.
+
+        :param folder: results folder (path_save of init_saving), created if needed
+        """
+        import sqlite3  # a separate package in Pyodide, only needed once a registry is opened
+
+        self.folder = os.path.abspath(folder)
+        os.makedirs(self.folder, exist_ok=True)
+        self.connection = sqlite3.connect(os.path.join(self.folder, REGISTRY_FILE), timeout=TIMEOUT)
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        with self.connection:
+            self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _relative(self, path):
+        return os.path.relpath(os.path.abspath(path), self.folder)
+
+    # -----------------------------
+    # Writing
+    # -----------------------------
+    def register(self, path, run_id=None, model=None, description=None, fingerprint=None, metrics=None,
+                 artifacts=(), created=None):
+        """ Adds a run folder (or updates it if it is registered already) and returns its id.
+
+        :param path: run folder
+        :param metrics: {name: number}, e.g. {"final Biomass": 12.3}
+        :param artifacts: files of the run (paths), see also scan_artifacts
+        :param created: UNIX time of the run, defaults to now
+        """
+        now = time.time()
+        relative = self._relative(path)
+        with self.connection:
+            self.connection.execute(
+                "INSERT INTO runs (path, run_id, model, description, fingerprint, created, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (path) DO UPDATE SET run_id = excluded.run_id, "
+                "model = excluded.model, description = excluded.description, fingerprint = excluded.fingerprint, "
+                "updated = excluded.updated",
+                (relative, None if run_id is None else str(run_id), model, description, fingerprint,
+                 now if created is None else created, now))
+            run = self.connection.execute("SELECT id FROM runs WHERE path = ?", (relative,)).fetchone()[0]
+        self.update(run, metrics, artifacts)
+        return run
+
+    def update(self, run, metrics=None, artifacts=()):
+        """ Adds (or replaces) metrics and adds artifacts of a run (id or Run) """
+        run = getattr(run, "id", run)
+        with self.connection:
+            if metrics:
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO metrics (run, name, value) VALUES (?, ?, ?)",
+                    [(run, name, None if value is None else float(value)) for name, value in metrics.items()])
+            if artifacts:
+                self.connection.executemany("INSERT OR IGNORE INTO artifacts (run, path) VALUES (?, ?)",
+                                            [(run, self._relative(path)) for path in artifacts])
+            self.connection.execute("UPDATE runs SET updated = ? WHERE id = ?", (time.time(), run))
+
+    def scan_artifacts(self, run):
+        """ Registers all files of the folder of a run (id or Run) as its artifacts, returns the Run """
+        run = self.get(getattr(run, "id", run))
+        artifacts = []
+        for root, _, files in os.walk(run.path):
+            artifacts += [os.path.join(root, name) for name in files]
+        self.update(run, artifacts=artifacts)
+        return self.get(run.id)
+
+    def import_folders(self, model=None):
+        """ Registers the run folders (<datestring>_<identifier>) of the results folder that are not registered
+        yet, e.g. the folders of the time before the registry. The creation time is read from the name.
+
+        :param model: model name of the imported runs (unknown otherwise)
+        :return: number of registered folders
+        """
+        known = {path for path, in self.connection.execute("SELECT path FROM runs")}
+        rows = []
+        for entry in os.scandir(self.folder):
+            match = RUN_FOLDER.match(entry.name)
+            if not entry.is_dir() or match is None or entry.name in known:
+                continue
+            try:
+                created = datetime.datetime.strptime(match.group(1), DATE_FORMAT).timestamp()
+            except ValueError:
+                continue
+            rows.append((entry.name, match.group(2), model, None, None, created, time.time()))
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO runs (path, run_id, model, description, fingerprint, created, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        return len(rows)
+
+    # -----------------------------
+    # Queries
+    # -----------------------------
+    def _runs(self, where="", parameters=(), order="created DESC", limit=None):
+        query = f"SELECT id, path, run_id, model, description, fingerprint, created, updated FROM runs {where} " \
+                f"ORDER BY {order}" + ("" if limit is None else f" LIMIT {int(limit)}")
+        rows = self.connection.execute(query, parameters).fetchall()
+        if not rows:
+            return []
+        ids = [row[0] for row in rows]
+        metrics = {run: {} for run in ids}
+        artifacts = {run: [] for run in ids}
+        # In batches, SQLite limits the number of parameters of one query
+        for start in range(0, len(ids), 500):
+            batch = ids[start:start + 500]
+            marks = ",".join("?" * len(batch))
+            for run, name, value in self.connection.execute(
+                    f"SELECT run, name, value FROM metrics WHERE run IN ({marks})", batch):
+                metrics[run][name] = value
+            for run, path in self.connection.execute(
+                    f"SELECT run, path FROM artifacts WHERE run IN ({marks}) ORDER BY path", batch):
+                artifacts[run].append(os.path.join(self.folder, path))
+        return [Run(run, os.path.join(self.folder, path), run_id, model, description, key, created, updated,
+                    metrics[run], artifacts[run])
+                for run, path, run_id, model, description, key, created, updated in rows]
+
+    def get(self, run):
+        """ Run by id or by folder, None if it is not registered """
+        if isinstance(run, str):
+            runs = self._runs("WHERE path = ?", (self._relative(run),))
+        else:
+            runs = self._runs("WHERE id = ?", (int(run),))
+        return runs[0] if runs else None
+
+    def runs(self, model=None, run_id=None, fingerprint=None, since=None, until=None, metrics=None, limit=None,
+             oldest_first=False):
+        """ Registered runs, newest first.
+
+        :param model: only runs of this model
+        :param run_id: only runs with this run_id
+        :param fingerprint: only runs with this configuration (see fingerprint)
+        :param since: only runs created at or after this time (UNIX time or datetime)
+        :param until: only runs created before this time (UNIX time or datetime)
+        :param metrics: {name: (min, max)} ranges of metrics (None for open), e.g. {"final Biomass": (10, None)}
+        :param limit: maximum number of runs
+        :param oldest_first: oldest runs first
+        """
+        conditions, parameters = [], []
+        for column, value in (("model", model), ("run_id", run_id), ("fingerprint", fingerprint)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                parameters.append(str(value))
+        for operator, value in ((">=", since), ("<", until)):
+            if value is not None:
+                conditions.append(f"created {operator} ?")
+                parameters.append(value.timestamp() if isinstance(value, datetime.datetime) else float(value))
+        for name, (low, high) in (metrics or {}).items():
+            condition = "id IN (SELECT run FROM metrics WHERE name = ?"
+            parameters.append(name)
+            for operator, value in ((">=", low), ("<=", high)):
+                if value is not None:
+                    condition += f" AND value {operator} ?"
+                    parameters.append(float(value))
+            conditions.append(condition + ")")
+        where = "WHERE " + " AND ".join(conditions) if conditions else ""
+        return self._runs(where, parameters, "created ASC" if oldest_first else "created DESC", limit)
+
+    def latest(self, fingerprint):
+        """ Newest run with this configuration, None if there is none (e.g. to reuse its results) """
+        runs = self.runs(fingerprint=fingerprint, limit=1)
+        return runs[0] if runs else None
+
+    def duplicates(self, model=None):
+        """ {fingerprint: runs (newest first)} of all configurations that were run more than once """
+        query = "SELECT fingerprint FROM runs WHERE fingerprint IS NOT NULL" + \
+                ("" if model is None else " AND model = ?") + " GROUP BY fingerprint HAVING COUNT(*) > 1"
+        keys = [key for key, in self.connection.execute(query, () if model is None else (model,))]
+        return {key: self.runs(model=model, fingerprint=key) for key in keys}
+
+    # -----------------------------
+    # Garbage collection
+    # -----------------------------
+    def collect_garbage(self, older_than=None, keep_duplicates=None, model=None, missing=True, delete_files=True,
+                        dry_run=False):
+        """ Removes runs from the registry and deletes their folders. Returns the removed runs.
+
+        :param older_than: remove runs older than this many days
+        :param keep_duplicates: keep only the newest runs of every configuration (e.g. 1), None keeps all
+        :param model: only runs of this model
+        :param missing: remove runs whose folder does not exist anymore
+        :param delete_files: False to only remove the runs from the registry
+        :param dry_run: True to only return the runs that would be removed
+        """
+        runs = self.runs(model=model)
+        removed = {}
+        if older_than is not None:
+            limit = time.time() - older_than * 86400
+            removed.update({run.id: run for run in runs if run.created < limit})
+        if keep_duplicates is not None:
+            for duplicates in self.duplicates(model).values():
+                removed.update({run.id: run for run in duplicates[keep_duplicates:]})
+        if missing:
+            removed.update({run.id: run for run in runs if not os.path.isdir(run.path)})
+        removed = sorted(removed.values(), key=lambda run: run.created)
+        if dry_run:
+            return removed
+
+        for run in removed:
+            # Only folders inside the results folder are deleted
+            if delete_files and os.path.isdir(run.path) and \
+                    os.path.commonpath([self.folder, os.path.abspath(run.path)]) == self.folder and \
+                    os.path.abspath(run.path) != self.folder:
+                shutil.rmtree(run.path, ignore_errors=True)
+            with self.connection:
+                self.connection.execute("DELETE FROM runs WHERE id = ?", (run.id,))
+        return removed
+
+
+def register_run(folder, path, **kwargs):
+    """ Shortcut for RunRegistry(folder).register(path, **kwargs), closes the database again """
+    with RunRegistry(folder) as registry:
+        return registry.register(path, **kwargs)
@@ -0,0 +1,308 @@
+import numpy as np
+from scipy.integrate import odeint
+
+import class_compiler as ccm
+import class_simulator as csim
+
+
+# Relative step of the central differences of whole simulations (if dif_simple can not be differentiated)
+DIFFERENCE_STEP = 1e-3
+
+# Lowest tolerance of the solver for the sensitivities (plots and the Fisher information need a few digits, a
+# tighter tolerance only costs steps)
+SENSITIVITY_TOL = 1e-6
+
+# Maximum number of solver steps between two time points (the sensitivities need small steps at every switch)
+MAX_STEPS = 50000
+
+
+def estimable_parameters(model, parameters=None, constants=None):
+    """ Names of the parameters the sensitivities are calculated for by default: every entry of the parameters
+    table that is used by the model and not excluded with 'vary': False. Models without parameters (only constants)
+    use all their constants.
+
+    :param model: class_compiler.CompiledModel (its tables are used if parameters/constants are None)
+    """
+    parameters = model.tables["parameters"] if parameters is None else parameters
+    constants = model.tables["constants"] if constants is None else constants
+    names = [name for name, meta in parameters.items() if meta.get("vary") is not False and name in model.index]
+    if not names:
+        names = [name for name in constants if name in model.index]
+    return names
+
+
+class SensitivityResult:
+    def __init__(self, t, x, sensitivities, names, values, simulation):
+        """ States and their sensitivities to the parameters.
+
+        :param t: time points
+        :param x: states of the simulation, shape (len(t), n_states)
+        :param sensitivities: d x / d parameter, shape (len(t), n_states, n_params)
+        :param names: names of the parameters (order of the last axis)
+        :param values: values of the parameters
+        :param simulation: csim.SimulationResult of the nominal run (phases, feed start, x_and_rs, ...)
+        """
+        self.t = t
+        self.x = x
+        self.sensitivities = sensitivities
+        self.names = names
+        self.values = np.asarray(values, dtype=float)
+        self.simulation = simulation
+
+    def scaled(self, weights=None):
+        """ Sensitivities multiplied by the parameter value (d x / d ln p) and by the weight of every state, so that
+        parameters of different size (and states of different weight) can be compared in one plot.
+
+        :param weights: one weight per state, 1 for all states if None
+        """
+        weights = np.ones(self.x.shape[1]) if weights is None else np.asarray(weights, dtype=float)
+        return self.sensitivities * weights[None, :, None] * self.values[None, None, :]
+
+    def fill(self, allthedata):
+        """ Fills "sensitivities", "sensitivities (weighted)" and "sensitivity_matrix" of the simulation_data of an
+        allthedata dict (catd.AllthedataBuilder.build) in the layout cplt.PlotPlotly.plot_sensitivities uses:
+
+        - sensitivities[state][parameter]: d state / d parameter at every time point
+        - sensitivities (weighted)[state][parameter]: the same multiplied by the parameter value and the 'weight' of
+          the state
+        - sensitivity_matrix: the weighted sensitivities as one array of shape (len(t) * n_states, n_params), the rows
+          are the states of the first time point, then of the second, ...
+
+        Only states that are 'estimable' (not False) are used. Returns allthedata.
+        """
+        states = list(allthedata["variables"])[:self.x.shape[1]]
+        weights = [allthedata["variables"][state]["weight"] for state in states]
+        weighted = self.scaled(weights)
+        used = [i for i, state in enumerate(states) if allthedata["variables"][state]["estimable"] is not False]
+
+        simulation_data = allthedata["simulation_data"]
+        simulation_data["sensitivities"] = {
+            states[i]: {name: self.sensitivities[:, i, j] for j, name in enumerate(self.names)} for i in used}
+        simulation_data["sensitivities (weighted)"] = {
+            states[i]: {name: weighted[:, i, j] for j, name in enumerate(self.names)} for i in used}
+        simulation_data["sensitivity_matrix"] = weighted[:, used, :].reshape(-1, len(self.names))
+        return allthedata
+
+
+class SensitivitySimulator:
+    def __init__(self, model, feed, parameters=None, substrate=None, biomass=None, feed_name=None,
+                 rtol=csim.DEFAULT_TOL, atol=csim.DEFAULT_TOL):
+        """ Forward sensitivities of a generated model: the states and d x / d p of all parameters are integrated
+        together (one solver run per feeding phase) instead of simulating the model again for every parameter.
+
+        d(dx/dp)/dt = df/dx * dx/dp + df/dp comes from one function derived symbolically from the compiled
+        dif_simple (cjac.SensitivityJacobian, derivatives by the states, the bound values and the feed start). At
+        the feed start the sensitivities get the jump of the substrate event, and the dependence of the fedbatch
+        feed on feed.ts and feed.X_fedbatch_start is included. Without sympy, or if dif_simple can not be
+        differentiated, the sensitivities are central differences of whole simulations (two per parameter).
+        If/else tests that depend on the states (e.g. the overflow of Xu 1999) can switch inside a phase and make
+        dif_simple jump, which the forward sensitivities do not follow: the tests are checked at the time points
+        of the simulation, and if one switches inside a phase, run falls back to the central differences (with a
+        warning, and for all later runs of the simulator). The derivation is done at the first run (and kept for
+        copies of the model, see _sensitivity_jacobian).
+
+        :param model: dif_simple (compiled, see class_compiler) or a class_compiler.CompiledModel
+        :param feed: the cfb.Feed of the notebook or a cfb.FeedSchedule
+        :param parameters: names of the parameters (as for class_compiler.CompiledModel.with_values, e.g. "mu_set"
+                           or "inputs.Feed.concentration") or initial values ("variables.<name>.initial_value"),
+                           defaults to estimable_parameters(model)
+        The other arguments are the same as for csim.FedBatchSimulator.
+        """
+        self.simulator = csim.FedBatchSimulator(model, feed, substrate, biomass, feed_name, rtol, atol, verbose=False)
+        self.model = self.simulator.model
+        self.schedule = self.simulator.schedule
+        self.names = list(estimable_parameters(self.model) if parameters is None else parameters)
+        self.rtol = rtol
+        self.atol = atol
+        self.sensitivity_rtol = max(rtol, SENSITIVITY_TOL)
+        self.sensitivity_atol = max(atol, SENSITIVITY_TOL)
+        self.arguments = dict(substrate=self.simulator.substrate, biomass=self.simulator.biomass,
+                              feed_name=self.simulator.feed_name, rtol=rtol, atol=atol)
+
+        variables = list(self.model.tables["variables"])
+        self.initial_values = {}
+        for name in self.names:
+            table, _, rest = name.partition(".")
+            variable, _, field = rest.rpartition(".")
+            if table == "variables" and field == "initial_value" and variable in variables:
+                self.initial_values[name] = variables.index(variable)
+            elif name not in self.model.index:
+                raise KeyError(f"'{name}' is not used by the model. Available: {self.model.names}")
+
+        # Globals of the compiled dif_simple the derivatives are taken by: the bound values of the parameters and
+        # the feed start (which moves with the parameters)
+        feed_name = self.simulator.feed_name
+        self.sources = list(dict.fromkeys([f"{ccm.BOUND_VECTOR}_{self.model.index[name]}" for name in self.names
+                                           if name not in self.initial_values]
+                                          + [f"{feed_name}.ts", f"{feed_name}.X_fedbatch_start"]))
+        self._derivatives = None
+        self.branch_switch = False
+
+    @property
+    def derivatives(self):
+        """ cjac.SensitivityJacobian of the model, None if the sensitivities are central differences """
+        if self._derivatives is None:
+            self._derivatives = _sensitivity_jacobian(self.model, self.sources) or False
+        return self._derivatives or None
+
+    def _value(self, name, x0):
+        if name in self.initial_values:
+            return x0[self.initial_values[name]]
+        return self.model.values[self.model.index[name]]
+
+    def _augmented_rhs(self, phase, ts, X_fedbatch_start, dts, dX_fedbatch_start):
+        """ RHS and Jacobian (for the solver) of the states and sensitivities in one phase.
+
+        dts and dX_fedbatch_start are the derivatives of the feed start (time and biomass) by the parameters.
+        """
+        feed_name = self.simulator.feed_name
+        model = self.model.bind(**{feed_name: self.schedule.state(phase, ts, X_fedbatch_start)})
+        derivatives = self.derivatives.bind(model)
+        n_params = len(self.names)
+        n_states = self.derivatives.n_states
+
+        # df/dp = d f / d sources * d sources / d p: 1 for the value of a parameter, dts and dX_fedbatch_start for
+        # the feed start
+        mapping = np.zeros((len(self.sources), n_params))
+        for j, name in enumerate(self.names):
+            if name not in self.initial_values:
+                mapping[self.sources.index(f"{ccm.BOUND_VECTOR}_{self.model.index[name]}"), j] = 1.0
+        mapping[self.sources.index(f"{feed_name}.ts")] += dts
+        mapping[self.sources.index(f"{feed_name}.X_fedbatch_start")] += dX_fedbatch_start
+
+        def augmented(y, t):
+            f, J, P, _ = derivatives(y[:n_states], t)
+            S = y[n_states:].reshape(n_params, n_states)
+            return np.concatenate((f, (S @ J.T + (P @ mapping).T).ravel()))
+
+        def jacobian(y, t):
+            # df/dx on every block of the diagonal (the coupling of the sensitivities to x is left out, the solver
+            # only needs the Jacobian for its Newton iterations)
+            return np.kron(np.eye(n_params + 1), derivatives(y[:n_states], t)[1])
+
+        return model.rhs, augmented, jacobian
+
+    def _switching_phase(self, simulation, t):
+        """ First phase in which an if/else test of dif_simple that depends on the states switches between the time
+        points t of the simulation, None if there is none
+        """
+        feed_name = self.simulator.feed_name
+        for k, entry in enumerate(simulation.phases):
+            phase, t_now, t_stop = entry["phase"], entry["start"], entry["end"]
+            ts, X_fedbatch_start = (None, None) if phase == "batch" else (simulation.ts, simulation.X_fedbatch_start)
+            model = self.model.bind(**{feed_name: self.schedule.state(phase, ts, X_fedbatch_start)})
+            derivatives = self.derivatives.bind(model)
+            in_phase = (t >= t_now) & ((t < t_stop) | (k == len(simulation.phases) - 1))
+            if len({derivatives(x, time)[3] for x, time in zip(simulation.x[in_phase], t[in_phase])}) > 1:
+                return phase
+        return None
+
+    def _finite_differences(self, x0, t):
+        """ d x / d p by simulating the model twice per parameter, shape (len(t), n_states, n_params) """
+        columns = []
+        for name in self.names:
+            base = self._value(name, x0)
+            h = DIFFERENCE_STEP * max(abs(base), 1e-8)
+            runs = []
+            for value in (base + h, base - h):
+                x_start, model = np.array(x0), self.model
+                if name in self.initial_values:
+                    x_start[self.initial_values[name]] = value
+                else:
+                    model = self.model.with_values(**{name: value})
+                # The schedule, not the feed of the notebook: it keeps the phase of the nominal run
+                simulator = csim.FedBatchSimulator(model, self.schedule, verbose=False, **self.arguments)
+                runs.append(simulator.run(x_start, t).x)
+            columns.append((runs[0] - runs[1]) / (2 * h))
+        return np.stack(columns, axis=-1)
+
+    def run(self, x0, t):
+        """ Simulates the model with its sensitivities from x0 over the time points t, returns a SensitivityResult. """
+        t = np.asarray(t, dtype=float)
+        x0 = np.asarray(x0, dtype=float)
+        simulation = self.simulator.run(x0, t)
+        values = [self._value(name, x0) for name in self.names]
+        if self.derivatives is not None and not self.branch_switch:
+            phase = self._switching_phase(simulation, t)
+            if phase is not None:
+                print(f"⚠️ Warning: an if/else test of dif_simple that depends on the states switches in the {phase} "
+                      f"phase, the sensitivities are calculated by simulating the model twice per parameter.")
+                self.branch_switch = True
+        if self.derivatives is None or self.branch_switch:
+            return SensitivityResult(t, simulation.x, self._finite_differences(x0, t), self.names, values, simulation)
+        n_states, n_params = len(x0), len(self.names)
+
+        S_now = np.zeros((n_params, n_states))
+        for j, name in enumerate(self.names):
+            if name in self.initial_values:
+                S_now[j, self.initial_values[name]] = 1.0
+        sensitivities = np.empty((len(t), n_params, n_states))
+        rtol = np.concatenate((np.full(n_states, self.rtol), np.full(n_states * n_params, self.sensitivity_rtol)))
+        atol = np.concatenate((np.full(n_states, self.atol), np.full(n_states * n_params, self.sensitivity_atol)))
+        x_now = x0
+        ts = X_fedbatch_start = None
+        dts = dX_fedbatch_start = np.zeros(n_params)
+        rhs = None
+        for k, entry in enumerate(simulation.phases):
+            phase, t_now, t_stop = entry["phase"], entry["start"], entry["end"]
+            dt_switch = np.zeros(n_params)
+            if phase == "fedbatch":
+                # Feed start: at the substrate limit the start time moves with the parameters (implicit function
+                # theorem on S(ts) = threshold), t_fedbatch_start is fixed
+                ts, X_fedbatch_start = simulation.ts, simulation.X_fedbatch_start
+                f_before = np.zeros(n_states) if rhs is None else np.asarray(rhs(x_now, t_now))
+                by_time = self.schedule.t_fedbatch_start is not None and ts >= self.schedule.t_fedbatch_start
+                if rhs is not None and not by_time:
+                    dt_switch = -S_now[:, self.simulator.substrate] / f_before[self.simulator.substrate]
+                dts = dt_switch
+                dX_fedbatch_start = S_now[:, self.simulator.biomass] + f_before[self.simulator.biomass] * dts
+            rhs_before = rhs
+            rhs, augmented, jacobian = self._augmented_rhs(phase, ts, X_fedbatch_start, dts, dX_fedbatch_start)
+            if np.any(dt_switch):
+                # Jump of the sensitivities where the RHS changes at a parameter dependent time
+                f_jump = np.asarray(rhs_before(x_now, t_now)) - np.asarray(rhs(x_now, t_now))
+                S_now = S_now + np.outer(dt_switch, f_jump)
+
+            last = k == len(simulation.phases) - 1
+            in_phase = (t >= t_now) & ((t < t_stop) | last)
+            times = np.unique(np.concatenate(([t_now], t[in_phase], [t_stop])))
+            y = odeint(augmented, np.concatenate((x_now, S_now.ravel())), times, Dfun=jacobian, rtol=rtol, atol=atol,
+                       mxstep=MAX_STEPS)
+            on_grid = np.isin(times, t[in_phase])
+            sensitivities[np.searchsorted(t, times[on_grid])] = y[on_grid, n_states:].reshape(-1, n_params, n_states)
+            x_now, S_now = y[-1, :n_states], y[-1, n_states:].reshape(n_params, n_states)
+
+        return SensitivityResult(t, simulation.x, np.swapaxes(sensitivities, 1, 2), self.names, values, simulation)
+
+
+_derivatives_cache = {}
+
+
+def _sensitivity_jacobian(model, sources):
+    """ cjac.SensitivityJacobian, None (with a warning) without sympy or if dif_simple can not be differentiated.
+
+    The derivation is kept for the latest model (by dif_simple/algebra and the globals), copies of the model with
+    other values (with_values) bind the same function.
+    """
+    key = (model.functions, tuple(sources))
+    if key in _derivatives_cache:
+        return _derivatives_cache[key]
+    try:
+        import class_jacobian as cjac  # sympy is only needed for the symbolic derivatives
+    except ImportError:
+        print("⚠️ Warning: sympy is not installed, the sensitivities are calculated by simulating the model twice per "
+              "parameter.")
+        return None
+    try:
+        derivatives = cjac.SensitivityJacobian(model, sources)
+    except ValueError as error:
+        print(f"⚠️ Warning: {error} The sensitivities are calculated by simulating the model twice per parameter.")
+        derivatives = None
+    _derivatives_cache.clear()
+    _derivatives_cache[key] = derivatives
+    return derivatives
+
+
+def simulate_sensitivities(model, feed, x0, t, parameters=None, **options):
+    """ Shortcut for SensitivitySimulator(model, feed, parameters, **options).run(x0, t), see there. """
+    return SensitivitySimulator(model, feed, parameters, **options).run(x0, t)
@@ -0,0 +1,543 @@
+from contextlib import nullcontext
+
+import numpy as np
+from scipy.integrate import odeint, solve_ivp
+from scipy.optimize import brentq
+
+import class_compiler as ccm
+import class_diagnostics as cdiag
+
+
+# Same tolerances odeint uses by default
+DEFAULT_TOL = 1.49012e-8
+
+# Number of time points integrated at once while looking for the substrate limit
+EVENT_CHUNK = 100
+
+# Number of time points at which the vectorized algebra is compared with algebra before it is used
+CHECK_POINTS = 16
+
+# Implicit methods of scipy.integrate.solve_ivp that use a Jacobian (odeint is used if method is None)
+STIFF_METHODS = ("BDF", "Radau", "LSODA")
+
+# Largest deviation of a straight line between two adaptive time points from the dense solution (relative to the
+# largest value of the state) and the number of times the intervals are halved at most
+ADAPTIVE_RTOL = 1e-3
+MAX_REFINEMENTS = 12
+
+
+class DenseTrajectory:
+    def __init__(self, segments):
+        """ States at any time of a simulation from the dense output (interpolants) of the solver.
+
+        :param segments: list of (start time, scipy OdeSolution) sorted by start time, a segment is used from its
+                         start to the start of the next one
+        """
+        self.starts = np.array([start for start, _ in segments], dtype=float)
+        self.solutions = [solution for _, solution in segments]
+        self.n_states = len(self.solutions[0](self.starts[0]))
+
+    def __call__(self, times):
+        """ States at the times, shape (len(times), n_states) """
+        times = np.asarray(times, dtype=float)
+        segment = np.maximum(np.searchsorted(self.starts, times, side="right") - 1, 0)
+        x = np.empty((len(times), self.n_states))
+        for k in np.unique(segment):
+            mask = segment == k
+            x[mask] = self.solutions[k](times[mask]).T
+        return x
+
+    def step_times(self, t_end=None):
+        """ Times of the solver steps (the natural adaptive time points), sorted """
+        ends = np.append(self.starts[1:], np.inf)
+        times = [solution.ts[(solution.ts >= start) & (solution.ts < end)]
+                 for start, end, solution in zip(self.starts, ends, self.solutions)]
+        times = np.unique(np.concatenate(times + [self.starts]))
+        return times if t_end is None else times[times <= t_end]
+
+
+class LazyTrajectory:
+    def __init__(self, evaluate, times, columns=None):
+        """ Values of a simulation (states and rates) that are only calculated when they are read.
+
+        Indexing (x[:, 0]), len(x) and np.asarray(x) calculate all columns at self.times once, calling the
+        trajectory (x(times)) calculates them at any other times without storing them.
+
+        :param evaluate: function times -> values, shape (len(times), n_columns)
+        :param times: default time points
+        :param columns: names of the columns (optional)
+        """
+        self.evaluate = evaluate
+        self.times = np.asarray(times, dtype=float)
+        self.columns = columns
+        self._values = None
+
+    def __call__(self, times):
+        return self.evaluate(np.asarray(times, dtype=float))
+
+    def at(self, times):
+        """ Same trajectory with other default time points """
+        return LazyTrajectory(self.evaluate, times, self.columns)
+
+    @property
+    def values(self):
+        if self._values is None:
+            self._values = self.evaluate(self.times)
+        return self._values
+
+    @property
+    def shape(self):
+        return (len(self.times), len(self.columns)) if self.columns is not None else self.values.shape
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self.values, dtype=dtype)
+
+    def __getitem__(self, key):
+        return self.values[key]
+
+    def __len__(self):
+        return len(self.times)
+
+
+class SimulationResult:
+    def __init__(self, t, x, phases, ts, X_fedbatch_start, mode, model=None, schedule=None, feed_name="feed",
+                 stats=None, trajectory=None, diagnostics=None):
+        """ Trajectory of one simulation over all feeding phases.
+
+        :param t: time points of the simulation
+        :param x: states at the time points, shape (len(t), n_states)
+        :param phases: list of dicts with "phase" ("batch", "fedbatch", "constant"), "start" and "end" time
+        :param ts: time when the feeding started (None if it never started)
+        :param X_fedbatch_start: Biomass at the feed start
+        :param mode: printable description of the feeding mode
+        :param model: the class_compiler.CompiledModel that was simulated (needed for x_and_rs)
+        :param schedule: the cfb.FeedSchedule that was simulated (needed for x_and_rs)
+        :param feed_name: global name of the feed inside the model functions
+        :param stats: work of the solver, dict with "nfev" (RHS evaluations) and "njev" (Jacobian evaluations)
+        :param trajectory: DenseTrajectory of the simulation (dense=True of FedBatchSimulator), None otherwise
+        :param diagnostics: cdiag.Diagnostics of the simulation (diagnostics=True of FedBatchSimulator), None otherwise
+        """
+        self.t = t
+        self.x = x
+        self.phases = phases
+        self.ts = ts
+        self.X_fedbatch_start = X_fedbatch_start
+        self.mode = mode
+        self.model = model
+        self.schedule = schedule
+        self.feed_name = feed_name
+        self.stats = stats if stats is not None else {}
+        self.trajectory = trajectory
+        self.diagnostics = diagnostics
+
+        # Phase of every time point (a phase starts at its start time)
+        self._phase_models = {}
+        self.phase_per_point = np.full(len(t), phases[0]["phase"], dtype="<U8")
+        for entry in phases[1:]:
+            self.phase_per_point[t >= entry["start"]] = entry["phase"]
+
+        # Times of the phases with the boundaries included (what AllthedataBuilder expects)
+        self.t_fedbatch = self.phase_times("fedbatch")
+        self.t_constant_feed = self.phase_times("constant")
+
+    def phase_times(self, phase):
+        """ Grid points of a phase with its start and end time included, None if the phase did not happen. """
+        for entry in self.phases:
+            if entry["phase"] == phase:
+                start, end = entry["start"], entry["end"]
+                inner = self.t[(self.t > start) & (self.t < end)]
+                return np.concatenate(([start], inner, [end]))
+        return None
+
+    # -----------------------------
+    # Rates
+    # -----------------------------
+    def x_and_rs(self, rates, out=None):
+        """ States and rates of every time point in one array: the columns of x followed by the rates.
+
+        algebra is evaluated once for the whole simulation (vectorized, see class_compiler) with the feed flags of
+        the phase of every time point. If the model has no vectorized algebra, or it does not give the same
+        results as algebra at CHECK_POINTS time points, algebra is called for every time point instead.
+
+        :param rates: rates dict of the notebook (or a list of rate names), gives the order of the columns
+        :param out: preallocated array of shape (len(t), n_states + len(rates)), created if None
+        :return: the filled array (out)
+        """
+        if self.model is None or self.model.algebra is None:
+            raise ValueError("The rates can only be calculated for a simulated model with an algebra function.")
+        names = list(rates)
+        n_states = self.x.shape[1]
+        if out is None:
+            out = np.empty((len(self.t), n_states + len(names)))
+        out[:, :n_states] = self.x
+        columns = out[:, n_states:]
+        with self._section("post-processing"):
+            if not self._rates_vectorized(names, columns):
+                self._rates_per_point(names, columns)
+        return out
+
+    def _phase_model(self, phase):
+        """ Model with the feed locked in one phase (one entry per phase, so all points of a phase share it) """
+        if phase not in self._phase_models:
+            feed = self.schedule.state(phase, self.ts, self.X_fedbatch_start)
+            self._phase_models[phase] = self.model.bind(**{self.feed_name: feed})
+        return self._phase_models[phase]
+
+    def _rates_vectorized(self, names, columns):
+        feed = self.schedule.state(self.phase_per_point, self.ts, self.X_fedbatch_start)
+        algebra_vectorized = self.model.bind(**{self.feed_name: feed}).algebra_vectorized
+        if algebra_vectorized is None:
+            return False
+        try:
+            results = algebra_vectorized(self.x.T, self.t)
+            self._count_algebra(1)
+        except Exception as error:
+            print(f"⚠️ Warning: vectorized algebra failed ({error}), algebra is called for every time point.")
+            return False
+        for j, name in enumerate(names):
+            columns[:, j] = results[name]
+        if not self._rates_match(names, columns):
+            print("⚠️ Warning: vectorized algebra differs from algebra, algebra is called for every time point.")
+            return False
+        return True
+
+    def _rates_match(self, names, columns):
+        """ True if columns has the results of algebra at CHECK_POINTS time points and at every phase start """
+        starts = np.searchsorted(self.t, [entry["start"] for entry in self.phases])
+        check = np.unique(np.concatenate((np.linspace(0, len(self.t) - 1, CHECK_POINTS).astype(int), starts)))
+        for k in check[check < len(self.t)]:
+            results = self._phase_model(self.phase_per_point[k]).algebra(self.x[k], self.t[k])
+            self._count_algebra(1)
+            expected = [results[name] for name in names]
+            if not np.allclose(columns[k], expected, rtol=1e-9, atol=1e-12, equal_nan=True):
+                return False
+        return True
+
+    def _rates_per_point(self, names, columns):
+        for k, (state_vector, time_point) in enumerate(zip(self.x, self.t)):
+            results = self._phase_model(self.phase_per_point[k]).algebra(state_vector, time_point)
+            columns[k] = [results[name] for name in names]
+        self._count_algebra(len(self.t))
+
+    def _section(self, name):
+        return self.diagnostics.section(name) if self.diagnostics is not None else nullcontext()
+
+    def _count_algebra(self, calls):
+        if self.diagnostics is not None:
+            self.diagnostics.add("algebra calls", calls)
+
+    # -----------------------------
+    # Dense output
+    # -----------------------------
+    def _dense(self):
+        if self.trajectory is None:
+            raise ValueError("The simulation has no dense output, simulate with dense=True.")
+        return self.trajectory
+
+    def resample(self, times):
+        """ SimulationResult at other time points, calculated from the dense output """
+        times = np.asarray(times, dtype=float)
+        return SimulationResult(times, self._dense()(times), self.phases, self.ts, self.X_fedbatch_start, self.mode,
+                                self.model, self.schedule, self.feed_name, self.stats, self.trajectory,
+                                self.diagnostics)
+
+    def adaptive_times(self, rtol=ADAPTIVE_RTOL, max_points=None, evaluate=None):
+        """ Time points at which straight lines between the points follow the dense solution of every state within
+        rtol (relative to the largest value of the state): starting from the solver steps, every interval whose
+        midpoint deviates more is halved.
+
+        :param max_points: no further halving beyond this number of points (no limit if None)
+        :param evaluate: function times -> values that are checked instead of the states (e.g. states and rates)
+        """
+        trajectory = self._dense()
+        evaluate = trajectory if evaluate is None else evaluate
+        max_points = np.inf if max_points is None else max_points
+        t_end = self.phases[-1]["end"]
+        times = np.unique(np.concatenate((trajectory.step_times(t_end), [entry["end"] for entry in self.phases])))
+        x = evaluate(times)
+        scale = np.maximum(np.abs(x).max(axis=0), 1e-12)
+        for _ in range(MAX_REFINEMENTS):
+            middle = (times[:-1] + times[1:]) / 2
+            x_middle = evaluate(middle)
+            refine = np.any(np.abs(x_middle - (x[:-1] + x[1:]) / 2) > rtol * scale, axis=1)
+            if not refine.any() or len(times) + refine.sum() > max_points:
+                break
+            order = np.argsort(np.concatenate((times, middle[refine])), kind="stable")
+            times = np.concatenate((times, middle[refine]))[order]
+            x = np.vstack((x, x_middle[refine]))[order]
+        return times
+
+    def lazy_x_and_rs(self, rates, times=None):
+        """ LazyTrajectory of x_and_rs: states and rates are calculated from the dense output only when they are
+        read, e.g. by catd.AllthedataBuilder(variables, inputs, rates, simulation.lazy_x_and_rs(rates)).
+
+        :param times: default time points, adaptive_times of the states and rates if None
+        """
+        names = list(rates)
+        self._dense()
+
+        def evaluate(points):
+            return self.resample(points).x_and_rs(names)
+
+        columns = sorted(self.model.state_names, key=self.model.state_names.get) + names \
+            if len(self.model.state_names) == self.x.shape[1] else None
+        return LazyTrajectory(evaluate, self.adaptive_times(evaluate=evaluate) if times is None else times, columns)
+
+    def builder_kwargs(self):
+        """ Feed times for catd.AllthedataBuilder(variables, inputs, rates, x_and_rs, t, **kwargs) """
+        return dict(t_fedbatch=self.t_fedbatch, t_constant_feed=self.t_constant_feed, diagnostics=self.diagnostics)
+
+
+def _symbolic_jacobian(model, verbose):
+    """ cjac.symbolic_jacobian, None (with a warning if verbose) without sympy. class_jacobian is imported only here,
+    so the simulator does not need sympy unless the Jacobian is used.
+    """
+    try:
+        import class_jacobian as cjac
+    except ImportError:
+        if verbose:
+            print("⚠️ Warning: sympy is not installed, the Jacobian is estimated by the solver.")
+        return None
+    return cjac.symbolic_jacobian(model, verbose)
+
+
+class FedBatchSimulator:
+    def __init__(self, model, feed, substrate=None, biomass=None, feed_name=None, rtol=DEFAULT_TOL,
+                 atol=DEFAULT_TOL, verbose=True, jacobian=False, method=None, dense=False, jit=False,
+                 diagnostics=False):
+        """ Integrates a generated model over all feeding phases of a cfb.Feed in one run.
+
+        The solver (odeint) is restarted at every phase change with the feed locked in the new phase, so the RHS
+        never switches inside one solver run. t_fedbatch_start and t_const are used as stop times of the phase
+        before, the feed start by substrate limit is an event: the batch phase is integrated in chunks of
+        EVENT_CHUNK time points and the exact crossing of substrate_limit is found by root-finding (brentq).
+
+        :param model: dif_simple (compiled here) or a class_compiler.CompiledModel
+        :param feed: the cfb.Feed of the notebook (left in the state of the last phase after run()) or a
+                     cfb.FeedSchedule
+        :param substrate: index (or name in dif_simple, e.g. 'S') of the substrate, read from feed.get(t, S, X)
+                          by default
+        :param biomass: index (or name in dif_simple, e.g. 'X') of the biomass, read from feed.get(t, S, X)
+                        by default
+        :param feed_name: global name of the feed inside dif_simple, defaults to the name used for feed.get
+        :param rtol: relative tolerance of the solver
+        :param atol: absolute tolerance of the solver
+        :param verbose: print the feed start like cfb.Feed does
+        :param jacobian: True to give the solver the symbolic Jacobian of dif_simple (class_jacobian), or a
+                         class_jacobian.SymbolicJacobian of the same model (derived once, e.g. for many parameter sets).
+                         Without it the solver estimates the Jacobian by finite differences.
+        :param method: None for odeint (LSODA) or a stiff method of solve_ivp ("BDF", "Radau", "LSODA")
+        :param dense: keep the dense output (interpolants) of the solver as result.trajectory, t of run() can then be
+                      coarse and the states are calculated later at any times (resample, lazy_x_and_rs). Uses
+                      solve_ivp (LSODA if method is None)
+        :param jit: True to integrate a numba-compiled version of dif_simple (class_jit), or a class_jit.JitModel of the
+                    same model (compiled once, e.g. for many parameter sets). Faster only for a long dif_simple (see
+                    class_jit). Without numba (e.g. in the browser) the compiled Python RHS is used as before.
+        :param diagnostics: record the work of the solver and of dif_simple/algebra per feeding phase (RHS calls,
+                            Jacobian evaluations, steps, time in Feed.get and in the kinetics, see class_diagnostics)
+                            as result.diagnostics, which AllthedataBuilder stores as allthedata["diagnostics"]
+        """
+        compiled = ccm.compiled(model)
+        if compiled is None:
+            raise ValueError("The model can not be compiled, the simulator needs the source code of dif_simple.")
+        model = compiled
+        self.feed = feed
+        self.schedule = getattr(feed, "schedule", feed)
+        self.rtol = rtol
+        self.atol = atol
+        self.verbose = verbose
+        if method is not None and method not in STIFF_METHODS:
+            raise ValueError(f"Unknown method {method!r}, use None (odeint) or one of {', '.join(STIFF_METHODS)}.")
+        self.method = "LSODA" if dense and method is None else method
+        self.dense = dense
+        self._segments = []
+        self._solution = None
+        if jacobian is True:
+            jacobian = _symbolic_jacobian(model, verbose)
+        self.jacobian = jacobian or None
+        self.stats = {"nfev": 0, "njev": 0}
+        self.diagnostics = diagnostics
+        self._diagnostics = None
+
+        get_calls = {name: args for name, args in model.calls.items() if name.endswith(".get") and len(args) == 3}
+        if feed_name is None:
+            feed_name = next((name[:-len(".get")] for name in get_calls
+                              if model.namespace.get(name[:-len(".get")]) is feed), "feed")
+        self.feed_name = feed_name
+        self.model = model.bind(**{feed_name: self.schedule.state("batch")})
+
+        args = get_calls.get(f"{feed_name}.get", [None, None, None])
+        self.substrate = self._state_position(substrate if substrate is not None else args[1], "substrate")
+        self.biomass = self._state_position(biomass if biomass is not None else args[2], "biomass")
+        if jit is True:
+            import class_jit as cjit  # numba is only imported when the model is compiled with it
+
+            jit = cjit.jit_model(model, feed_name, verbose)
+        self.jit = jit or None
+
+    def _state_position(self, state, label):
+        if isinstance(state, (int, np.integer)):
+            return int(state)
+        index = self.model.state_index(state) if state is not None else None
+        if index is None:
+            raise ValueError(f"Could not find the {label} in x, pass {label}=<index in x> to the simulator.")
+        return index
+
+    # -----------------------------
+    # Integration
+    # -----------------------------
+    def _integrate(self, rhs, x_now, times, jac=None):
+        times = np.asarray(times, dtype=float)
+        self._solution = None
+        if times[-1] == times[0]:  # no interval (odeint would return uninitialized counters)
+            return np.tile(np.asarray(x_now, dtype=float), (len(times), 1))
+        diagnostics = self._diagnostics
+        if diagnostics is not None:
+            diagnostics.solver_started()
+        # A class_jit.JitRhs is passed as compiled function with its arguments, the solver calls it directly
+        function, args = (rhs.function, rhs.args) if hasattr(rhs, "args") else (rhs, ())
+        if self.method is None:
+            dfun = jac if jac is None or not args else lambda state, time, *_: jac(state, time)
+            xs, info = odeint(function, x_now, times, args=args, Dfun=dfun, rtol=self.rtol, atol=self.atol,
+                              full_output=True)
+            self.stats["nfev"] += int(info["nfe"][-1])
+            self.stats["njev"] += int(info["nje"][-1])
+            if diagnostics is not None:
+                diagnostics.add("accepted steps", int(info["nst"][-1]))
+                diagnostics.add("Jacobian evaluations", int(info["nje"][-1]))
+            return xs
+        # The dense output has one piece per accepted step, so it is also kept for the diagnostics
+        solution = solve_ivp(lambda time, state: function(state, time, *args), (times[0], times[-1]), x_now, self.method,
+                             t_eval=times, rtol=self.rtol, atol=self.atol,
+                             dense_output=self.dense or diagnostics is not None,
+                             jac=None if jac is None else lambda time, state: jac(state, time))
+        self._solution = (times[0], solution.sol)
+        self.stats["nfev"] += solution.nfev
+        self.stats["njev"] += solution.njev
+        if diagnostics is not None and solution.sol is not None:
+            diagnostics.add("accepted steps", len(solution.sol.ts) - 1)
+            diagnostics.add("Jacobian evaluations", int(solution.njev))
+        if not solution.success:
+            print(f"⚠️ Warning: {self.method} failed at t={solution.t[-1]:.6g} ({solution.message}).")
+            return np.vstack((solution.y.T, np.full((len(times) - solution.y.shape[1], len(x_now)), np.nan)))
+        return solution.y.T
+
+    def _section(self, name):
+        return self._diagnostics.section(name) if self._diagnostics is not None else nullcontext()
+
+    def _accept(self):
+        """ Keeps the dense output of the last _integrate call (not of the trial runs of the event search) """
+        if self.dense and self._solution is not None and self._solution[1] is not None:
+            self._segments.append(self._solution)
+
+    def _integrate_until_limit(self, rhs, x_now, times, threshold, jac=None):
+        """ Integrates over times until the substrate falls below threshold.
+
+        :return: (states at the times before the event, event time, state at the event), the event time is None
+                 if the limit was not reached
+        """
+        S = self.substrate
+        states = [x_now[None, :]]
+        for start in range(0, len(times) - 1, EVENT_CHUNK):
+            chunk = times[start:start + EVENT_CHUNK + 1]
+            xs = self._integrate(rhs, states[-1][-1], chunk, jac)
+            self._accept()
+            below = np.flatnonzero(xs[:, S] <= threshold)
+            if not below.size:
+                states.append(xs[1:])
+                continue
+
+            k = below[0]
+            t_before, x_before = chunk[k - 1], xs[k - 1]
+            states.append(xs[1:k])
+            with self._section("event search"):
+                if self.dense:
+                    # The interpolant of the chunk already contains the crossing
+                    solution = self._segments[-1][1]
+                    t_event = brentq(lambda time: solution(time)[S] - threshold, t_before, chunk[k], xtol=1e-12)
+                    return np.vstack(states), t_event, solution(t_event)
+
+                def distance(time):
+                    if time == t_before:
+                        return x_before[S] - threshold
+                    return self._integrate(rhs, x_before, [t_before, time], jac)[-1, S] - threshold
+
+                t_event = brentq(distance, t_before, chunk[k], xtol=1e-12)
+                x_event = self._integrate(rhs, x_before, [t_before, t_event], jac)[-1]
+                self._accept()
+                return np.vstack(states), t_event, x_event
+        return np.vstack(states), None, None
+
+    def run(self, x0, t):
+        """ Simulates the model from x0 over the time points t and returns a SimulationResult. """
+        t = np.asarray(t, dtype=float)
+        x = np.empty((len(t), len(x0)))
+        t_now, t_end = t[0], t[-1]
+        x_now = np.asarray(x0, dtype=float)
+        self.stats = {"nfev": 0, "njev": 0}
+        self._segments = []
+        self._diagnostics = cdiag.Diagnostics() if self.diagnostics else None
+
+        phase = None
+        feeding_started = False
+        ts = X_fedbatch_start = None
+        phases = []
+        while True:
+            new_phase = self.schedule.phase_at(t_now, x_now[self.substrate], feeding_started)
+            if new_phase != phase:
+                if new_phase == "fedbatch" and ts is None:
+                    feeding_started = True
+                    ts, X_fedbatch_start = float(t_now), float(x_now[self.biomass])
+                    if self.verbose:
+                        print(f"Feeding started at time: {ts:.3f}")
+                        print(f"Feeding started at Biomass: {X_fedbatch_start:.6f}")
+                if phases:
+                    phases[-1]["end"] = float(t_now)
+                phases.append(dict(phase=new_phase, start=float(t_now), end=float(t_end)))
+                phase = new_phase
+
+            # Integration times: phase start, grid points and stop time. A grid point at the stop time belongs to
+            # the next phase (except the end)
+            t_stop = self.schedule.next_stop(phase, t_now, t_end)
+            in_phase = (t >= t_now) & ((t < t_stop) | (t_stop == t_end))
+            times = np.unique(np.concatenate(([t_now], t[in_phase], [t_stop])))
+            slots = np.minimum(np.searchsorted(t, times), len(t) - 1)
+            on_grid = in_phase[slots] & (t[slots] == times)
+
+            feed_state = self.schedule.state(phase, ts, X_fedbatch_start)
+            phase_model = self.model.bind(**{self.feed_name: feed_state})
+            rhs = phase_model.rhs if self.jit is None else self.jit.bind(phase_model.values, feed_state)
+            jac = self.jacobian.bind(phase_model) if self.jacobian is not None else None
+            if self._diagnostics is not None:
+                rhs, jac = self._diagnostics.wrap(rhs, jac)
+            t_event = None
+            with self._section(phase):
+                if phase == "batch" and self.schedule.substrate_limit is not None:
+                    states, t_event, x_event = self._integrate_until_limit(rhs, x_now, times,
+                                                                           self.schedule.threshold, jac)
+                else:
+                    states = self._integrate(rhs, x_now, times, jac)
+                    self._accept()
+
+            n = len(states)
+            x[slots[:n][on_grid[:n]]] = states[on_grid[:n]]
+
+            if t_event is not None:
+                t_now, x_now = t_event, x_event
+                feeding_started = True
+                continue
+            if t_stop >= t_end:
+                break
+            t_now, x_now = t_stop, states[-1]
+
+        if hasattr(self.feed, "set_phase"):
+            self.feed.set_phase(phases[-1]["phase"], ts, X_fedbatch_start)
+        return SimulationResult(t, x, phases, ts, X_fedbatch_start, self.schedule.mode, self.model, self.schedule,
+                                self.feed_name, dict(self.stats),
+                                DenseTrajectory(self._segments) if self.dense and self._segments else None,
+                                self._diagnostics)
+
+
+def simulate(model, feed, x0, t, **options):
+    """ Shortcut for FedBatchSimulator(model, feed, **options).run(x0, t), see there. """
+    return FedBatchSimulator(model, feed, **options).run(x0, t)
@@ -0,0 +1,336 @@
+import ast
+import builtins
+import copy
+import hashlib
+import importlib
+import inspect
+import json
+import linecache
+import marshal
+import os
+import pickle
+import sys
+import textwrap
+import types
+
+import numpy as np
+
+import class_allthedata as catd
+import class_compiler as ccm
+import class_fedbatch as cfb
+import class_simulator as csim
+from model_loader import load_notebook_model
+
+try:
+    import yaml
+except ImportError:  # YAML is optional, JSON always works
+    yaml = None
+
+
+SPEC_FORMAT = "bioprocess-model"
+SPEC_VERSION = 1
+
+TABLES = ("variables", "inputs", "parameters", "constants", "rates")
+EQUATIONS = ("algebra", "dif_simple")
+FEED_FIELDS = ("t_const", "substrate_limit", "t_fedbatch_start")
+
+# Files read as specification (anything else is loaded as model notebook, see load_namespace)
+SPEC_EXTENSIONS = (".json", ".yaml", ".yml")
+
+# Compiled models are cached next to the spec file, like Python does for modules
+CACHE_FOLDER = "__pycache__"
+CACHE_VERSION = 1
+
+
+# -----------------------------
+# Writing
+# -----------------------------
+def _global_names(source):
+    """ Names the function reads that it does not assign itself (its globals) """
+    tree = ast.parse(source)
+    loaded, stored = set(), set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            (loaded if isinstance(node.ctx, ast.Load) else stored).add(node.id)
+        elif isinstance(node, ast.arg):
+            stored.add(node.arg)
+    return loaded - stored
+
+
+def _import_path(value):
+    """ "module" or "module:name" under which value can be imported again, None if it can not """
+    if isinstance(value, types.ModuleType):
+        return value.__name__
+    module, name = getattr(value, "__module__", None), getattr(value, "__qualname__", None)
+    if not module or not name or module == "__main__":
+        return None
+    try:
+        if _resolve(f"{module}:{name}") is value:
+            return f"{module}:{name}"
+    except (ImportError, AttributeError):
+        pass
+    return None
+
+
+def _resolve(path):
+    module, _, name = path.partition(":")
+    value = importlib.import_module(module)
+    for part in filter(None, name.split(".")):
+        value = getattr(value, part)
+    return value
+
+
+def _plain(value):
+    """ JSON fallback for the values in the tables (numpy arrays/numbers, tuples) """
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"{value!r} can not be stored in a model specification.")
+
+
+def spec_from_namespace(ns, name="model", description=""):
+    """ Model specification (a plain dict) of a model notebook: its tables, algebra and dif_simple (as source code),
+    the feed configuration, the time grid and the globals the equations use (imports like exp or np and simple
+    values like flags).
+
+    :param ns: globals of the notebook, e.g. globals() inside the notebook or model_loader.load_notebook_model(...)
+    :param name: name of the model
+    :param description: description of the model
+    :raises ValueError: if the equations use a global that can not be stored (e.g. an object of the notebook)
+    """
+    equations = {}
+    for function_name in EQUATIONS:
+        if callable(ns.get(function_name)):
+            equations[function_name] = textwrap.dedent(inspect.getsource(ns[function_name]))
+    if "dif_simple" not in equations:
+        raise ValueError("The notebook has no dif_simple function.")
+
+    imports, values, feed = {}, {}, None
+    used = set().union(*(_global_names(source) for source in equations.values()))
+    for global_name in sorted(used - set(TABLES) - set(equations)):
+        if global_name not in ns:
+            if hasattr(builtins, global_name):
+                continue
+            raise ValueError(f"'{global_name}' is used by the equations but not defined.")
+        value = ns[global_name]
+        schedule = getattr(value, "schedule", value)
+        if hasattr(schedule, "phase_at") and all(hasattr(schedule, field) for field in FEED_FIELDS):  # a cfb.Feed
+            feed = dict(name=global_name, **{field: getattr(schedule, field) for field in FEED_FIELDS})
+        elif isinstance(value, (bool, int, float, str, type(None), np.generic)):
+            values[global_name] = _plain(value) if isinstance(value, np.generic) else value
+        elif _import_path(value) is not None:
+            imports[global_name] = _import_path(value)
+        else:
+            raise ValueError(f"'{global_name}' ({type(value).__name__}) is used by the equations but can not be "
+                             f"stored, define it inside algebra/dif_simple or as number.")
+
+    t = np.asarray(ns["t"], dtype=float)
+    spec = dict(format=SPEC_FORMAT, version=SPEC_VERSION, name=name, description=description,
+                time=dict(t0=float(t[0]), t_end=float(t[-1]), dt=float((t[-1] - t[0]) / (len(t) - 1))),
+                feed=feed or dict(name="feed", **dict.fromkeys(FEED_FIELDS)))
+    for table in TABLES:
+        spec[table] = json.loads(json.dumps(ns.get(table, {}), default=_plain))
+    spec.update(equations=equations, imports=imports, globals=values)
+    return spec
+
+
+def spec_from_notebook(path, name=None, description=""):
+    """ spec_from_namespace of a model notebook (or the folder containing it), the notebook is loaded headless """
+    ns = load_notebook_model(path, headless=True)
+    return spec_from_namespace(ns, name or os.path.basename(os.path.normpath(ns["__model_dir__"])), description)
+
+
+def save_spec(spec, path):
+    """ Writes a specification as JSON, or as YAML if path ends with .yaml/.yml (needs PyYAML) """
+    with open(path + ".tmp", "w", encoding="utf-8") as file:
+        if path.endswith((".yaml", ".yml")):
+            if yaml is None:
+                raise ImportError("Writing YAML needs PyYAML (pip install pyyaml), or use a .json file.")
+            yaml.safe_dump(spec, file, sort_keys=False, allow_unicode=True)
+        else:
+            json.dump(spec, file, indent=2, ensure_ascii=False)
+    os.replace(path + ".tmp", path)
+    return path
+
+
+# -----------------------------
+# Reading
+# -----------------------------
+def read_spec(path):
+    """ Specification dict of a JSON or YAML file """
+    with open(path, "r", encoding="utf-8") as file:
+        if path.endswith((".yaml", ".yml")):
+            if yaml is None:
+                raise ImportError("Reading YAML needs PyYAML (pip install pyyaml), or use a .json file.")
+            spec = yaml.safe_load(file)
+        else:
+            spec = json.load(file)
+    if spec.get("format") != SPEC_FORMAT:
+        raise ValueError(f"{path} is not a model specification (format '{SPEC_FORMAT}').")
+    if spec.get("version", 0) > SPEC_VERSION:
+        raise ValueError(f"{path} has version {spec['version']}, this class_spec reads up to {SPEC_VERSION}.")
+    return spec
+
+
+def _cache_key(spec):
+    """ Hash of everything the compilation depends on: the equations, the names of the globals and the compiler """
+    with open(ccm.__file__, "rb") as file:
+        compiler = file.read()
+    digest = hashlib.sha256(json.dumps(dict(
+        version=CACHE_VERSION, python=sys.version, equations=spec["equations"], imports=spec.get("imports", {}),
+        globals=sorted(spec.get("globals", {})), feed=spec["feed"]["name"], tables=TABLES,
+    ), sort_keys=True).encode())
+    digest.update(compiler)
+    return digest.hexdigest()
+
+
+class SpecModel:
+    def __init__(self, spec, path=None, cache=True):
+        """ A model specification compiled into a ready-to-simulate model, without executing a notebook.
+
+        The namespace holds what the notebook would define (variables, ..., feed, t, algebra, dif_simple), model is
+        the class_compiler.CompiledModel of dif_simple. The bytecode of the equations and the result of the
+        compilation are cached in __pycache__ next to the spec file, so loading a model again takes a few
+        milliseconds. A change of the equations, of the imported globals or of class_compiler gives a new cache
+        entry, the values of the tables are read at every load (they are not part of the cache).
+
+        :param spec: specification dict (see spec_from_namespace, read_spec)
+        :param path: path of the spec file (where the cache is kept), None for no cache
+        :param cache: False to compile without reading or writing the cache
+        """
+        self.spec = spec
+        self.name = spec.get("name", "model")
+        self.path = path
+
+        ns = {"__name__": f"spec_{self.name}"}
+        for global_name, target in spec.get("imports", {}).items():
+            ns[global_name] = _resolve(target)
+        ns.update(copy.deepcopy(spec.get("globals", {})))
+        for table in TABLES:
+            ns[table] = copy.deepcopy(spec.get(table, {}))
+        feed = spec["feed"]
+        self.feed = cfb.Feed(**{field: feed.get(field) for field in FEED_FIELDS})
+        ns[feed["name"]] = self.feed
+        time = spec["time"]
+        ns.update(time)
+        ns["t"] = np.linspace(time["t0"], time["t_end"], int(round((time["t_end"] - time["t0"]) / time["dt"])) + 1)
+        if path is not None:
+            ns["__model_dir__"] = os.path.dirname(os.path.abspath(path))
+        self.namespace = ns
+
+        cache_path = self._cache_path() if cache and path is not None else None
+        cached = self._read_cache(cache_path)
+        source = "\n\n".join(spec["equations"][name] for name in EQUATIONS if name in spec["equations"])
+        filename = f"<spec {self.name}>"
+        # Registered like a notebook cell, so inspect.getsource works on the functions
+        linecache.cache[filename] = (len(source), None, source.splitlines(True), filename)
+        code = marshal.loads(cached["code"]) if cached else compile(source, filename, "exec")
+        exec(code, ns)
+        functions = (ns["dif_simple"], ns.get("algebra"))
+        if cached:
+            self.model = ccm.CompiledModel.from_compiled_state(cached["compiled"], functions, ns)
+        else:
+            self.model = ccm.compiled(ns["dif_simple"])
+            if self.model is None:
+                raise ValueError(f"dif_simple of {self.name} can not be compiled.")
+            self._write_cache(cache_path, dict(code=marshal.dumps(code), compiled=self.model.compiled_state()))
+
+    # -----------------------------
+    # Cache
+    # -----------------------------
+    def _cache_path(self):
+        folder = os.path.join(os.path.dirname(os.path.abspath(self.path)), CACHE_FOLDER)
+        stem = os.path.splitext(os.path.basename(self.path))[0]
+        return os.path.join(folder, f"{stem}.{_cache_key(self.spec)[:16]}.pickle")
+
+    @staticmethod
+    def _read_cache(cache_path):
+        if cache_path is None:
+            return None
+        try:
+            with open(cache_path, "rb") as file:
+                return pickle.load(file)
+        except (OSError, EOFError, pickle.UnpicklingError, ValueError, AttributeError):
+            return None
+
+    @staticmethod
+    def _write_cache(cache_path, entry):
+        if cache_path is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            with open(cache_path + ".tmp", "wb") as file:
+                pickle.dump(entry, file)
+            os.replace(cache_path + ".tmp", cache_path)
+        except OSError:  # e.g. a read-only folder, the model just is not cached
+            pass
+
+    # -----------------------------
+    # Simulation
+    # -----------------------------
+    @property
+    def t(self):
+        return self.namespace["t"]
+
+    @property
+    def x0(self):
+        return np.array([meta["initial_value"] for meta in self.namespace["variables"].values()], dtype=float)
+
+    def rates(self):
+        """ Rates in the order algebra returns them, with the entries of the rates table where the names match """
+        names = self.namespace["algebra"](self.x0, self.t[0]) if "algebra" in self.namespace else {}
+        return {name: self.namespace["rates"].get(name, {}) for name in names}
+
+    def simulator(self, **options):
+        """ csim.FedBatchSimulator of the model, options as there """
+        return csim.FedBatchSimulator(self.model.refresh(), self.feed, feed_name=self.spec["feed"]["name"],
+                                      **options)
+
+    def simulate(self, x0=None, t=None, **options):
+        """ csim.simulate of the model, x0 and t of the specification by default """
+        return self.simulator(**options).run(self.x0 if x0 is None else x0, self.t if t is None else t)
+
+    def allthedata(self, simulation, description=None):
+        """ allthedata dict of a simulation (catd.AllthedataBuilder with all rates) """
+        rates = self.rates()
+        ns = self.namespace
+        builder = catd.AllthedataBuilder(ns["variables"], ns["inputs"], rates, simulation.x_and_rs(rates),
+                                         simulation.t, description=description or self.name,
+                                         **simulation.builder_kwargs())
+        return builder.build()
+
+
+def load_model(path, cache=True):
+    """ SpecModel of a specification file (JSON or YAML) """
+    return SpecModel(read_spec(path), path, cache)
+
+
+def load_namespace(path):
+    """ Namespace of a model (variables, ..., feed, t, algebra, dif_simple): of a specification file (without
+    executing the notebook) or of a model notebook or folder (model_loader.load_notebook_model, headless)
+    """
+    if path.endswith(SPEC_EXTENSIONS):
+        return load_model(path).namespace
+    return load_notebook_model(path, headless=True)
+
+
+# -----------------------------
+# Worker processes
+# -----------------------------
+def portable_model(model):
+    """ A model in the form that is sent to worker processes (class_sweep, class_bootstrap): a path (model notebook
+    or folder) stays a path and every process loads the saved notebook; a namespace (globals() of the running
+    notebook) becomes its specification (spec_from_namespace), so every process uses the tables and equations of
+    the kernel, also if they were changed after the notebook was saved.
+    """
+    if isinstance(model, dict):
+        return model if model.get("format") == SPEC_FORMAT else spec_from_namespace(model)
+    return os.fspath(model)
+
+
+def portable_namespace(model):
+    """ Namespace of a portable_model: the specification compiled (without cache) or the notebook loaded """
+    if isinstance(model, dict):
+        return SpecModel(model, cache=False).namespace
+    return load_notebook_model(model)
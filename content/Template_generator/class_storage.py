@@ -0,0 +1,203 @@
+import json
+import os
+from collections.abc import Mapping
+
+import numpy as np
+
+import class_allthedata as catd
+
+
+STORAGE_FORMAT = "allthedata"
+STORAGE_VERSION = 1
+
+# Files inside the folder of a saved collection
+METADATA_FILE = "allthedata.json"
+ARRAYS_FILE = "arrays.bin"
+COMPRESSED_FILE = "arrays.npz"
+
+# Start of every array in ARRAYS_FILE is a multiple of this (aligned reads of the memory map)
+ALIGNMENT = 64
+
+
+class _Writer:
+    """ Turns an allthedata collection into JSON metadata and a list of arrays. Every array is stored once: arrays
+    used in several places (e.g. a time grid shared by all experiments) by identity, columns of a stored block
+    (e.g. the feed placeholder x_and_rs[:, 0]) as a reference to the block.
+    """
+
+    def __init__(self, columns=True):
+        self.arrays = []
+        self.refs = {}
+        self.blocks = []
+        self.columns = columns
+        self._seen = []  # every array given to ref, kept alive so that its id is not reused
+
+    def encode(self, value):
+        if isinstance(value, (catd.ColumnBlock, catd.LazyColumns)):
+            values = value.values if isinstance(value, catd.ColumnBlock) else \
+                np.column_stack([value[name] for name in value])
+            return {"__columns__": self.ref(values, block=True), "names": list(value)}
+        if isinstance(value, Mapping):
+            return {str(key): self.encode(item) for key, item in value.items()}
+        if isinstance(value, np.ndarray):
+            if value.dtype == object:
+                return self.encode(value.tolist())
+            ref = self.ref(value)
+            return dict(ref, matrix=True) if isinstance(value, np.matrix) else ref
+        if isinstance(value, np.generic):
+            return value.item()
+        if isinstance(value, (list, tuple)):
+            return [self.encode(item) for item in value]
+        if value is None or isinstance(value, (str, bool, int, float)):
+            return value
+        raise TypeError(f"{type(value).__name__} can not be saved in allthedata ({value!r}).")
+
+    def ref(self, array, block=False):
+        if id(array) in self.refs:
+            return self.refs[id(array)]
+        ref = self._column_of_block(array) if self.columns and array.ndim == 1 else None
+        if ref is None:
+            ref = {"__array__": len(self.arrays)}
+            self.arrays.append(np.asarray(array))
+            if block and array.ndim == 2:
+                self.blocks.append((array, ref["__array__"]))
+        self.refs[id(array)] = ref
+        self._seen.append(array)
+        return ref
+
+    def _column_of_block(self, array):
+        address = array.__array_interface__["data"][0]
+        for block, index in self.blocks:
+            if block.shape[0] != array.shape[0] or block.dtype != array.dtype or block.strides[0] != array.strides[0]:
+                continue
+            offset = address - block.__array_interface__["data"][0]
+            if 0 <= offset < block.shape[1] * block.strides[1] and offset % block.strides[1] == 0:
+                return {"__array__": index, "column": offset // block.strides[1]}
+        return None
+
+
+def save_allthedata(allthedata, path, compress=False):
+    """ Saves an allthedata dict or a collection of them (e.g. {"1": allthedata} or MultiExperimentResult.allthedata)
+    into the folder path: the arrays in one binary file, everything else in allthedata.json.
+
+    Every block of states and rates is stored column by column, so load_allthedata can memory-map the file and
+    reading one variable only reads that variable from the disk. Arrays used several times (shared time grids,
+    placeholders) are stored once.
+
+    :param allthedata: allthedata dict or dict of them by expID
+    :param path: folder (created if needed, existing files of a saved collection are replaced)
+    :param compress: True for a compressed .npz instead (smaller, but every block is read completely when one of
+                     its columns is used)
+    :return: path
+    """
+    writer = _Writer(columns=not compress)
+    tree = writer.encode(allthedata)
+    os.makedirs(path, exist_ok=True)
+
+    entries = []
+    if compress:
+        arrays_path = os.path.join(path, COMPRESSED_FILE)
+        with open(arrays_path + ".tmp", "wb") as file:
+            np.savez_compressed(file, **{str(i): array for i, array in enumerate(writer.arrays)})
+        entries = [{"key": str(i)} for i in range(len(writer.arrays))]
+    else:
+        arrays_path = os.path.join(path, ARRAYS_FILE)
+        with open(arrays_path + ".tmp", "wb") as file:
+            for array in writer.arrays:
+                order = "F" if array.ndim == 2 else "C"
+                offset = -file.tell() % ALIGNMENT
+                file.write(b"\0" * offset)
+                entries.append({"dtype": array.dtype.str, "shape": list(array.shape), "order": order,
+                                "offset": file.tell()})
+                file.write(array.tobytes(order=order))
+
+    metadata = dict(format=STORAGE_FORMAT, version=STORAGE_VERSION, compressed=compress, arrays=entries, data=tree)
+    metadata_path = os.path.join(path, METADATA_FILE)
+    with open(metadata_path + ".tmp", "w", encoding="utf-8") as file:
+        json.dump(metadata, file)
+    os.replace(arrays_path + ".tmp", arrays_path)
+    os.replace(metadata_path + ".tmp", metadata_path)
+    return path
+
+
+class _NpzBlock:
+    """ Block of a compressed collection, read from the .npz when one of its columns is used (for LazyColumns) """
+
+    def __init__(self, archive, key):
+        self.archive = archive
+        self.key = key
+        self.values = None
+
+    def __getitem__(self, index):
+        if self.values is None:
+            self.values = self.archive[self.key]
+        return self.values[index]
+
+
+class _Reader:
+    def __init__(self, path, metadata, mmap):
+        self.entries = metadata["arrays"]
+        self.arrays = {}
+        if metadata["compressed"]:
+            self.archive = np.load(os.path.join(path, COMPRESSED_FILE))
+            self.buffer = None
+        else:
+            self.archive = None
+            arrays_path = os.path.join(path, ARRAYS_FILE)
+            if os.path.getsize(arrays_path) == 0:
+                self.buffer = b""
+            elif mmap:
+                self.buffer = np.memmap(arrays_path, dtype=np.uint8, mode="r")
+            else:
+                self.buffer = np.fromfile(arrays_path, dtype=np.uint8)
+
+    def array(self, index):
+        if index not in self.arrays:
+            entry = self.entries[index]
+            if self.archive is not None:
+                array = self.archive[entry["key"]]
+            elif np.prod(entry["shape"]) == 0:
+                array = np.empty(entry["shape"], dtype=entry["dtype"])
+            else:
+                # A view of the file: nothing is read until the values are used
+                array = np.ndarray(entry["shape"], dtype=entry["dtype"], buffer=self.buffer,
+                                   offset=entry["offset"], order=entry["order"])
+            self.arrays[index] = array
+        return self.arrays[index]
+
+    def decode(self, value):
+        if isinstance(value, dict):
+            if "__columns__" in value:
+                index = value["__columns__"]["__array__"]
+                if self.archive is not None:
+                    return catd.LazyColumns(_NpzBlock(self.archive, self.entries[index]["key"]), value["names"])
+                return catd.ColumnBlock(self.array(index), value["names"])
+            if "__array__" in value:
+                array = self.array(value["__array__"])
+                if "column" in value:
+                    array = array[:, value["column"]]
+                return np.asmatrix(array) if value.get("matrix") else array
+            return {key: self.decode(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self.decode(item) for item in value]
+        return value
+
+
+def load_allthedata(path, mmap=True):
+    """ Loads what save_allthedata saved in the folder path.
+
+    The arrays are views of the memory-mapped file (read-only): loading reads only allthedata.json, the values are
+    read from the disk when they are used, e.g. by a plot of some experiments. Compressed collections read every
+    block of states and rates on its first use.
+
+    :param path: folder of the saved collection
+    :param mmap: False to read all arrays into memory (writable, the file can be deleted afterwards)
+    """
+    with open(os.path.join(path, METADATA_FILE), "r", encoding="utf-8") as file:
+        metadata = json.load(file)
+    if metadata.get("format") != STORAGE_FORMAT:
+        raise ValueError(f"{path} does not contain a saved allthedata (format '{STORAGE_FORMAT}').")
+    if metadata.get("version", 0) > STORAGE_VERSION:
+        raise ValueError(f"{path} has version {metadata['version']}, this class_storage reads up to "
+                         f"{STORAGE_VERSION}.")
+    return _Reader(path, metadata, mmap).decode(metadata["data"])
@@ -0,0 +1,267 @@
+import concurrent.futures
+import contextlib
+import io
+import itertools
+import multiprocessing.util
+import os
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import class_ensemble as cens
+import class_simulator as csim
+import class_spec as cspec
+
+
+# Number of scenarios simulated by one task (one ensemble per task, see class_ensemble)
+DEFAULT_CHUNK_SIZE = 8
+
+# Tasks kept waiting per worker, more are submitted only when one is done
+TASKS_PER_WORKER = 2
+
+
+def grid(axes):
+    """ All combinations of the values of axes as a list of scenarios (the last axis changes fastest), e.g.
+    grid({"mu_set": [0.1, 0.2], "inputs.Feed.concentration": [300, 500]}) gives 4 scenarios.
+    """
+    names = list(axes)
+    return [dict(zip(names, values)) for values in itertools.product(*(np.atleast_1d(axes[name]) for name in names))]
+
+
+class SweepResult:
+    def __init__(self, t, x_and_rs, ts, X_fedbatch_start, columns, n_states, scenarios):
+        """ Results of all scenarios of a sweep, in the order of the scenarios.
+
+        :param t: time points (the same for all scenarios)
+        :param x_and_rs: states and rates, shape (n_scenarios, len(t), n_states + n_rates)
+        :param ts: feed start of every scenario (nan if the feeding never started)
+        :param X_fedbatch_start: biomass at the feed start of every scenario (nan if the feeding never started)
+        :param columns: names of the columns of x_and_rs (variables, then rates)
+        :param n_states: number of states (the first columns)
+        :param scenarios: the overrides of every scenario
+        """
+        self.t = t
+        self.x_and_rs = x_and_rs
+        self.ts = ts
+        self.X_fedbatch_start = X_fedbatch_start
+        self.columns = columns
+        self.n_states = n_states
+        self.scenarios = scenarios
+
+    def __len__(self):
+        return len(self.scenarios)
+
+    @property
+    def x(self):
+        return self.x_and_rs[..., :self.n_states]
+
+    def column(self, name):
+        """ One variable or rate of all scenarios, shape (n_scenarios, len(t)) """
+        return self.x_and_rs[..., self.columns.index(name)]
+
+
+class _Store:
+    """ The result arrays of a sweep in one block of memory, shared with the worker processes if name is given. """
+
+    def __init__(self, n_scenarios, n_points, n_columns, name=None, create=False):
+        self.shape = (n_scenarios, n_points, n_columns)
+        size = 8 * (n_scenarios * n_points * n_columns + 2 * n_scenarios)
+        self.memory = None
+        if create:
+            self.memory = shared_memory.SharedMemory(create=True, size=size)
+            buffer = self.memory.buf
+        elif name is not None:
+            self.memory = shared_memory.SharedMemory(name=name)
+            buffer = self.memory.buf
+        else:
+            buffer = bytearray(size)
+        flat = np.frombuffer(buffer, dtype=float)
+        n_values = n_scenarios * n_points * n_columns
+        self.x_and_rs = flat[:n_values].reshape(self.shape)
+        self.ts = flat[n_values:n_values + n_scenarios]
+        self.X_fedbatch_start = flat[n_values + n_scenarios:]
+
+    @property
+    def name(self):
+        return None if self.memory is None else self.memory.name
+
+    def copy(self):
+        return np.array(self.x_and_rs), np.array(self.ts), np.array(self.X_fedbatch_start)
+
+    def close(self, unlink=False):
+        if self.memory is None:
+            return
+        self.x_and_rs = self.ts = self.X_fedbatch_start = None  # the views must be gone before close
+        self.memory.close()
+        if unlink:
+            self.memory.unlink()
+
+
+class _ChunkRunner:
+    """ Builds the model once (class_spec.portable_namespace) and simulates chunks of scenarios with it (in the
+    parent or in a worker).
+    """
+
+    def __init__(self, model, t, rates, rtol, atol, jit=False):
+        with contextlib.redirect_stdout(io.StringIO()):
+            ns = cspec.portable_namespace(model)
+        self.t = np.asarray(ns["t"] if t is None else t, dtype=float)
+        self.variables = list(ns["variables"])
+        self.x0 = np.array([meta["initial_value"] for meta in ns["variables"].values()], dtype=float)
+        self.rates = list(ns["algebra"](self.x0, self.t[0]) if rates is None else rates)
+        self.simulator = cens.EnsembleSimulator(ns["dif_simple"], ns["feed"], rtol=rtol, atol=atol, jit=jit)
+        self.model = self.simulator.model
+
+    @property
+    def columns(self):
+        return self.variables + self.rates
+
+    def check(self, scenario):
+        """ Raises a KeyError for an override that is not used by the model """
+        for name in scenario:
+            if self._initial_value_position(name) is None and name not in self.model.index:
+                raise KeyError(f"'{name}' is not used by the model. Available: {self.model.names} and "
+                               f"{[f'variables.{variable}.initial_value' for variable in self.variables]}")
+
+    def _initial_value_position(self, name):
+        table, _, rest = name.partition(".")
+        variable, _, field = rest.rpartition(".")
+        if table == "variables" and field == "initial_value" and variable in self.variables:
+            return self.variables.index(variable)
+        return None
+
+    def run(self, scenarios, store, start):
+        """ Simulates the scenarios as one ensemble and writes the results into store[start:start + len(scenarios)] """
+        x0 = np.tile(self.x0, (len(scenarios), 1))
+        parameters = {}
+        for i, scenario in enumerate(scenarios):
+            for name, value in scenario.items():
+                position = self._initial_value_position(name)
+                if position is not None:
+                    x0[i, position] = value
+                if name in self.model.index:
+                    if name not in parameters:
+                        parameters[name] = np.full(len(scenarios), self.model.values[self.model.index[name]], float)
+                    parameters[name][i] = value
+
+        ensemble = self.simulator.run(x0, self.t, parameters)
+        rows = slice(start, start + len(scenarios))
+        ensemble.x_and_rs(self.rates, out=store.x_and_rs[rows])
+        store.ts[rows] = [np.nan if member.ts is None else member.ts for member in ensemble.members]
+        store.X_fedbatch_start[rows] = [np.nan if member.X_fedbatch_start is None else member.X_fedbatch_start
+                                        for member in ensemble.members]
+
+
+# State of a worker process (set by _init_worker)
+_worker = {}
+
+
+def _init_worker(model, t, rates, rtol, atol, jit, store_name, shape):
+    _worker["runner"] = _ChunkRunner(model, t, rates, rtol, atol, jit)
+    _worker["store"] = _Store(*shape, name=store_name)
+    # Closes the mapping when the worker exits (atexit does not run in forked workers)
+    multiprocessing.util.Finalize(None, _worker["store"].close, exitpriority=10)
+
+
+def _run_chunk(start, scenarios):
+    with contextlib.redirect_stdout(io.StringIO()):
+        _worker["runner"].run(scenarios, _worker["store"], start)
+    return start, len(scenarios)
+
+
+class Sweep:
+    def __init__(self, model_path, t=None, rates=None, workers=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                 rtol=csim.DEFAULT_TOL, atol=csim.DEFAULT_TOL, jit=False):
+        """ Runs many scenarios of a model notebook (e.g. one of the Library_of_models folders) on all cores.
+
+        Every scenario is a dict of overrides: constants and parameters by name ("mu_set") or path
+        ("constants.mu_set.value"), initial values as "variables.<name>.initial_value" and used inputs as
+        "inputs.<name>.<field>" (e.g. "inputs.Feed.concentration"). The scenarios are split into chunks of
+        chunk_size which are simulated as one ensemble (class_ensemble) by a concurrent.futures.ProcessPoolExecutor.
+        Every worker builds the model once (see class_spec.portable_model) and writes its results directly into one
+        shared result store, so only the scenarios are sent to the workers and nothing is sent back per run.
+
+        :param model_path: model notebook or folder containing it (the saved notebook is used, not the state of a
+                           running kernel), or the namespace of the running notebook (globals()), whose current
+                           tables and equations are used by every process
+        :param t: time points, defaults to t of the notebook
+        :param rates: names of the rates in the result, defaults to everything algebra returns
+        :param workers: number of processes (default: number of cores), 1 runs everything in this process
+        :param chunk_size: number of scenarios per task
+        :param rtol: relative tolerance of the solver
+        :param atol: absolute tolerance of the solver
+        :param jit: True to simulate with dif_simple compiled by numba (class_jit), compiled once per process
+        """
+        self.model_path = model_path
+        self.portable_model = cspec.portable_model(model_path)
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.rtol = rtol
+        self.atol = atol
+        self.jit = jit
+        self.runner = _ChunkRunner(self.portable_model, t, rates, rtol, atol, jit)
+        self.t = self.runner.t
+        self.rates = self.runner.rates
+
+    def run(self, scenarios, progress=None):
+        """ Simulates all scenarios and returns a SweepResult (same order as scenarios).
+
+        :param scenarios: list of override dicts (see grid for all combinations of some values)
+        :param progress: called as progress(done, total) every time a chunk is finished
+        """
+        scenarios = [dict(scenario) for scenario in scenarios]
+        for scenario in scenarios:
+            self.runner.check(scenario)
+        chunks = [(start, scenarios[start:start + self.chunk_size])
+                  for start in range(0, len(scenarios), self.chunk_size)]
+        shape = (len(scenarios), len(self.t), len(self.runner.columns))
+
+        workers = self.workers or os.cpu_count() or 1
+        if workers > 1 and len(chunks) > 1:
+            try:
+                arrays = self._run_parallel(chunks, shape, min(workers, len(chunks)), progress)
+            except (OSError, NotImplementedError) as error:  # no processes (e.g. in the browser)
+                print(f"⚠️ Warning: could not start worker processes ({error}), the sweep runs in this process.")
+            else:
+                return SweepResult(self.t, *arrays, self.runner.columns, len(self.runner.variables), scenarios)
+
+        store = _Store(*shape)
+        done = 0
+        for start, chunk in chunks:
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.runner.run(chunk, store, start)
+            done += len(chunk)
+            if progress is not None:
+                progress(done, len(scenarios))
+        return SweepResult(self.t, store.x_and_rs, store.ts, store.X_fedbatch_start, self.runner.columns,
+                           len(self.runner.variables), scenarios)
+
+    def _run_parallel(self, chunks, shape, workers, progress):
+        store = _Store(*shape, create=True)
+        try:
+            init_args = (self.portable_model, self.t, self.rates, self.rtol, self.atol, self.jit, store.name, shape)
+            with concurrent.futures.ProcessPoolExecutor(workers, initializer=_init_worker,
+                                                        initargs=init_args) as executor:
+                waiting = iter(chunks)
+                running = set()
+                done = 0
+                while True:
+                    # Only a few tasks per worker are submitted at a time
+                    for start, chunk in itertools.islice(waiting, workers * TASKS_PER_WORKER - len(running)):
+                        running.add(executor.submit(_run_chunk, start, chunk))
+                    if not running:
+                        break
+                    finished, running = concurrent.futures.wait(running,
+                                                                return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in finished:
+                        done += future.result()[1]
+                        if progress is not None:
+                            progress(done, shape[0])
+            return store.copy()
+        finally:
+            store.close(unlink=True)
+
+
+def run_sweep(model_path, scenarios, progress=None, **options):
+    """ Shortcut for Sweep(model_path, **options).run(scenarios, progress), see there. """
+    return Sweep(model_path, **options).run(scenarios, progress)
@@ -0,0 +1,100 @@
+import ast
+import json
+import linecache
+import os
+import sys
+
+
+def find_model_notebook(model_dir):
+    """
+    Returns the path of the model notebook inside a model folder (e.g. one of the Library_of_models folders).
+    Saved inputs notebooks and checkpoints are ignored.
+    """
+    notebooks = sorted(
+        name for name in os.listdir(model_dir)
+        if name.endswith(".ipynb") and not name.startswith("saved_inputs_for_")
+    )
+    if not notebooks:
+        raise FileNotFoundError(f"No model notebook found in {model_dir}")
+    if len(notebooks) > 1:
+        print(f"⚠️ Warning: more than one notebook in {model_dir}, using '{notebooks[0]}'.")
+    return os.path.join(model_dir, notebooks[0])
+
+
+def _without_ipython(source, namespace):
+    """
+    Code of a cell without its IPython imports (e.g. `from IPython.display import Markdown`), the imported names
+    are defined as functions that do nothing. Returns the compilable module.
+    """
+    module = ast.parse(source)
+    body = []
+    for stmt in module.body:
+        if isinstance(stmt, ast.ImportFrom) and (stmt.module or "").split(".")[0] == "IPython":
+            namespace.update({alias.asname or alias.name: _no_display for alias in stmt.names})
+        elif isinstance(stmt, ast.Import) and any(alias.name.split(".")[0] == "IPython" for alias in stmt.names):
+            continue
+        else:
+            body.append(stmt)
+    module.body = body
+    return module
+
+
+def _no_display(*args, **kwargs):
+    return None
+
+
+def load_notebook_model(path, stop_after="dif_simple", headless=False):
+    """
+    Executes the definition cells of a generated model notebook (imports, time, feed, variables, inputs,
+    parameters, constants, rates, algebra and dif_simple) and returns the resulting namespace.
+
+    Cells with Jupyter magics (%pip) and cells that only display the Markdown tables are skipped, execution
+    stops after the cell that defines `stop_after`, so nothing is simulated or plotted.
+
+    :param path: path to the .ipynb file or to the folder containing it
+    :param stop_after: name of the function after whose definition the execution stops
+    :param headless: leave out the imports of IPython (display, Markdown, ...), e.g. for the command line runner
+                     without Jupyter
+    :return: dict with everything the notebook defined (variables, constants, feed, dif_simple, ...)
+    """
+    if os.path.isdir(path):
+        path = find_model_notebook(path)
+    path = os.path.abspath(path)
+    model_dir = os.path.dirname(path)
+
+    with open(path, "r", encoding="utf-8") as f:
+        nb = json.load(f)
+
+    # Use the modules next to the notebook (every model folder has its own copies)
+    for file_name in os.listdir(model_dir):
+        if file_name.endswith(".py"):
+            sys.modules.pop(file_name[:-3], None)
+    sys.path.insert(0, model_dir)
+
+    namespace = {"__name__": "__main__"}
+    cwd = os.getcwd()
+    os.chdir(model_dir)
+    try:
+        for i, cell in enumerate(nb["cells"]):
+            if cell["cell_type"] != "code":
+                continue
+            source = "".join(cell["source"])
+            if not source.strip() or source.lstrip().startswith("%") or "Markdown(" in source:
+                continue
+
+            # Register the cell like IPython does, so inspect.getsource works on the defined functions
+            filename = f"<{os.path.basename(path)} cell {i}>"
+            linecache.cache[filename] = (len(source), None, source.splitlines(True), filename)
+            code = _without_ipython(source, namespace) if headless else source
+            exec(compile(code, filename, "exec"), namespace)
+
+            if stop_after in namespace:
+                break
+        else:
+            raise ValueError(f"'{stop_after}' is not defined in {path}")
+    finally:
+        os.chdir(cwd)
+        sys.path.remove(model_dir)
+
+    namespace["__model_dir__"] = model_dir
+    return namespace